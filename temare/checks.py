@@ -6,7 +6,8 @@ import re
 import os.path
 import urlparse
 from config import minmem, maxmem, mincores, maxcores, \
-                   formats, tstimeout, grubtemplates
+                   formats, tstimeout, grubtemplates, diskcaches, diskaios, \
+                   maxovercommit, overheads, hypervisors
 
 
 def chk_arg_count(args, count):
@@ -46,6 +47,22 @@ def chk_bitness(bitness):
                 'Valid values are 32|64.')
 
 
+def chk_capability(capability):
+    """Check and translate input value for an I/O capability of a
+       guest image, such as virtio or vhost-net support
+       @return: 0 for unsupported
+                1 for supported
+    """
+    if capability in ('yes', 'true', '1'):
+        return 1
+    elif capability in ('no', 'false', '0'):
+        return 0
+    else:
+        raise ValueError(
+                'Invalid value for a capability.\n'
+                'Valid values are 0|1, false|true, or yes|no.')
+
+
 def chk_cores(cores):
     """Check and translate input value for the number of CPU cores
        Limits set to 1 and 64 for now
@@ -63,6 +80,34 @@ def chk_cores(cores):
     return cores
 
 
+def chk_diskaio(aio):
+    """Check input value for the asynchronous I/O mode of a guest image
+       Valid values are defined in config.diskaios, or 'default'
+       @return: AIO mode, None for the default of the hypervisor
+    """
+    if aio == 'default':
+        return None
+    if aio not in diskaios:
+        raise ValueError(
+                'Invalid AIO mode.\n'
+                'Valid values are default, %s.' % (', '.join(diskaios), ))
+    return aio
+
+
+def chk_diskcache(cache):
+    """Check input value for the disk cache mode of a guest image
+       Valid values are defined in config.diskcaches, or 'default'
+       @return: cache mode, None for the default of the hypervisor
+    """
+    if cache == 'default':
+        return None
+    if cache not in diskcaches:
+        raise ValueError(
+                'Invalid disk cache mode.\n'
+                'Valid values are default, %s.' % (', '.join(diskcaches), ))
+    return cache
+
+
 def chk_grub_template(subjectname, replacements):
     """Check for completeness of the values needed to fill the GRUB template
     """
@@ -101,6 +146,51 @@ def chk_hostname(hostname):
     return hostname
 
 
+def chk_hugepages(hugepages):
+    """Check input value for the size of a hugepage pool in MB
+       Must be a non-negative integer value up to the maximum memory
+       @return: size of the hugepage pool as integer
+    """
+    if re.match('^[0-9]+$', str(hugepages)) == None:
+        raise ValueError(
+                'Invalid value for the size of the hugepage pool.\n'
+                'Only non-negative integer values are allowed.')
+    hugepages = int(hugepages)
+    if hugepages > maxmem:
+        raise ValueError(
+                'Invalid value for the size of the hugepage pool.\n'
+                'The maximum size is limited to %s MB.' % (maxmem, ))
+    return hugepages
+
+
+def chk_hostclass(hostclass):
+    """Check input value for the class of a host
+       Must match regexp ^[A-Za-z][A-Za-z0-9_\-]*$
+       Length limited to 32 characters
+       @return: name of the host class as string
+    """
+    hostclass = str(hostclass)
+    if re.match('^[A-Za-z][A-Za-z0-9_\-]*$', hostclass) == None:
+        raise ValueError('Invalid name for a host class.')
+    if len(hostclass) > 32:
+        raise ValueError(
+                'Invalid name for a host class.\n'
+                'The length is limited to 32 characters.')
+    return hostclass
+
+
+def chk_hypervisor(hypervisor):
+    """Check input value for a hypervisor type
+       Valid values are defined in config.hypervisors
+       @return: hypervisor type as string
+    """
+    if hypervisor not in hypervisors:
+        raise ValueError(
+                'Invalid hypervisor type.\n'
+                'Valid values are %s.' % (', '.join(hypervisors), ))
+    return hypervisor
+
+
 def chk_imageformat(imageformat):
     """Check input value for the guest image format
        Valid values are defined as the keys of config.formats
@@ -132,7 +222,33 @@ def chk_imagename(imagename):
     return imagename
 
 
-def chk_memory(memory):
+def chk_limit(limit):
+    """Check input value for a concurrency limit
+       Must be a positive integer value
+       @return: limit as integer
+    """
+    limit = str(limit)
+    if not limit.isdigit() or int(limit) == 0:
+        raise ValueError(
+                'Invalid value for a concurrency limit.\n'
+                'Only positive integer values are allowed.')
+    return int(limit)
+
+
+def chk_count(count):
+    """Check input value for a number of items
+       Must be a non-negative integer value
+       @return: count as integer
+    """
+    count = str(count)
+    if not count.isdigit():
+        raise ValueError(
+                'Invalid value for a number.\n'
+                'Only non-negative integer values are allowed.')
+    return int(count)
+
+
+def chk_memory(memory, minimum=minmem):
     """Check and translate input value for the amount of memory
        Limits set to 1G and 32G for now
        Allows extensions M, MB, G and GB
@@ -149,13 +265,83 @@ def chk_memory(memory):
         memory = int(memory.rstrip('M'))
     else:
         memory = int(memory)
-    if memory < minmem or memory > maxmem:
+    if memory < minimum or memory > maxmem:
         raise ValueError(
                 'Invalid memory size.\n'
-                'The size must be between %sM and %sM.' % (minmem, maxmem))
+                'The size must be between %sM and %sM.' % (minimum, maxmem))
     return memory
 
 
+def chk_nodes(nodes):
+    """Check and translate input value for the number of NUMA nodes
+       Limited to the maximum number of CPU cores
+       @return: number of NUMA nodes as integer
+    """
+    if re.match('^[1-9][0-9]*$', str(nodes)) == None:
+        raise ValueError(
+                'Invalid value for the number of NUMA nodes.\n'
+                'Only positive integer values are allowed.')
+    nodes = int(nodes)
+    if nodes > maxcores:
+        raise ValueError(
+                'Invalid value for the number of NUMA nodes.\n'
+                'The maximum number is limited to %s.' % (maxcores, ))
+    return nodes
+
+
+def chk_cpulist(cpulist):
+    """Check the CPUs of a NUMA node, given as a list of CPU numbers and
+       ranges as in 0-3,8-11
+       @return: number of CPUs in the list
+    """
+    if re.match('^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$', cpulist) == None:
+        raise ValueError(
+                'Invalid CPU list "%s".\n'
+                'Only CPU numbers and ranges separated by commas are '
+                'allowed, as in 0-3,8-11.' % (cpulist, ))
+    count = 0
+    for cpus in cpulist.split(','):
+        first, last = (cpus.split('-') * 2)[:2]
+        if int(first) > int(last):
+            raise ValueError('Invalid CPU range "%s".' % (cpus, ))
+        count += int(last) - int(first) + 1
+    return count
+
+
+def chk_numa(nodes):
+    """Check and translate input value for the NUMA nodes of a host,
+       either the number of nodes, or the CPU lists of all nodes as in
+       chk_cpulist(), separated by slashes as in 0-3,8-11/4-7,12-15
+       @return: tuple of the number of NUMA nodes as integer and the CPU
+                lists or None if only the number was given
+    """
+    if re.match('^[0-9]+$', str(nodes)) != None:
+        return chk_nodes(nodes), None
+    cpulists = str(nodes).split('/')
+    for cpulist in cpulists:
+        chk_cpulist(cpulist)
+    return chk_nodes(len(cpulists)), '/'.join(cpulists)
+
+
+def chk_overhead(name, value):
+    """Check input values for a parameter of the overhead model
+       Valid names are the keys of config.overheads['default'], values
+       must be non-negative numbers, and positive for vcpus
+       @return: tuple of the name and the value as float
+    """
+    if name not in overheads['default'].keys():
+        raise ValueError(
+                'Invalid overhead parameter.\n'
+                'Valid values are %s.' %
+                (', '.join(sorted(overheads['default'].keys())), ))
+    if re.match('^[0-9]+(\.[0-9]+)?$', str(value)) == None or \
+            (name == 'vcpus' and float(value) == 0):
+        raise ValueError(
+                'Invalid value for the overhead parameter %s.\n'
+                'Only non-negative numbers are allowed.' % (name, ))
+    return name, float(value)
+
+
 def chk_ostype(ostype):
     """Check input value for the operating system type
        Must match regexp ^[A-Za-z][A-Za-z0-9_\-]+$
@@ -172,6 +358,19 @@ def chk_ostype(ostype):
     return ostype
 
 
+def chk_overcommit(ratio):
+    """Check input value for the memory overcommit ratio of a host
+       Must be a number from 1.0 (no overcommit) to config.maxovercommit
+       @return: overcommit ratio as float
+    """
+    if re.match('^[0-9]+(\.[0-9]+)?$', str(ratio)) == None or \
+            float(ratio) < 1.0 or float(ratio) > maxovercommit:
+        raise ValueError(
+                'Invalid value for the memory overcommit ratio.\n'
+                'Valid values are numbers from 1.0 to %s.' % (maxovercommit, ))
+    return float(ratio)
+
+
 def chk_priority(priority):
     """Check the input value for the Tapper queue bandwidth
     Must be a positive integer value
@@ -184,6 +383,27 @@ def chk_priority(priority):
     return int(priority)
 
 
+def chk_requirement(requirement, value):
+    """Check and translate a resource requirement of a test
+       Memory is checked as in chk_memory() with a minimum of 1G for
+       guests, VCPUs as in chk_cores(), none removes the requirement
+       @return: tuple of the database column of the requirement and
+                its value as integer or None
+    """
+    if requirement not in requirements:
+        raise ValueError(
+                'Unknown resource requirement.\n'
+                'Valid requirements are %s.' % ('|'.join(requirements), ))
+    column = {'minmem': 'min_memory', 'prefmem': 'pref_memory',
+              'mincores': 'min_cores', 'prefcores': 'pref_cores'}
+    if value == 'none':
+        return column[requirement], None
+    elif requirement.endswith('mem'):
+        return column[requirement], chk_memory(value, 1024)
+    else:
+        return column[requirement], chk_cores(value)
+
+
 def chk_runtime(runtime):
     """Check input value for test suite runtime
        Must be a positive integer value
@@ -392,3 +612,6 @@ def chk_url(url):
 grubvalues = {
         'kernel': chk_abspath, 'initrd': chk_abspath,
         'ks_file': chk_url, 'install': chk_url}
+
+# Resource requirements of tests in the order testadd accepts them
+requirements = ['minmem', 'prefmem', 'mincores', 'prefcores']
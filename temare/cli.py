@@ -22,12 +22,17 @@ class TemareCli:
         self.add_command(clicommands.HostStateCommand(self))
         self.add_command(clicommands.HostListCommand(self))
         self.add_command(clicommands.HostPrepCommand(self))
+        self.add_command(clicommands.HostPrepBenchCommand(self))
         self.add_command(clicommands.ImageAddCommand(self))
         self.add_command(clicommands.ImageDelCommand(self))
+        self.add_command(clicommands.ImageModCommand(self))
         self.add_command(clicommands.ImageStateCommand(self))
         self.add_command(clicommands.ImageListCommand(self))
         self.add_command(clicommands.TestAddCommand(self))
         self.add_command(clicommands.TestDelCommand(self))
+        self.add_command(clicommands.TestModCommand(self))
+        self.add_command(clicommands.TestImageModCommand(self))
+        self.add_command(clicommands.TestImageListCommand(self))
         self.add_command(clicommands.TestListCommand(self))
         self.add_command(clicommands.TestSubjectAddCommand(self))
         self.add_command(clicommands.TestSubjectDelCommand(self))
@@ -43,6 +48,12 @@ class TemareCli:
         self.add_command(clicommands.CompletionAddCommand(self))
         self.add_command(clicommands.CompletionDelCommand(self))
         self.add_command(clicommands.CompletionListCommand(self))
+        self.add_command(clicommands.OverheadSetCommand(self))
+        self.add_command(clicommands.OverheadDelCommand(self))
+        self.add_command(clicommands.OverheadListCommand(self))
+        self.add_command(clicommands.StarveListCommand(self))
+        self.add_command(clicommands.BuildListCommand(self))
+        self.add_command(clicommands.BuildRunsCommand(self))
         self.scriptname = basename(args[0])
         self.args = args[1:]
         self.run_command()
@@ -6,10 +6,15 @@
 """
 import sys
 import dbops
+import engine
+import executor
 import preparation
+import report
+import time
 import version
-from subprocess import Popen, PIPE
-from checks import chk_arg_count, chk_bitness, chk_hostname, chk_subject
+from checks import chk_arg_count, chk_bitness, chk_count, chk_hostname, \
+                   chk_limit, chk_subject
+from config import prepreportdir
 
 
 def do_list(listing, ordering):
@@ -26,6 +31,12 @@ def do_list(listing, ordering):
             'host_name'   : 'Host',
             'host_cores'  : 'CPU Cores',
             'host_memory' : 'Memory',
+            'host_nodes'  : 'NUMA Nodes',
+            'host_hugepages': 'Hugepages',
+            'host_overcommit': 'Overcommit',
+            'host_class'  : 'Class',
+            'hypervisor'  : 'Hypervisor',
+            'is_hugepages': 'Hugepages',
             'image_name'  : 'Guest Image',
             'image_format': 'Format',
             'os_type_name': 'OS Type',
@@ -41,18 +52,41 @@ def do_list(listing, ordering):
             'is_enabled'  : 'State',
             'key'         : 'Key',
             'value'       : 'Value',
-            'is_smp'      : 'SMP'}
+            'is_smp'      : 'SMP',
+            'fail_count'  : 'Failures',
+            'breaker'     : 'Breaker',
+            'is_virtio'   : 'Virtio',
+            'is_vhost'    : 'Vhost',
+            'disk_cache'  : 'Cache',
+            'disk_aio'    : 'AIO',
+            'min_memory'  : 'Min Memory',
+            'pref_memory' : 'Pref Memory',
+            'min_cores'   : 'Min VCPUs',
+            'pref_cores'  : 'Pref VCPUs',
+            'schedule_name': 'Schedule',
+            'age'         : 'Age',
+            'is_satisfiable': 'Satisfiable',
+            'build'       : 'Build',
+            'runs'        : 'Runs',
+            'guests'      : 'Guests',
+            'first_run'   : 'Started',
+            'coverage'    : 'Coverage',
+            'run_id'      : 'Run'}
     substitutions = {
             'is_64bit'  : {0: '32',       1: '64'},
             'is_bigmem' : {0: 'no',       1: 'yes'},
             'is_enabled': {0: 'disabled', 1: 'enabled'},
-            'is_smp'    : {0: 'no',       1: 'yes'}}
+            'is_smp'    : {0: 'no',       1: 'yes'},
+            'is_virtio' : {0: 'no',       1: 'yes'},
+            'is_vhost'  : {0: 'no',       1: 'yes'},
+            'is_hugepages': {0: 'no',     1: 'yes'},
+            'is_satisfiable': {0: 'no',   1: 'yes'}}
     width = {}
     for key, value in headings.iteritems():
         width[key] = len(str(value))
     for index in range(0, len(listing)):
         for key, value in listing[index].iteritems():
-            if key == 'host_memory':
+            if key in ('host_memory', 'host_hugepages'):
                 value = '%s MB' % (value, )
                 listing[index][key] = value
             elif key in substitutions.keys():
@@ -78,6 +112,33 @@ def do_list(listing, ordering):
     sys.stdout.write(separator)
 
 
+def get_options(args, valid):
+    """Separate command line options from the remaining arguments
+
+    Options are given as --NAME or --NAME=VALUE anywhere in the arguments.
+    Arguments:
+        args  -- A list of command line arguments
+        valid -- A list of valid option names without leading dashes
+    Returns:
+        A tuple of a dictionary of the given options and their values
+        (True for options without value) and a list of the remaining
+        arguments
+    """
+    options = {}
+    remaining = []
+    for arg in args:
+        if not arg.startswith('--'):
+            remaining.append(arg)
+            continue
+        name, separator, value = arg[2:].partition('=')
+        if name not in valid:
+            raise ValueError('Unknown option "--%s".' % (name, ))
+        if separator == '':
+            value = True
+        options[name] = value
+    return options, remaining
+
+
 class TemareCommand:
     """Base class for CLI commands
     """
@@ -190,59 +251,174 @@ class HostPrepCommand(TemareCommand):
 
     def __init__(self, base):
         TemareCommand.__init__(self, base)
-        self.failed = 0
         self.names = ['hostprep']
-        self.usage = 'HOSTNAME...'
+        self.usage = '[--overlay [--fanout]] [--parallel=COUNT] [--resume] ' \
+                     '[--report=FILE] HOSTNAME...'
         self.summary = 'Prepare and start testruns on the specified hosts'
         self.description = \
-            '    HOSTNAME  Name of the host'
+            '    --overlay   Stage base images once per host and start\n' \
+            '                guests from copy-on-write overlays\n' \
+            '    --fanout    Copy staged base images between the hosts\n' \
+            '                instead of copying them all from the image\n' \
+            '                server\n' \
+            '    --parallel  Number of hosts to prepare at the same time\n' \
+            '    --resume    Continue failed preparations with the same\n' \
+            '                tests, skipping the steps completed before\n' \
+            '    --report    File to write the timing of all stages and\n' \
+            '                commands to, as JSON lines\n' \
+            '    HOSTNAME    Name of the host'
 
     def do_command(self, args):
         """Validate the number of given arguments and
            generate guest configurations
         """
         hostlist = []
-        threads = []
-        environment = ''
-        getenv = '(grep -q "^kvm " /proc/modules && echo "kvm") || '         \
-                 '(/usr/sbin/xend status >/dev/null 2>&1 && echo "xen") || ' \
-                 'echo "bare"'
+        options, args = get_options(args,
+                ['overlay', 'fanout', 'parallel', 'resume', 'report'])
+        overlay = options.has_key('overlay')
+        resume = options.has_key('resume')
         if len(args) == 0:
             raise ValueError('No arguments given.')
-        sys.stdout.write(
-                'Starting to prepare hosts. '
-                'Please wait, this may take a while...\n')
+        if options.has_key('fanout') and not overlay:
+            raise ValueError('The --fanout option requires --overlay.')
+        limits = {}
+        if options.has_key('parallel'):
+            limits['hosts'] = chk_limit(options['parallel'])
         for host in args:
             host = chk_hostname(host)
             if host not in hostlist:
                 hostlist.append(host)
-                process = Popen(['/usr/bin/ssh',
-                        '-o PasswordAuthentication=no', 'root@%s' % (host, ),
-                        getenv], stderr=None, stdout=PIPE)
-                retval = process.wait()
-                if retval == 0:
-                    output = process.communicate()[0].strip().split('\n')
-                    if len(output) == 1 and output[0] in ('xen', 'kvm'):
-                        environment = output[0]
-                if environment == 'xen':
-                    threads.append(preparation.XenHostPreparation(self, host))
-                elif environment == 'kvm':
-                    threads.append(preparation.KvmHostPreparation(self, host))
-                else:
-                    self.failed = 1
-                    sys.stderr.write(
-                            'Preparation of host %s failed\n'
-                            'Reason:\n'
-                            'Could not determine the test environment.\n'
-                            % (host, ))
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
-        if self.failed == 1:
+        if options.get('report') == True:
+            raise ValueError('The --report option requires a filename.')
+        filename = options.get('report', '%s/hostprep-%s.jsonl' %
+                (prepreportdir, time.strftime('%Y%m%d-%H%M%S')))
+        prepengine = engine.PreparationEngine(limits, options.has_key('fanout'),
+                report.PreparationReport(filename))
+        sys.stdout.write(
+                'Starting to prepare hosts. '
+                'Please wait, this may take a while...\n')
+        skipped = engine.check_health(hostlist)
+        for host in hostlist:
+            if skipped.has_key(host):
+                prepengine.report_failure(host, None, skipped[host])
+        environments = engine.detect_hypervisors(
+                [host for host in hostlist if not skipped.has_key(host)])
+        for host in hostlist:
+            if skipped.has_key(host):
+                continue
+            elif environments[host] == 'xen':
+                prepengine.add(preparation.XenHostPreparation(
+                        prepengine, host, overlay, resume))
+            elif environments[host] == 'kvm':
+                prepengine.add(preparation.KvmHostPreparation(
+                        prepengine, host, overlay, resume))
+            else:
+                prepengine.report_failure(host, None,
+                        'Could not determine the test environment.')
+        results = prepengine.run()
+        engine.record_health(dict([(host, result)
+                for host, result in results.iteritems()
+                if not skipped.has_key(host)]))
+        hostops = dbops.Hosts()
+        for prep in prepengine.preparations:
+            result = results[prep.host]
+            if result['status'] == 'failed' and \
+                    result['stage'] == prep.checkstage:
+                hostops.set_type(prep.host, None, 0)
+        for line in prepengine.get_summary():
+            sys.stdout.write('%s\n' % (line, ))
+        if len(prepengine.get_failed()) != 0:
             raise ValueError('Preparation of some hosts failed.')
 
 
+class HostPrepBenchCommand(TemareCommand):
+    """Measure the preparation of many hosts on a simulated fleet
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['hostprepbench']
+        self.usage = '[--hosts=COUNT] [--guests=COUNT] [--parallel=COUNT] ' \
+                     '[--latency=MS] [--bandwidth=MBPS] [--imagesize=MB] ' \
+                     '[--failrate=PERCENT] [--bootdelay=MS] ' \
+                     '[--overlay [--fanout]] [--report=FILE]'
+        self.summary = 'Measure hostprep on simulated hosts'
+        self.description = \
+            '    --hosts      Number of simulated hosts (default 200)\n' \
+            '    --guests     Number of guests per host (default 4)\n' \
+            '    --parallel   Number of hosts to prepare at the same time\n' \
+            '    --latency    Duration of every command in milliseconds\n' \
+            '                 (default 50)\n' \
+            '    --bandwidth  Bandwidth of a single image copy in MB/s\n' \
+            '                 (default 100)\n' \
+            '    --imagesize  Size of every image in MB (default 100)\n' \
+            '    --failrate   Percentage of failing commands (default 0)\n' \
+            '    --bootdelay  Milliseconds between two guest starts on a\n' \
+            '                 host (default from the configuration)\n' \
+            '    --overlay    Stage base images once per host and start\n' \
+            '                 guests from copy-on-write overlays\n' \
+            '    --fanout     Copy staged base images between the hosts\n' \
+            '    --report     File to write the timing of all stages and\n' \
+            '                 commands to, as JSON lines'
+
+    def do_command(self, args):
+        """Prepare simulated hosts and print the throughput
+        """
+        options, args = get_options(args, ['hosts', 'guests', 'parallel',
+                'latency', 'bandwidth', 'imagesize', 'failrate', 'bootdelay',
+                'overlay', 'fanout', 'report'])
+        chk_arg_count(args, 0)
+        overlay = options.has_key('overlay')
+        if options.has_key('fanout') and not overlay:
+            raise ValueError('The --fanout option requires --overlay.')
+        if options.get('report') == True:
+            raise ValueError('The --report option requires a filename.')
+        hosts = chk_limit(options.get('hosts', 200))
+        guests = chk_limit(options.get('guests', 4))
+        failrate = chk_count(options.get('failrate', 0))
+        if failrate > 100:
+            raise ValueError('The failure rate is limited to 100 percent.')
+        limits = {}
+        if options.has_key('parallel'):
+            limits['hosts'] = chk_limit(options['parallel'])
+        boot = {}
+        if options.has_key('bootdelay'):
+            boot['delay'] = chk_count(options['bootdelay']) / 1000.0
+        remote = executor.SimulatedExecutor(
+                chk_count(options.get('latency', 50)) / 1000.0,
+                chk_limit(options.get('bandwidth', 100)), failrate / 100.0,
+                chk_limit(options.get('imagesize', 100)))
+        prepreport = report.PreparationReport(options.get('report'))
+        prepengine = engine.PreparationEngine(limits, options.has_key('fanout'),
+                prepreport, remote, False, boot)
+        for index in range(hosts):
+            prepengine.add(preparation.KvmHostPreparation(prepengine,
+                    'sim%04d' % (index, ), overlay,
+                    testrun=executor.SimulatedTestRun(guests)))
+        started = time.time()
+        try:
+            results = prepengine.run()
+        finally:
+            remote.cleanup()
+        duration = max(time.time() - started, 0.001)
+        failed = len(prepengine.get_failed())
+        started = sum([result['guests'] for result in results.itervalues()])
+        megabytes = prepengine.report.get_bytes() / 1048576.0
+        sys.stdout.write(
+                'Duration:          %9.1f s\n'
+                'Hosts prepared:    %9d\n'
+                'Hosts failed:      %9d\n'
+                'Guests started:    %9d\n'
+                'Hosts per minute:  %9.1f\n'
+                'Guests per minute: %9.1f\n'
+                'Data copied:       %9.1f MB (%.1f MB/s)\n' %
+                (duration, hosts - failed, failed, started,
+                 (hosts - failed) * 60 / duration, started * 60 / duration,
+                 megabytes, megabytes / duration))
+        for line in prepengine.get_summary():
+            sys.stdout.write('%s\n' % (line, ))
+
+
 class HostAddCommand(TemareCommand):
     """Add a new host to the pool of available boxes to test on
     """
@@ -291,11 +467,16 @@ class HostModCommand(TemareCommand):
     def __init__(self, base):
         TemareCommand.__init__(self, base)
         self.names = ['hostmod']
-        self.usage = 'HOSTNAME mem|cores|bits ARGUMENT'
+        self.usage = 'HOSTNAME mem|cores|nodes|hugepages|overcommit|class|' \
+                'bits ARGUMENT'
         self.summary = 'Modify a hosts configuration'
         self.description = \
             '    HOSTNAME  Name of the host\n' \
-            '    ARGUMENT  Value of the configuration'
+            '    ARGUMENT  Value of the configuration, for nodes either\n' \
+            '              the number of NUMA nodes or the CPU lists of\n' \
+            '              all nodes separated by slashes, for example\n' \
+            '              0-3,8-11/4-7,12-15, covering the cores of the\n' \
+            '              host'
 
     def do_command(self, args):
         """Validate the number of given arguments and
@@ -309,6 +490,14 @@ class HostModCommand(TemareCommand):
             hostops.memory(args)
         elif command == 'cores':
             hostops.cores(args)
+        elif command == 'nodes':
+            hostops.nodes(args)
+        elif command == 'hugepages':
+            hostops.hugepages(args)
+        elif command == 'overcommit':
+            hostops.overcommit(args)
+        elif command == 'class':
+            hostops.hostclass(args)
         elif command == 'bits':
             hostops.bitness(args)
         else:
@@ -348,8 +537,9 @@ class HostListCommand(TemareCommand):
         """
         hostops = dbops.Hosts()
         listing = hostops.list(args)
-        ordering = ['host_name', 'host_memory', 'host_cores',
-                'is_64bit', 'is_enabled']
+        ordering = ['host_name', 'host_memory', 'host_cores', 'host_nodes',
+                'host_hugepages', 'host_overcommit', 'host_class',
+                'is_64bit', 'is_enabled', 'fail_count', 'breaker']
         do_list(listing, ordering)
 
 
@@ -397,6 +587,45 @@ class ImageDelCommand(TemareCommand):
         imageops.delete(args)
 
 
+class ImageModCommand(TemareCommand):
+    """Modify the I/O capabilities and modes of an existing image file
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['imagemod']
+        self.usage = 'FILENAME virtio|vhost|cache|aio|hugepages ARGUMENT'
+        self.summary = 'Modify the I/O configuration of a guest image'
+        self.description = \
+            '    FILENAME  Filename of the guest image\n' \
+            '    ARGUMENT  yes|no for virtio, vhost, and hugepages,\n' \
+            '              default|none|writeback|writethrough for cache,\n' \
+            '              default|native|threads for aio\n' \
+            '    Xen guests only use cache mode writeback of raw images,\n' \
+            '    all other settings apply to KVM guests.'
+
+    def do_command(self, args):
+        """Validate the number of given arguments and
+            update the guest image configuration
+        """
+        chk_arg_count(args, 3)
+        imagename, command, value = args
+        args = (imagename, value)
+        imageops = dbops.Images()
+        if command == 'virtio':
+            imageops.virtio(args)
+        elif command == 'vhost':
+            imageops.vhost(args)
+        elif command == 'cache':
+            imageops.cache(args)
+        elif command == 'aio':
+            imageops.aio(args)
+        elif command == 'hugepages':
+            imageops.hugepages(args)
+        else:
+            raise ValueError('Unknown guest image configuration.')
+
+
 class ImageStateCommand(TemareCommand):
     """Enable or disable scheduling of the specified image file
     """
@@ -432,7 +661,8 @@ class ImageListCommand(TemareCommand):
         imageops = dbops.Images()
         listing = imageops.list(args)
         ordering = ['image_name', 'image_format', 'vendor_name', 'os_type_name',
-                'is_64bit', 'is_bigmem', 'is_smp', 'is_enabled']
+                'is_64bit', 'is_bigmem', 'is_smp', 'is_enabled', 'is_virtio',
+                'is_vhost', 'disk_cache', 'disk_aio', 'is_hugepages']
         do_list(listing, ordering)
 
 
@@ -499,14 +729,19 @@ class TestAddCommand(TemareCommand):
     def __init__(self, base):
         TemareCommand.__init__(self, base)
         self.names = ['testadd']
-        self.usage = 'TESTNAME OSTYPE TESTCOMMAND RUNTIME TIMEOUT'
+        self.usage = 'TESTNAME OSTYPE TESTCOMMAND RUNTIME TIMEOUT ' \
+                '[MINMEM [PREFMEM [MINCORES [PREFCORES]]]]'
         self.summary = 'Add a new test to the schedule'
         self.description = \
             '    TESTNAME     Name of the test program\n' \
             '    OSTYPE       Name of the operating system type\n' \
             '    TESTCOMMAND  Command to start the test program\n' \
             '    RUNTIME      Runtime for testsuite (seconds)\n' \
-            '    TIMEOUT      Timeout for testsuite (seconds)'
+            '    TIMEOUT      Timeout for testsuite (seconds)\n' \
+            '    MINMEM       Minimum memory of the guest, or none\n' \
+            '    PREFMEM      Preferred memory of the guest, or none\n' \
+            '    MINCORES     Minimum number of VCPUs, or none\n' \
+            '    PREFCORES    Preferred number of VCPUs, or none'
 
     def do_command(self, args):
         """Add a test program to the database
@@ -535,6 +770,75 @@ class TestDelCommand(TemareCommand):
         testops.delete(args)
 
 
+class TestModCommand(TemareCommand):
+    """Modify the resource requirements of an existing test program
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['testmod']
+        self.usage = 'TESTNAME OSTYPE minmem|prefmem|mincores|prefcores ' \
+                'ARGUMENT'
+        self.summary = 'Modify the resource requirements of a test'
+        self.description = \
+            '    TESTNAME  Name of the test program\n' \
+            '    OSTYPE    Name of the operating system type\n' \
+            '    ARGUMENT  Memory or number of VCPUs, or none'
+
+    def do_command(self, args):
+        """Update the resource requirements of a test program
+        """
+        testops = dbops.Tests()
+        testops.requirement(args)
+
+
+class TestImageModCommand(TemareCommand):
+    """Modify the resource requirements of a test program for a single
+    guest image
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['testimagemod']
+        self.usage = 'TESTNAME FILENAME minmem|prefmem|mincores|prefcores ' \
+                'ARGUMENT'
+        self.summary = 'Modify the resource requirements of a test ' \
+                'for an image'
+        self.description = \
+            '    TESTNAME  Name of the test program\n' \
+            '    FILENAME  Filename of the guest image\n' \
+            '    ARGUMENT  Memory or number of VCPUs, or none to use the\n' \
+            '              requirement of the test program'
+
+    def do_command(self, args):
+        """Update the resource requirements of a test program for a guest
+        image
+        """
+        testops = dbops.Tests()
+        testops.image_requirement(args)
+
+
+class TestImageListCommand(TemareCommand):
+    """Display a list of all resource requirements of test programs for
+    single guest images
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['testimagelist']
+        self.summary = 'Get a list of test requirements for single images'
+
+    def do_command(self, args):
+        """Print a list of all resource requirements of test programs for
+        single guest images
+        """
+        testops = dbops.Tests()
+        listing = testops.list_image_requirements(args)
+        ordering = ['test_name', 'image_name', 'min_memory', 'pref_memory',
+                'min_cores', 'pref_cores']
+        do_list(listing, ordering)
+
+
 class TestListCommand(TemareCommand):
     """Display a list of all test programs and their targeted OS
     """
@@ -550,7 +854,8 @@ class TestListCommand(TemareCommand):
         testops = dbops.Tests()
         listing = testops.list(args)
         ordering = ['test_name', 'os_type_name',
-                'test_command', 'runtime', 'timeout']
+                'test_command', 'runtime', 'timeout',
+                'min_memory', 'pref_memory', 'min_cores', 'pref_cores']
         do_list(listing, ordering)
 
 
@@ -562,9 +867,11 @@ class TestSubjectPrepCommand(TemareCommand):
     def __init__(self, base):
         TemareCommand.__init__(self, base)
         self.names = ['subjectprep']
-        self.usage = 'HOSTNAME [SUBJECT BITNESS]'
+        self.usage = '[--overlay] HOSTNAME [SUBJECT BITNESS]'
         self.summary = 'Create guest configs and output YAML precondition'
         self.description = \
+            '    --overlay Start guests from copy-on-write overlays\n' \
+            '              of the unpacked guest images\n' \
             '    HOSTNAME  Name of the host\n' \
             '    SUBJECT   Name of a specific test subject (optional)\n' \
             '    BITNESS   Bitness of the test subject\n' \
@@ -574,16 +881,19 @@ class TestSubjectPrepCommand(TemareCommand):
         """Validate the number of given arguments, write guest configurations,
         and ouput a YAML precondition string
         """
+        options, args = get_options(args, ['overlay'])
+        overlay = options.has_key('overlay')
         if len(args) == 1:
             hostname = chk_hostname(args[0])
-            subjectops = preparation.SubjectPreparation(hostname)
+            subjectops = preparation.SubjectPreparation(
+                    hostname, overlay=overlay)
             subjectops.gen_precondition()
         elif len(args) == 3:
             hostname = chk_hostname(args[0])
             subject = chk_subject(args[1])
             bitness = chk_bitness(args[2])
             subjectops = preparation.SubjectPreparation(
-                    hostname, subject, bitness)
+                    hostname, subject, bitness, overlay)
             subjectops.gen_precondition()
         else:
             raise ValueError('Wrong number of arguments.')
@@ -812,3 +1122,129 @@ class CompletionListCommand(TemareCommand):
         listing = compops.list(args)
         ordering = ['subject_name', 'is_64bit', 'key', 'value']
         do_list(listing, ordering)
+
+
+class OverheadSetCommand(TemareCommand):
+    """Set a measured parameter of the overhead model
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['overheadset']
+        self.usage = 'HYPERVISOR CLASS|all reserve|share|guest|shadow|vcpus ' \
+                'VALUE'
+        self.summary = 'Set a measured parameter of the overhead model'
+        self.description = \
+            '    HYPERVISOR  Hypervisor type (xen or kvm)\n' \
+            '    CLASS       Host class the value applies to, all for all ' \
+            'hosts\n' \
+            '    VALUE       Measured value, see config.overheads'
+
+    def do_command(self, args):
+        """Add or update an overhead parameter in the database
+        """
+        overheadops = dbops.Overheads()
+        overheadops.add(args)
+
+
+class OverheadDelCommand(TemareCommand):
+    """Remove a measured parameter of the overhead model
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['overheaddel']
+        self.usage = 'HYPERVISOR CLASS|all reserve|share|guest|shadow|vcpus'
+        self.summary = 'Use the configured value of an overhead parameter'
+        self.description = \
+            '    HYPERVISOR  Hypervisor type (xen or kvm)\n' \
+            '    CLASS       Host class the value applies to, all for all ' \
+            'hosts'
+
+    def do_command(self, args):
+        """Remove an overhead parameter from the database
+        """
+        overheadops = dbops.Overheads()
+        overheadops.delete(args)
+
+
+class OverheadListCommand(TemareCommand):
+    """Display a list of all measured parameters of the overhead model
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['overheadlist']
+        self.summary = 'Get a list of all measured overhead parameters'
+
+    def do_command(self, args):
+        """Print a list of all measured overhead parameters
+        """
+        overheadops = dbops.Overheads()
+        listing = overheadops.list(args)
+        ordering = ['hypervisor', 'host_class', 'key', 'value']
+        do_list(listing, ordering)
+
+
+class StarveListCommand(TemareCommand):
+    """Display a list of all starving schedule entries
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['starvelist']
+        self.summary = 'Get a list of starving or unsatisfiable tests'
+
+    def do_command(self, args):
+        """Print a list of all schedule entries passed over by too many
+        test runs or not fitting on any enabled host
+        """
+        scheduleops = dbops.Schedules()
+        listing = scheduleops.list(args)
+        ordering = ['schedule_name', 'test_name', 'image_name', 'age',
+                'is_satisfiable']
+        do_list(listing, ordering)
+
+
+class BuildListCommand(TemareCommand):
+    """Display a list of all builds of the test subjects and their coverage
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['buildlist']
+        self.summary = 'Get a list of all builds and their coverage'
+
+    def do_command(self, args):
+        """Print a list of all builds of the test subjects with their test
+        runs and coverage
+        """
+        buildops = dbops.Builds()
+        listing = buildops.list(args)
+        ordering = ['subject_name', 'is_64bit', 'build', 'runs', 'guests',
+                'first_run', 'coverage']
+        do_list(listing, ordering)
+
+
+class BuildRunsCommand(TemareCommand):
+    """Display a list of all test runs using a build of a test subject
+    """
+
+    def __init__(self, base):
+        TemareCommand.__init__(self, base)
+        self.names = ['buildruns']
+        self.usage = 'SUBJECT BITNESS BUILD'
+        self.summary = 'Get a list of all test runs of a build'
+        self.description = \
+            '    SUBJECT  Name of the test subject\n' \
+            '    BITNESS  Bitness of the test subject\n' \
+            '    BUILD    File name of the build, or none'
+
+    def do_command(self, args):
+        """Print a list of all guests of the test runs using a build
+        """
+        buildops = dbops.Builds()
+        listing = buildops.runs(args)
+        ordering = ['run_id', 'host_name', 'first_run', 'test_name',
+                'image_name']
+        do_list(listing, ordering)
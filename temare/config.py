@@ -27,8 +27,61 @@ tstimeout = 86400
 mincores = 1
 maxcores = 64
 
-# KVM guest start script template
-kvm =                                                                         \
+# Overhead model of the hypervisors, used to size the guests of a host
+#   reserve -- MB of memory reserved for the host or dom0 at least
+#   share   -- Share of the memory reserved for the host or dom0, if more
+#   guest   -- MB of memory every guest takes besides its own memory
+#              (device model, hypervisor data structures)
+#   shadow  -- MB of shadow or nested page table memory per GB of guest
+#              memory, also the shadow memory of Xen guests
+#   vcpus   -- VCPUs per CPU core of the host (CPU overcommit factor)
+# Entries for a hypervisor ('xen' or 'kvm') override the defaults. Values
+# measured on the hosts are stored with overheadset per hypervisor and
+# host class and override both.
+overheads = {
+        'default': {'reserve': minmem, 'share': 0.1, 'guest': 0,
+                    'shadow': 10, 'vcpus': 1.0}}
+hypervisors = ['xen', 'kvm']
+
+# Starvation of schedule entries: number of test runs of a host or test
+# subject passing over an entry before it is starving. An entry ages with
+# every test run finalized while it is not done, and its chance to be
+# picked grows with its age. Starving entries are listed by starvelist and,
+# with steerstarving, picked ahead of all other tests on the hosts they fit
+# on, deciding the vendor of the guest. Without it, they still compete with
+# the short and demanding tests otherwise preferred. Keep it well above the
+# test runs of a full cycle, which are about the schedule entries of a host
+# or test subject divided by its guests per run.
+starvationage = 100
+steerstarving = True
+
+# Vendor selection of the generator: 'roundrobin' rotates the vendors one
+# by one, 'runtime' picks the vendor with the most runtime of tests left in
+# the current cycle, so that vendors with many images get more guests and
+# all vendors finish their cycle at about the same time.
+vendorpolicy = 'runtime'
+
+# Smoke-first ordering: tests with a runtime of up to smokeruntime seconds
+# are picked ahead of the long tail of their vendor in every cycle, so that
+# a new build shows its first results early. With smokeperostype, a short
+# test of an OS type without short test in the current cycle goes first.
+# A smokeruntime of 0 disables the ordering.
+smokeruntime = 3600
+smokeperostype = True
+
+# Host setup scripts are run once per test run before the guests start.
+# They write their findings to an environment file (%(hostenv)s) which is
+# read as shell or Python code by the guest start scripts and configuration
+# files. hostprep runs the setup script (%(hostsetup)s) as a step of its
+# own. Tapper installs the preconditions of a host before it boots, so for
+# subjectprep, every guest first runs the setup step below: the first guest
+# runs the setup script, and guests starting at the same time wait for it
+# to finish.
+setupstep = '/usr/bin/flock %(hostsetup)s.lock -c '                          \
+            '"test -f %(hostenv)s || /bin/bash %(hostsetup)s"'
+
+# KVM host setup script template
+kvmsetup =                                                                    \
         '#!/bin/bash\n'                                                       \
         'export PATH=/usr/local/bin:/usr/bin:$PATH\n'                         \
         'kvmexec=$((which qemu-kvm||which qemu-system-x86_64) 2>/dev/null)\n' \
@@ -46,7 +99,18 @@ kvm =                                                                         \
         '   echo "CPUs have no HVM features. Exiting." >/dev/stderr\n'        \
         '   exit 2\n'                                                         \
         'fi\n'                                                                \
-        '$kvmexec '                                                           \
+        '%(kvmksm)s'                                                          \
+        'numactl=$((which numactl) 2>/dev/null)\n'                            \
+        'echo "kvmexec=\\"$kvmexec\\"" >%(hostenv)s\n'                        \
+        'echo "numactl=\\"$numactl\\"" >>%(hostenv)s\n'
+
+# KVM guest start script template
+kvm =                                                                         \
+        '#!/bin/bash\n'                                                       \
+        'export PATH=/usr/local/bin:/usr/bin:$PATH\n'                         \
+        + setupstep + ' || exit 2\n'                                          \
+        '. %(hostenv)s\n'                                                     \
+        '%(kvmpin)s$kvmexec '                                                 \
         '-name %(runid)03d-%(test)s '                                         \
         '-k de '                                                              \
         '-daemonize '                                                         \
@@ -54,32 +118,101 @@ kvm =                                                                         \
         '-vnc :%(vnc)d '                                                      \
         '-usbdevice tablet '                                                  \
         '-m %(memory)d '                                                      \
+        '%(kvmmem)s'                                                          \
+        '%(kvmballoon)s'                                                      \
         '-smp %(cores)d '                                                     \
-        '-hda %(datadir)s/%(imgbasename)s '                                   \
-        '-hdb %(datadir)s/%(mntfile)s '                                       \
+        '%(kvmdisk)s '                                                        \
         '-serial file:/tmp/guest%(runid)d.fifo '                              \
-        '-net nic,macaddr=%(macaddr)s '                                       \
-        '-net tap,ifname=tap%(vnc)d\n'
+        '%(kvmnic)s\n'
+
+# KVM disk and network options of a guest, depending on the I/O capabilities
+# of its image. The test suite image always stays on the IDE bus, so that it
+# keeps its device name inside the guest.
+kvmdisk = {
+        'legacy': '-hda %(datadir)s/%(imgbasename)s '
+                  '-hdb %(datadir)s/%(mntfile)s',
+        'drive':  '-drive file=%(datadir)s/%(imgbasename)s,if=%(diskbus)s,'
+                  'index=0,media=disk%(driveopts)s '
+                  '-drive file=%(datadir)s/%(mntfile)s,if=ide,'
+                  'index=1,media=disk%(driveopts)s'}
+kvmnic = '-net nic,macaddr=%(macaddr)s%(nicopts)s ' \
+         '-net tap,ifname=tap%(vnc)d%(tapopts)s'
+
+# Mount point of hugetlbfs on KVM hosts, backing the memory of guests whose
+# images use hugepages. Xen HVM guests with nested paging get their memory
+# from superpages without any configuration.
+hugepagemount = '/dev/hugepages'
+kvmhugepages = '-mem-path %s -mem-prealloc ' % (hugepagemount, )
+
+# Memory overcommit: highest overcommit ratio of a host, and the share of
+# the memory of a guest expected to be merged by KSM with another guest of
+# the same vendor and OS type. Overcommitted KVM guests get a memory
+# balloon and KSM is started on the host. Xen has no page sharing, so
+# overcommit is meant for KVM hosts.
+maxovercommit = 4.0
+pagesharing = 0.3
+kvmballoon = '-balloon virtio '
+kvmksm = 'echo 1 >/sys/kernel/mm/ksm/run 2>/dev/null\n'
+
+# Command printing the number of pages swapped in and out on a host
+swapscript =                                                                  \
+        "awk '/^pswp(in|out) / { pages += $2 } END { print pages + 0 }' "     \
+        "/proc/vmstat"
+
+# Command printing the MB of free hugepages on a KVM host
+hugepagescript =                                                              \
+        "grep -q ' %s hugetlbfs ' /proc/mounts && "                           \
+        "awk '/^HugePages_Free:/ { free = $2 } "                              \
+        "/^Hugepagesize:/ { size = $2 } "                                     \
+        "END { print int(free * size / 1024) }' /proc/meminfo || echo 0"      \
+        % (hugepagemount, )
+
+# Binding of a guest to the CPUs and the memory of its NUMA node. KVM guests
+# are bound with numactl if the host has it, Xen guests are pinned to the
+# CPUs of the node and Xen allocates their memory from that node.
+numapin = {
+        'kvm': '${numactl:+$numactl --cpunodebind=%(node)d '
+               '--membind=%(node)d }',
+        'svm': 'cpus = "%(cpus)s"\n',
+        'xl':  'cpus=\"%(cpus)s\"\n'}
+
+# Host page cache and asynchronous I/O modes of guest images. Images
+# without a mode use the defaults of the hypervisor. Native AIO requires
+# the host page cache to be bypassed and is only used with cache mode none.
+# Xen guests started from SVM files only honor cache mode writeback of raw
+# images, by using the file backend instead of tap:aio. xl guests keep the
+# defaults of xl.
+diskcaches = ['none', 'writeback', 'writethrough']
+diskaios = ['native', 'threads']
+
+# Xen host setup script template for SVM files
+svmsetup =                                                                    \
+        '#!/bin/bash\n'                                                       \
+        'qemu32=/usr/lib/xen/bin/qemu-dm\n'                                   \
+        'qemu64=/usr/lib64/xen/bin/qemu-dm\n'                                 \
+        'test -f $qemu32 -a ! -L $qemu32 && found32=1\n'                      \
+        'test -f $qemu64 -a ! -L $qemu64 && found64=1\n'                      \
+        'if [ -n "$found32" -a -n "$found64" ]; then\n'                       \
+        '   echo "qemu-dm exists in both, lib and lib64" >/dev/stderr\n'      \
+        '   exit 2\n'                                                         \
+        'elif [ -z "$found32" -a -z "$found64" ]; then\n'                     \
+        '   echo "qemu-dm not found in lib or lib64" >/dev/stderr\n'          \
+        '   exit 2\n'                                                         \
+        'elif [ -n "$found64" ] && ! uname -m | grep -q 64; then\n'           \
+        '   echo "qemu-dm found in lib64, but we are on 32b" >/dev/stderr\n'  \
+        '   exit 2\n'                                                         \
+        'elif [ -n "$found64" ]; then\n'                                      \
+        '   device_model=$qemu64\n'                                           \
+        'else\n'                                                              \
+        '   device_model=$qemu32\n'                                           \
+        'fi\n'                                                                \
+        'echo "device_model=\\"$device_model\\"" >%(hostenv)s\n'
 
 # Xen SVM file template
 svm =                                                                        \
-        'import os, os.path, re\n'                                           \
-        'from subprocess import Popen, PIPE\n'                               \
-        'arch = os.uname()[4]\n'                                             \
-        'qemu32 = (os.path.isfile("/usr/lib/xen/bin/qemu-dm")\n'             \
-        '          and not os.path.islink("/usr/lib/xen/bin/qemu-dm"))\n'    \
-        'qemu64 = (os.path.isfile("/usr/lib64/xen/bin/qemu-dm")\n'           \
-        '          and not os.path.islink("/usr/lib64/xen/bin/qemu-dm"))\n'  \
-        'if qemu32 and qemu64:\n'                                            \
-        '    raise Exception, "qemu-dm exists in both, lib and lib64"\n'     \
-        'elif not qemu32 and not qemu64:\n'                                  \
-        '    raise Exception, "qemu-dm not found in lib or lib64"\n'         \
-        'elif qemu64 and not re.search("64", arch):\n'                       \
-        '    raise Exception, "qemu-dm found in lib64, but we are on 32b"\n' \
-        'elif qemu64:\n'                                                     \
-        '    device_model = "/usr/lib64/xen/bin/qemu-dm"\n'                  \
-        'else:\n'                                                            \
-        '    device_model = "/usr/lib/xen/bin/qemu-dm"\n'                    \
+        'import os\n'                                                        \
+        'os.system("' + setupstep.replace('"', '\\"') + '")\n'             \
+        'execfile("%(hostenv)s")\n'                                          \
         'kernel = "/usr/lib/xen/boot/hvmloader"\n'                           \
         'builder = "hvm"\n'                                                  \
         'vif = [ "mac=%(macaddr)s,bridge=xenbr0" ]\n'                        \
@@ -102,10 +235,11 @@ svm =                                                                        \
         'shadow_memory = %(shadowmem)d\n'                                    \
         'memory = %(memory)d\n'                                              \
         'vcpus = %(cores)d\n'                                                \
+        '%(svmcpus)s'                                                        \
         'hap = %(hap)d\n'
 
-# Xen xl guest start script template
-xlsh =                                                                        \
+# Xen host setup script template for xl guest start scripts
+xlsetup =                                                                     \
         '#!/bin/bash\n'                                                       \
         'export PATH=/usr/local/bin:/usr/bin:$PATH\n'                         \
         'xenexec=$((which xl) 2>/dev/null)\n'                                 \
@@ -114,6 +248,14 @@ xlsh =                                                                        \
         '   exit 2\n'                                                         \
         'fi\n'                                                                \
         '/etc/init.d/xend stop && sleep 4\n'                                  \
+        'echo "xenexec=\\"$xenexec\\"" >%(hostenv)s\n'
+
+# Xen xl guest start script template
+xlsh =                                                                        \
+        '#!/bin/bash\n'                                                       \
+        'export PATH=/usr/local/bin:/usr/bin:$PATH\n'                         \
+        + setupstep + ' || exit 2\n'                                          \
+        '. %(hostenv)s\n'                                                     \
         'tmp_conf=`mktemp`\n'                                                 \
         'cat > $tmp_conf << EOF\n'                                            \
         'builder=\"hvm\"\n'                                                   \
@@ -135,15 +277,25 @@ xlsh =                                                                        \
         'hpet=0\n'                                                            \
         'memory=%(memory)d\n'                                                 \
         'vcpus=%(cores)d\n'                                                   \
+        '%(xlcpus)s'                                                          \
         'hap=%(hap)d\n'                                                       \
         'EOF\n'                                                               \
         '$xenexec create $tmp_conf\n'                                         \
         'rm -f $tmp_conf\n'
 
+# Filename of the host setup script in the data directory of a host
+# prepared by hostprep. The environment file gets the suffix .env
+hostsetupfile = 'host-setup.sh'
+
 # Designation of the guest image formats as used in the guest configuration
 formats = {'raw': 'tap:aio', 'qcow': 'tap:qcow',
         'qcow2': 'tap:qcow2', 'file': 'file'}
 
+# Format of the guest image formats as given to qemu-img for the base
+# images of copy-on-write overlays
+backingformats = {'raw': 'raw', 'qcow': 'qcow', 'qcow2': 'qcow2',
+        'file': 'raw'}
+
 # Command to generate svm files on hosts for manual testing
 cfgscript = 'echo \'%%s\' >%(cfgfile)s'
 
@@ -155,9 +307,132 @@ copyscript =                                                                  \
         'else /usr/bin/scp -q -o PasswordAuthentication=no '                  \
         'osko:/export/image_files/official_testing/%%s %(datadir)s/%%s; fi'
 
+# Command to determine the image source used by copyscript (nfs or scp)
+# and the size in bytes and the modification time of the given image files
+# on it, separated by a colon
+sizescript =                                                                  \
+        'if [ -d /mnt/official_testing ]; then echo nfs; '                    \
+        'cd /mnt/official_testing && /usr/bin/stat -L -c %%s:%%Y %s; '        \
+        'else echo scp; /usr/bin/ssh -o PasswordAuthentication=no osko '      \
+        '"cd /export/image_files/official_testing && '                        \
+        'stat -L -c %%s:%%Y %s"; fi'
+
+# Limits for image transfers shared by all hosts prepared at the same time.
+# Number of concurrent transfers and bandwidth in MB/s per image source
+transferlimits = {'nfs': (4, 200), 'scp': (2, 100), 'default': (2, 100)}
+
+# Number of hosts a single host serves staged base images to at the same
+# time when images are distributed between hosts
+fanout = 2
+
+# Command to copy a staged base image from another host
+peercopyscript = '/usr/bin/scp -q -o PasswordAuthentication=no root@%s:%s %s'
+
+# Limits for preparing many hosts at the same time. Number of hosts prepared
+# at the same time, number of remote commands running at the same time on all
+# hosts, and number of remote commands running at the same time on one host
+preplimits = {'hosts': 32, 'commands': 64, 'hostcommands': 4}
+
+# Timeouts in seconds for remote preparation commands. Status checks get
+# the check timeout, image copies and conversions the copy timeout plus the
+# time needed at the given minimum bandwidth in MB/s, and all other
+# commands the default timeout
+preptimeouts = {'check': 60, 'default': 600, 'copy': 300, 'bandwidth': 5}
+
+# Staggered start of the guests of a host. Number of guests booting at the
+# same time, seconds between two guest starts, seconds a guest may take to
+# become ready before the next guest is started anyway, and seconds between
+# two readiness checks
+guestboot = {'parallel': 2, 'delay': 5, 'timeout': 120, 'interval': 5}
+
+# Commands printing "ready" as soon as a guest shows activity on its serial
+# console or on the network, and for Xen, as soon as its domain is running
+# or idle. Guests writing nothing to the serial console, such as Windows
+# guests, are ready once the bridge of the host learned their MAC address.
+guestactivity = '(test -s /tmp/guest%(runid)d.fifo || '                      \
+                '/sbin/bridge fdb show 2>/dev/null | '                      \
+                '/bin/grep -qi "^%(macaddr)s ")'
+kvmreadyscript = guestactivity + ' && echo ready; true'
+xenreadyscript = '/usr/sbin/xm domstate %(runid)03d-%(test)s 2>/dev/null | ' \
+                 '/bin/egrep -q "running|blocked" && '                      \
+                 + guestactivity + ' && echo ready; true'
+
+# Command printing the hypervisor running on a host (kvm, xen, or bare)
+hypervisorscript = '(grep -q "^kvm " /proc/modules && echo "kvm") || '       \
+                   '(/usr/sbin/xend status >/dev/null 2>&1 && echo "xen") || ' \
+                   'echo "bare"'
+
+# Number of seconds a hypervisor type determined for a host is reused
+hypervisorttl = 86400
+
+# Circuit breaker for hosts failing again and again. After the given number
+# of failed preparations in a row, a host is skipped for cooldown seconds.
+# Afterwards the health probe has to succeed within the probe timeout before
+# the host is prepared again
+hostbreaker = {'failures': 3, 'cooldown': 1800, 'probe': 15}
+
+# Cheap command to check if a host is reachable
+healthscript = '/bin/true'
+
+# Number of seconds ssh waits for the connection to a host
+sshtimeout = 10
+
+# Wrapper of commands run on a host through ssh, given the timeout of the
+# command in seconds and the quoted command. Killing ssh after a timeout
+# leaves the command running on the host, so the host kills it itself.
+# Commands still running 10 seconds after the timeout are killed hard.
+remotetimeout = '/usr/bin/timeout -k 10 %d /bin/bash -c %s'
+
+# Estimates for ordering hosts by the expected duration of their
+# preparation, for hosts without recorded stage durations. Seconds per host
+# and per guest, size in MB of images whose size is unknown, and bandwidth
+# in MB/s of image copies
+prepestimates = {'host': 60, 'guest': 30, 'imagesize': 2048, 'bandwidth': 20}
+
+# Directory for the timing reports of hostprep, one JSON lines file per run
+prepreportdir = '%s/logs/hostprep' % (tapperdir, )
+
 # Harddisk image containing testsuites for manual testing
 suiteimage = 'testsuites_raw.img'
 
+# Subdirectory of the data directory holding staged base images when guests
+# are started from copy-on-write overlays
+overlaydir = 'base'
+
+# Command to list the base images staged in a directory together with the
+# stamp of the image they were staged from (size and modification time on
+# the image source, see sizescript). The stamp of an image is kept in a
+# file next to it with the suffix .stamp, images without stamp are not
+# listed and get staged again.
+stagedscript =                                                                \
+        '/bin/mkdir -p %s && cd %s && for name in *; do '                     \
+        'test -f "$name.stamp" && echo "$name `cat "$name.stamp"`"; '         \
+        'done; true'
+
+# Command to create a thin qcow2 overlay on top of a staged base image,
+# given the base image, its format, and the overlay
+overlayscript = 'qemu-img create -f qcow2 -o backing_file=%s,backing_fmt=%s ' \
+                '%s >/dev/null'
+
+# Command to clone a staged raw image, sharing blocks where supported
+reflinkscript = '/bin/cp --reflink=auto %s %s'
+
+# Guest start script snippet creating the overlay of a guest image (Tapper)
+overlaysh =                                                                   \
+        'test -f %(datadir)s/%(imgbasename)s || '                             \
+        'qemu-img create -f qcow2 -o '                                        \
+        'backing_file=%(basefile)s,backing_fmt=%(basefmt)s '                  \
+        '%(datadir)s/%(imgbasename)s >/dev/null || exit 2\n'
+
+# Xen SVM file snippet creating the overlay of a guest image (Tapper)
+overlaysvm =                                                                  \
+        'import os.path\n'                                                    \
+        'from subprocess import call\n'                                       \
+        'if not os.path.isfile("%(datadir)s/%(imgbasename)s"):\n'             \
+        '    call(["qemu-img", "create", "-f", "qcow2", "-o",\n'              \
+        '          "backing_file=%(basefile)s,backing_fmt=%(basefmt)s",\n'    \
+        '          "%(datadir)s/%(imgbasename)s"])\n'
+
 # Full filename of the image to use for Dom0
 osimage = {0: 'suse/sles11_sp1_i686_baseimage.tgz',
            1: 'suse/sles11_sp1_x86-64_baseimage.tar.gz'}
@@ -186,6 +461,12 @@ buildarchs = {0: 'i686', 1: 'x86_64'}
 # Filename pattern for unpatched builds
 buildpattern = '^%s\.[0-9]{4}-[0-9]{2}-[0-9]{2}\.[0-9a-f_]+\.%s\.tgz$'
 
+# Policy when subjectprep finds a new build of a Xen test subject in
+# builddir: 'none' only records the build, 'restart' starts a fresh cycle
+# of the test subject, 'fasttrack' runs its short tests (see smokeruntime)
+# again ahead of the rest of the cycle.
+newbuildpolicy = 'fasttrack'
+
 # Data directory on the host containing image files and guest configurations
 virtdirman = '/xen/images'
 virtdirauto = '/virt'
@@ -214,6 +495,7 @@ if debug == True:
     xencfgstore = 'debug/configs/xen'
     kvmcfgstore = 'debug/configs/kvm'
     builddir = 'debug/builds/%s/%s'
+    prepreportdir = 'debug/logs/hostprep'
 
 if os.environ.has_key('HARNESS_ACTIVE'):
     dbpath = 't/test-schedule.db'
@@ -221,3 +503,4 @@ if os.environ.has_key('HARNESS_ACTIVE'):
     xencfgstore = '/tmp/'
     kvmcfgstore = '/tmp/'
     builddir = 't/misc_files/builds/%s/%s'
+    prepreportdir = '/tmp/'
@@ -4,8 +4,10 @@
 """
 import sqlite3
 import sys
+import threading
+import time
 import checks
-from config import dbpath
+from config import dbpath, hostbreaker, overheads, starvationage
 from queue import TapperQueue
 
 
@@ -46,7 +48,12 @@ def init_database():
                     last_vendor_id  INTEGER DEFAULT 0,
                     last_subject_id INTEGER DEFAULT 0,
                     is_64bit        INTEGER DEFAULT 1,
-                    is_enabled      INTEGER DEFAULT 1)''',
+                    is_enabled      INTEGER DEFAULT 1,
+                    host_type       TEXT DEFAULT NULL,
+                    host_type_time  INTEGER DEFAULT 0,
+                    fail_count      INTEGER DEFAULT 0,
+                    last_error      TEXT DEFAULT NULL,
+                    cooldown_until  INTEGER DEFAULT 0)''',
             '''CREATE TABLE IF NOT EXISTS image (
                     image_id        INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
                     image_name      TEXT UNIQUE,
@@ -56,7 +63,8 @@ def init_database():
                     is_64bit        INTEGER DEFAULT 1,
                     is_bigmem       INTEGER DEFAULT 1,
                     is_smp          INTEGER DEFAULT 1,
-                    is_enabled      INTEGER DEFAULT 1)''',
+                    is_enabled      INTEGER DEFAULT 1,
+                    image_size      INTEGER DEFAULT NULL)''',
             '''CREATE TABLE IF NOT EXISTS host_schedule (
                     schedule_id     INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
                     host_id         INTEGER NOT NULL,
@@ -75,10 +83,97 @@ def init_database():
                     completion_id   INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
                     subject_id      INTEGER NOT NULL,
                     key             TEXT,
-                    value           TEXT)''']
+                    value           TEXT)''',
+            # Progress of the last preparation of a host, to resume it
+            # after a failure. Tests are stored as YAML, steps as lines.
+            '''CREATE TABLE IF NOT EXISTS checkpoint (
+                    host_id         INTEGER PRIMARY KEY NOT NULL,
+                    is_overlay      INTEGER DEFAULT 0,
+                    tests           TEXT,
+                    steps           TEXT DEFAULT '')''',
+            # Stage durations of the last successful preparation of a host,
+            # to estimate the duration of its next preparation
+            '''CREATE TABLE IF NOT EXISTS stage_history (
+                    host_id         INTEGER NOT NULL,
+                    stage_name      TEXT NOT NULL,
+                    duration        REAL,
+                    bytes           INTEGER DEFAULT 0,
+                    guests          INTEGER DEFAULT 0,
+                    PRIMARY KEY (host_id, stage_name))''',
+            # Overhead model parameters measured on the hosts, overriding
+            # config.overheads. An empty host class applies to all hosts.
+            '''CREATE TABLE IF NOT EXISTS overhead (
+                    hypervisor      TEXT NOT NULL,
+                    host_class      TEXT NOT NULL DEFAULT '',
+                    name            TEXT NOT NULL,
+                    value           REAL NOT NULL,
+                    PRIMARY KEY (hypervisor, host_class, name))''',
+            # Resource requirements of a test for a single guest image,
+            # overriding the requirements of the test where not NULL
+            '''CREATE TABLE IF NOT EXISTS test_requirement (
+                    test_id         INTEGER NOT NULL,
+                    image_id        INTEGER NOT NULL,
+                    min_memory      INTEGER DEFAULT NULL,
+                    pref_memory     INTEGER DEFAULT NULL,
+                    min_cores       INTEGER DEFAULT NULL,
+                    pref_cores      INTEGER DEFAULT NULL,
+                    PRIMARY KEY (test_id, image_id))''',
+            # Candidate tests of a test subject and vendor for hosts of the
+            # same memory, cores, and bitness, stored as YAML. Entries of an
+            # older done_epoch of the test subject are stale.
+            '''CREATE TABLE IF NOT EXISTS candidate_cache (
+                    subject_id      INTEGER NOT NULL,
+                    vendor_id       INTEGER NOT NULL,
+                    host_shape      TEXT NOT NULL,
+                    done_epoch      INTEGER NOT NULL,
+                    candidates      TEXT,
+                    PRIMARY KEY (subject_id, vendor_id, host_shape))''',
+            # Test runs of the test subjects with the build they used, and
+            # the guest image and test of every guest of a test run
+            '''CREATE TABLE IF NOT EXISTS subject_run (
+                    run_id          INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                    subject_id      INTEGER NOT NULL,
+                    host_id         INTEGER NOT NULL,
+                    build           TEXT DEFAULT NULL,
+                    started         INTEGER)''',
+            '''CREATE TABLE IF NOT EXISTS subject_run_test (
+                    run_id          INTEGER NOT NULL,
+                    test_id         INTEGER NOT NULL,
+                    image_id        INTEGER NOT NULL)''']
+    # Columns added after the first release, created in existing databases
+    columns = [
+            ('host', 'host_type', 'TEXT DEFAULT NULL'),
+            ('host', 'host_type_time', 'INTEGER DEFAULT 0'),
+            ('image', 'image_size', 'INTEGER DEFAULT NULL'),
+            ('host', 'fail_count', 'INTEGER DEFAULT 0'),
+            ('host', 'last_error', 'TEXT DEFAULT NULL'),
+            ('host', 'cooldown_until', 'INTEGER DEFAULT 0'),
+            ('image', 'is_virtio', 'INTEGER DEFAULT 0'),
+            ('image', 'is_vhost', 'INTEGER DEFAULT 0'),
+            ('image', 'disk_cache', 'TEXT DEFAULT NULL'),
+            ('image', 'disk_aio', 'TEXT DEFAULT NULL'),
+            ('host', 'host_nodes', 'INTEGER DEFAULT 1'),
+            ('host', 'host_hugepages', 'INTEGER DEFAULT 0'),
+            ('image', 'is_hugepages', 'INTEGER DEFAULT 0'),
+            ('host', 'host_overcommit', 'REAL DEFAULT 1.0'),
+            ('host', 'host_class', 'TEXT DEFAULT NULL'),
+            ('test', 'min_memory', 'INTEGER DEFAULT NULL'),
+            ('test', 'pref_memory', 'INTEGER DEFAULT NULL'),
+            ('test', 'min_cores', 'INTEGER DEFAULT NULL'),
+            ('test', 'pref_cores', 'INTEGER DEFAULT NULL'),
+            ('subject', 'done_epoch', 'INTEGER DEFAULT 0'),
+            ('host_schedule', 'age', 'INTEGER DEFAULT 0'),
+            ('subject_schedule', 'age', 'INTEGER DEFAULT 0'),
+            ('subject', 'last_build', 'TEXT DEFAULT NULL'),
+            ('host', 'host_nodecpus', 'TEXT DEFAULT NULL')]
     try:
         for stmt in statements:
             cursor.execute(stmt)
+        for table, column, definition in columns:
+            cursor.execute('PRAGMA table_info(%s)' % (table, ))
+            if column not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                        (table, column, definition))
         connection.commit()
     except sqlite3.Error, err:
         raise ValueError(err.args[0])
@@ -118,6 +213,12 @@ class DatabaseEntity:
         self.connection = sqlite3.connect(dbpath)
         self.cursor = self.connection.cursor()
 
+    def clear_candidates(self):
+        """Remove all cached candidate tests of the test subjects, as the
+        schedule, the guest images, or the tests changed
+        """
+        self.cursor.execute('DELETE FROM candidate_cache')
+
     def add(self, args):
         """Add an item to the database
         """
@@ -203,6 +304,10 @@ class Hosts(DatabaseEntity):
         hostid = self.__get_host_id(hostname)
         self.cursor.execute('''
                 DELETE FROM host_schedule WHERE host_id=?''', (hostid, ))
+        self.cursor.execute('''
+                DELETE FROM checkpoint WHERE host_id=?''', (hostid, ))
+        self.cursor.execute('''
+                DELETE FROM stage_history WHERE host_id=?''', (hostid, ))
         self.cursor.execute('DELETE FROM host WHERE host_id=?', (hostid, ))
         self.connection.commit()
 
@@ -251,6 +356,86 @@ class Hosts(DatabaseEntity):
                 WHERE host_id=?''', (cores, hostid))
         self.connection.commit()
 
+    def nodes(self, args):
+        """Set the NUMA nodes of a system
+
+        The memory of the system is assumed to be split evenly between its
+        nodes. Given only the number of nodes, the CPU cores are split
+        evenly as well, with the CPUs numbered node by node. Otherwise the
+        CPU lists of all nodes are stored and the cores of a node are the
+        CPUs in its list, as printed by numactl -H or xl info -n. Neither
+        the number of nodes nor the CPUs of all nodes may exceed the CPU
+        cores of the system, and the CPUs of all nodes must add up to them.
+        Arguments:
+            hostname -- Name of the host system
+            nodes    -- NUMA nodes as specified in checks.chk_numa()
+        """
+        checks.chk_arg_count(args, 2)
+        hostname, nodes = args
+        hostid = self.__get_host_id(hostname)
+        nodes, cpulists = checks.chk_numa(nodes)
+        self.cursor.execute('''SELECT host_cores FROM host
+                WHERE host_id=?''', (hostid, ))
+        cores = self.cursor.fetchone()[0]
+        if nodes > cores:
+            raise ValueError('More NUMA nodes than CPU cores.')
+        if cpulists != None and cores != sum([checks.chk_cpulist(cpulist)
+                for cpulist in cpulists.split('/')]):
+            raise ValueError('CPU lists do not match the CPU cores.')
+        self.cursor.execute('''UPDATE host SET host_nodes=?, host_nodecpus=?
+                WHERE host_id=?''', (nodes, cpulists, hostid))
+        self.connection.commit()
+
+    def hugepages(self, args):
+        """Set the size of the hugepage pool reserved on a system
+
+        Arguments:
+            hostname  -- Name of the host system
+            hugepages -- Memory reserved as hugepages in MB, which is only
+                         used by guests whose images use hugepages
+        """
+        checks.chk_arg_count(args, 2)
+        hostname, hugepages = args
+        hostid = self.__get_host_id(hostname)
+        hugepages = checks.chk_hugepages(hugepages)
+        self.cursor.execute('''UPDATE host SET host_hugepages=?
+                WHERE host_id=?''', (hugepages, hostid))
+        self.connection.commit()
+
+    def overcommit(self, args):
+        """Set the memory overcommit ratio of a system
+
+        Arguments:
+            hostname   -- Name of the host system
+            overcommit -- Ratio of the memory committed to guests to the
+                          memory available for them, 1.0 disables overcommit
+        """
+        checks.chk_arg_count(args, 2)
+        hostname, overcommit = args
+        hostid = self.__get_host_id(hostname)
+        overcommit = checks.chk_overcommit(overcommit)
+        self.cursor.execute('''UPDATE host SET host_overcommit=?
+                WHERE host_id=?''', (overcommit, hostid))
+        self.connection.commit()
+
+    def hostclass(self, args):
+        """Set the class of a system, selecting its overhead model
+
+        Arguments:
+            hostname  -- Name of the host system
+            hostclass -- Name of the host class, or 'none'
+        """
+        checks.chk_arg_count(args, 2)
+        hostname, hostclass = args
+        hostid = self.__get_host_id(hostname)
+        if hostclass == 'none':
+            hostclass = None
+        else:
+            hostclass = checks.chk_hostclass(hostclass)
+        self.cursor.execute('''UPDATE host SET host_class=?
+                WHERE host_id=?''', (hostclass, hostid))
+        self.connection.commit()
+
     def bitness(self, args):
         """Set the bitness of the operating system installed on a system
 
@@ -266,6 +451,147 @@ class Hosts(DatabaseEntity):
                 WHERE host_id=?''', (bitness, hostid))
         self.connection.commit()
 
+    def get_types(self, hostnames):
+        """Get the cached hypervisor types of some hosts
+
+        Arguments:
+            hostnames -- A list of names of host systems
+        Returns:
+            A dictionary of the names of the hosts found in the database and
+            tuples of the hypervisor type (None if unknown) and the time it
+            was determined
+        """
+        types = {}
+        for hostname in hostnames:
+            self.cursor.execute('''
+                    SELECT host_type, host_type_time FROM host
+                    WHERE host_name=?''', (hostname, ))
+            row = self.cursor.fetchone()
+            if row != None:
+                types[hostname] = (row[0], row[1])
+        return types
+
+    def set_type(self, hostname, hosttype, timestamp):
+        """Cache the hypervisor type of a host
+
+        Hosts not found in the database are ignored.
+        Arguments:
+            hostname  -- Name of the host system
+            hosttype  -- Hypervisor type, or None to drop the cached type
+            timestamp -- Time the type was determined
+        """
+        self.cursor.execute('''UPDATE host SET host_type=?, host_type_time=?
+                WHERE host_name=?''', (hosttype, timestamp, hostname))
+        self.connection.commit()
+
+    def get_health(self, hostnames):
+        """Get the state of the circuit breakers of some hosts
+
+        The breaker of a host is open while the host is skipped after
+        failing again and again, half-open after the cooldown expired, and
+        closed otherwise.
+        Arguments:
+            hostnames -- A list of names of host systems
+        Returns:
+            A dictionary of the names of the hosts found in the database and
+            dictionaries with the items 'state' (open, half-open or closed),
+            'failures' (number of failures in a row), 'error' (last error)
+            and 'cooldown' (time the cooldown expires)
+        """
+        now = int(time.time())
+        health = {}
+        for hostname in hostnames:
+            self.cursor.execute('''
+                    SELECT fail_count, last_error, cooldown_until FROM host
+                    WHERE host_name=?''', (hostname, ))
+            row = self.cursor.fetchone()
+            if row == None:
+                continue
+            failures, error, cooldown = row
+            state = 'closed'
+            if failures >= hostbreaker['failures']:
+                state = 'half-open'
+                if cooldown > now:
+                    state = 'open'
+            health[hostname] = {'state': state, 'failures': failures,
+                                'error': error, 'cooldown': cooldown}
+        return health
+
+    def add_failure(self, hostname, error):
+        """Record a failed preparation of a host, and open its circuit
+        breaker for the cooldown of config.hostbreaker once the host failed
+        often enough in a row
+
+        Hosts not found in the database are ignored.
+        Arguments:
+            hostname -- Name of the host system
+            error    -- Description of the failure
+        """
+        self.cursor.execute('''
+                UPDATE host SET fail_count=fail_count+1, last_error=?,
+                cooldown_until=CASE WHEN fail_count+1 >= ? THEN ? ELSE 0 END
+                WHERE host_name=?''', (error, hostbreaker['failures'],
+                int(time.time()) + hostbreaker['cooldown'], hostname))
+        self.connection.commit()
+
+    def reset_failures(self, hostname):
+        """Close the circuit breaker of a host after it succeeded
+
+        Hosts not found in the database are ignored.
+        Arguments:
+            hostname -- Name of the host system
+        """
+        self.cursor.execute('''
+                UPDATE host SET fail_count=0, cooldown_until=0
+                WHERE host_name=?''', (hostname, ))
+        self.connection.commit()
+
+    def get_history(self, hostnames):
+        """Get the stage durations of the last successful preparation of
+        some hosts
+
+        Arguments:
+            hostnames -- A list of names of host systems
+        Returns:
+            A dictionary of host names and lists of tuples of the stage
+            name, its duration in seconds, the number of bytes copied in the
+            stage and the number of guests prepared. Hosts without history
+            are left out.
+        """
+        history = {}
+        for hostname in hostnames:
+            self.cursor.execute('''
+                    SELECT stage_name, duration, bytes, guests
+                    FROM stage_history
+                    LEFT JOIN host ON host.host_id=stage_history.host_id
+                    WHERE host_name=?''', (hostname, ))
+            rows = self.cursor.fetchall()
+            if len(rows) != 0:
+                history[hostname] = [tuple(row) for row in rows]
+        return history
+
+    def set_history(self, hostname, guests, stages):
+        """Replace the stage durations of a host
+
+        Hosts not found in the database are ignored.
+        Arguments:
+            hostname -- Name of the host system
+            guests   -- Number of guests prepared
+            stages   -- A list of tuples of the stage name, its duration in
+                        seconds and the number of bytes copied in the stage
+        """
+        self.cursor.execute('''
+                DELETE FROM stage_history
+                WHERE host_id=(SELECT host_id FROM host WHERE host_name=?)''',
+                (hostname, ))
+        for stage, duration, size in stages:
+            self.cursor.execute('''
+                    INSERT INTO stage_history
+                    (host_id, stage_name, duration, bytes, guests)
+                    SELECT host_id, ?, ?, ?, ? FROM host WHERE host_name=?''',
+                    (stage, duration, size, guests, hostname))
+        self.connection.commit()
+
     def list(self, args):
         """Return a list of all hosts and their properties.
 
@@ -274,9 +600,15 @@ class Hosts(DatabaseEntity):
         """
         checks.chk_arg_count(args, 0)
         self.cursor.execute('''
-                SELECT host_name, host_memory, host_cores,
-                       is_64bit, is_enabled
-                FROM host ORDER BY host_name''')
+                SELECT host_name, host_memory, host_cores, host_nodes,
+                       host_hugepages, host_overcommit,
+                       COALESCE(host_class, 'none') AS host_class,
+                       is_64bit, is_enabled, fail_count,
+                       CASE WHEN fail_count < ? THEN 'closed'
+                            WHEN cooldown_until > ? THEN 'open'
+                            ELSE 'half-open' END AS breaker
+                FROM host ORDER BY host_name''',
+                (hostbreaker['failures'], int(time.time())))
         return fetchassoc(self.cursor)
 
 
@@ -345,6 +677,7 @@ class Images(DatabaseEntity):
                 LEFT JOIN test ON test.os_type_id=image.os_type_id
                 WHERE image_name=? AND subject_id NOT NULL
                 AND test_id NOT NULL''', (imagename, ))
+        self.clear_candidates()
         self.connection.commit()
 
     def delete(self, args):
@@ -367,7 +700,10 @@ class Images(DatabaseEntity):
                 DELETE FROM host_schedule WHERE image_id=?''', imageid)
         self.cursor.execute('''
                 DELETE FROM subject_schedule WHERE image_id=?''', imageid)
+        self.cursor.execute('''
+                DELETE FROM test_requirement WHERE image_id=?''', imageid)
         self.cursor.execute('DELETE FROM image WHERE image_id=?', imageid)
+        self.clear_candidates()
         self.connection.commit()
 
     def state(self, args):
@@ -387,6 +723,112 @@ class Images(DatabaseEntity):
             raise ValueError('No such guest image.')
         self.cursor.execute('''UPDATE image SET is_enabled=?
                 WHERE image_name=?''', (state, imagename))
+        self.clear_candidates()
+        self.connection.commit()
+
+    def __set_option(self, imagename, column, value):
+        """Set a capability or mode of a guest image
+        """
+        imagename = checks.chk_imagename(imagename)
+        self.cursor.execute('''
+                SELECT * FROM image WHERE image_name=?''', (imagename, ))
+        if self.cursor.fetchone() == None:
+            raise ValueError('No such guest image.')
+        self.cursor.execute('''UPDATE image SET %s=?
+                WHERE image_name=?''' % (column, ), (value, imagename))
+        self.clear_candidates()
+        self.connection.commit()
+
+    def virtio(self, args):
+        """Set whether a guest image has virtio disk and network drivers
+
+        Arguments:
+            imagename -- Filename of the guest image
+            virtio    -- Capability as specified in checks.chk_capability()
+        """
+        checks.chk_arg_count(args, 2)
+        imagename, virtio = args
+        self.__set_option(imagename, 'is_virtio',
+                checks.chk_capability(virtio))
+
+    def vhost(self, args):
+        """Set whether a guest image may use the vhost-net backend of the
+        host kernel (only used together with virtio)
+
+        Arguments:
+            imagename -- Filename of the guest image
+            vhost     -- Capability as specified in checks.chk_capability()
+        """
+        checks.chk_arg_count(args, 2)
+        imagename, vhost = args
+        self.__set_option(imagename, 'is_vhost', checks.chk_capability(vhost))
+
+    def cache(self, args):
+        """Set the preferred disk cache mode of a guest image
+
+        Arguments:
+            imagename -- Filename of the guest image
+            cache     -- Cache mode as specified in checks.chk_diskcache()
+        """
+        checks.chk_arg_count(args, 2)
+        imagename, cache = args
+        self.__set_option(imagename, 'disk_cache', checks.chk_diskcache(cache))
+
+    def aio(self, args):
+        """Set the preferred asynchronous I/O mode of a guest image
+
+        Arguments:
+            imagename -- Filename of the guest image
+            aio       -- AIO mode as specified in checks.chk_diskaio()
+        """
+        checks.chk_arg_count(args, 2)
+        imagename, aio = args
+        self.__set_option(imagename, 'disk_aio', checks.chk_diskaio(aio))
+
+    def hugepages(self, args):
+        """Set whether the memory of guests of a guest image is backed by
+        hugepages
+
+        Arguments:
+            imagename -- Filename of the guest image
+            hugepages -- Capability as specified in checks.chk_capability()
+        """
+        checks.chk_arg_count(args, 2)
+        imagename, hugepages = args
+        self.__set_option(imagename, 'is_hugepages',
+                checks.chk_capability(hugepages))
+
+    def get_sizes(self, imagenames):
+        """Get the recorded sizes of some guest images
+
+        Arguments:
+            imagenames -- A list of filenames of guest images
+        Returns:
+            A dictionary of the filenames of the images with a recorded
+            size and their sizes in bytes
+        """
+        sizes = {}
+        for imagename in imagenames:
+            self.cursor.execute('''
+                    SELECT image_size FROM image
+                    WHERE image_name=? AND image_size NOT NULL''',
+                    (imagename, ))
+            row = self.cursor.fetchone()
+            if row != None:
+                sizes[imagename] = row[0]
+        return sizes
+
+    def set_sizes(self, sizes):
+        """Record the sizes of guest images
+
+        Images not found in the database are ignored.
+        Arguments:
+            sizes -- A dictionary of filenames of guest images and their
+                     sizes in bytes
+        """
+        for imagename, size in sizes.iteritems():
+            self.cursor.execute('''UPDATE image SET image_size=?
+                    WHERE image_name=?''', (size, imagename))
         self.connection.commit()
 
     def list(self, args):
@@ -398,7 +840,10 @@ class Images(DatabaseEntity):
         checks.chk_arg_count(args, 0)
         self.cursor.execute('''
                 SELECT image_name, image_format, vendor_name, os_type_name,
-                       is_64bit, is_bigmem, is_smp, is_enabled
+                       is_64bit, is_bigmem, is_smp, is_enabled, is_virtio,
+                       is_vhost, is_hugepages,
+                       COALESCE(disk_cache, 'default') AS disk_cache,
+                       COALESCE(disk_aio, 'default') AS disk_aio
                 FROM image
                 LEFT JOIN os_type ON image.os_type_id=os_type.os_type_id
                 LEFT JOIN vendor ON image.vendor_id=vendor.vendor_id
@@ -458,10 +903,14 @@ class OsTypes(DatabaseEntity):
             self.cursor.execute('''
                     DELETE FROM subject_schedule
                     WHERE image_id IN (%s)''' % wildcards, imagelist)
+            self.cursor.execute('''
+                    DELETE FROM test_requirement
+                    WHERE image_id IN (%s)''' % wildcards, imagelist)
             self.cursor.execute('''
                     DELETE FROM image WHERE os_type_id=?''', ostypeid)
         self.cursor.execute('DELETE FROM test WHERE os_type_id=?', ostypeid)
         self.cursor.execute('DELETE FROM os_type WHERE os_type_id=?', ostypeid)
+        self.clear_candidates()
         self.connection.commit()
 
     def list(self, args):
@@ -490,9 +939,19 @@ class Tests(DatabaseEntity):
             testcommand -- Command to start the test program
             runtime     -- Runtime for testsuite (seconds)
             timeout     -- Timeout for testsuite (seconds)
+            minmem      -- Minimum memory of the guest (optional)
+            prefmem     -- Preferred memory of the guest (optional)
+            mincores    -- Minimum number of VCPUs of the guest (optional)
+            prefcores   -- Preferred number of VCPUs of the guest (optional)
         """
-        checks.chk_arg_count(args, 5)
-        testname, ostype, testcommand, runtime, timeout = args
+        if len(args) < 5 or len(args) > 9:
+            raise ValueError('Wrong number of arguments.')
+        testname, ostype, testcommand, runtime, timeout = args[:5]
+        requirements = {}
+        for kind, value in zip(checks.requirements, args[5:]):
+            column, value = checks.chk_requirement(kind, value)
+            requirements[column] = value
+        self.__chk_requirements(requirements)
         testname = checks.chk_testname(testname)
         ostype = checks.chk_ostype(ostype)
         testcommand = checks.chk_testcommand(testcommand)
@@ -517,6 +976,11 @@ class Tests(DatabaseEntity):
                 (test_name, os_type_id, test_command, runtime, timeout)
                 VALUES (?,?,?,?,?)''',
                 (testname, ostypeid, testcommand, runtime, timeout))
+        for column, value in requirements.iteritems():
+            self.cursor.execute('''
+                    UPDATE test SET %s=?
+                    WHERE test_name=? AND os_type_id=?''' % (column, ),
+                    (value, testname, ostypeid))
         self.cursor.execute('''
                 INSERT INTO host_schedule (host_id, test_id, image_id)
                 SELECT host_id, test_id, image_id
@@ -533,6 +997,7 @@ class Tests(DatabaseEntity):
                 WHERE test_name=? and test.os_type_id=?
                 AND subject_id NOT NULL AND image_id NOT NULL''',
                 (testname, ostypeid))
+        self.clear_candidates()
         self.connection.commit()
 
     def delete(self, args):
@@ -558,7 +1023,10 @@ class Tests(DatabaseEntity):
                 DELETE FROM host_schedule WHERE test_id=?''', testid)
         self.cursor.execute('''
                 DELETE FROM subject_schedule WHERE test_id=?''', testid)
+        self.cursor.execute('''
+                DELETE FROM test_requirement WHERE test_id=?''', testid)
         self.cursor.execute('DELETE FROM test WHERE test_id=?', testid)
+        self.clear_candidates()
         self.connection.commit()
 
     def list(self, args):
@@ -569,12 +1037,135 @@ class Tests(DatabaseEntity):
         """
         checks.chk_arg_count(args, 0)
         self.cursor.execute('''
-                SELECT test_name, os_type_name, test_command, runtime, timeout
+                SELECT test_name, os_type_name, test_command, runtime, timeout,
+                    COALESCE(min_memory, 'none') AS min_memory,
+                    COALESCE(pref_memory, 'none') AS pref_memory,
+                    COALESCE(min_cores, 'none') AS min_cores,
+                    COALESCE(pref_cores, 'none') AS pref_cores
                 FROM test
                 LEFT JOIN os_type ON os_type.os_type_id=test.os_type_id
                 ORDER BY test_name''')
         return fetchassoc(self.cursor)
 
+    def __chk_requirements(self, requirements):
+        """Check that minimum requirements do not exceed the preferred ones
+
+        Arguments:
+            requirements -- Dictionary of column names and values
+        """
+        for resource in ('memory', 'cores'):
+            minimum = requirements.get('min_%s' % (resource, ))
+            preferred = requirements.get('pref_%s' % (resource, ))
+            if minimum != None and preferred != None and minimum > preferred:
+                raise ValueError('The minimum %s exceeds the preferred %s.' %
+                        (resource, resource))
+
+    def requirement(self, args):
+        """Set a resource requirement of a test program.
+
+        Arguments:
+            testname    -- Name of the test program
+            ostype      -- Name of the OS the test program is meant to run on
+            requirement -- minmem|prefmem|mincores|prefcores
+            value       -- Memory or number of VCPUs, or none
+        """
+        checks.chk_arg_count(args, 4)
+        testname, ostype, requirement, value = args
+        testname = checks.chk_testname(testname)
+        ostype = checks.chk_ostype(ostype)
+        column, value = checks.chk_requirement(requirement, value)
+        self.cursor.execute('''
+                SELECT test_id, min_memory, pref_memory, min_cores, pref_cores
+                FROM test
+                LEFT JOIN os_type ON os_type.os_type_id=test.os_type_id
+                WHERE test_name=? AND os_type_name=?''', (testname, ostype))
+        row = self.cursor.fetchone()
+        if row == None:
+            raise ValueError('No such test.')
+        requirements = dict(zip(('min_memory', 'pref_memory', 'min_cores',
+                                 'pref_cores'), row[1:]))
+        requirements[column] = value
+        self.__chk_requirements(requirements)
+        self.cursor.execute('UPDATE test SET %s=? WHERE test_id=?' %
+                (column, ), (value, row[0]))
+        self.clear_candidates()
+        self.connection.commit()
+
+    def image_requirement(self, args):
+        """Set a resource requirement of a test program for a single guest
+        image, overriding the requirement of the test program.
+
+        Arguments:
+            testname    -- Name of the test program
+            imagename   -- Filename of the guest image
+            requirement -- minmem|prefmem|mincores|prefcores
+            value       -- Memory or number of VCPUs, or none to use the
+                           requirement of the test program
+        """
+        checks.chk_arg_count(args, 4)
+        testname, imagename, requirement, value = args
+        testname = checks.chk_testname(testname)
+        imagename = checks.chk_imagename(imagename)
+        column, value = checks.chk_requirement(requirement, value)
+        self.cursor.execute('''
+                SELECT test_id, image_id FROM test
+                LEFT JOIN image ON image.os_type_id=test.os_type_id
+                WHERE test_name=? AND image_name=?''', (testname, imagename))
+        row = self.cursor.fetchone()
+        if row == None:
+            raise ValueError('No such test for this guest image.')
+        self.cursor.execute('''
+                INSERT OR IGNORE INTO test_requirement (test_id, image_id)
+                VALUES (?,?)''', row)
+        self.cursor.execute('''
+                SELECT COALESCE(test_requirement.min_memory, test.min_memory),
+                    COALESCE(test_requirement.pref_memory, test.pref_memory),
+                    COALESCE(test_requirement.min_cores, test.min_cores),
+                    COALESCE(test_requirement.pref_cores, test.pref_cores)
+                FROM test_requirement
+                LEFT JOIN test ON test.test_id=test_requirement.test_id
+                WHERE test_requirement.test_id=?
+                AND test_requirement.image_id=?''', row)
+        requirements = dict(zip(('min_memory', 'pref_memory', 'min_cores',
+                                 'pref_cores'), self.cursor.fetchone()))
+        if value != None:
+            requirements[column] = value
+            self.__chk_requirements(requirements)
+        self.cursor.execute('''
+                UPDATE test_requirement SET %s=?
+                WHERE test_id=? AND image_id=?''' % (column, ),
+                (value, ) + row)
+        self.cursor.execute('''
+                DELETE FROM test_requirement
+                WHERE min_memory IS NULL AND pref_memory IS NULL
+                AND min_cores IS NULL AND pref_cores IS NULL''')
+        self.clear_candidates()
+        self.connection.commit()
+
+    def list_image_requirements(self, args):
+        """Return a list of all resource requirements of test programs for
+        single guest images.
+
+        Returns:
+            A tuple of dictionaries containing pairs of column name and value
+        """
+        checks.chk_arg_count(args, 0)
+        self.cursor.execute('''
+                SELECT test_name, image_name,
+                    COALESCE(test_requirement.min_memory, 'test')
+                        AS min_memory,
+                    COALESCE(test_requirement.pref_memory, 'test')
+                        AS pref_memory,
+                    COALESCE(test_requirement.min_cores, 'test')
+                        AS min_cores,
+                    COALESCE(test_requirement.pref_cores, 'test')
+                        AS pref_cores
+                FROM test_requirement
+                LEFT JOIN test ON test.test_id=test_requirement.test_id
+                LEFT JOIN image ON image.image_id=test_requirement.image_id
+                ORDER BY test_name, image_name''')
+        return fetchassoc(self.cursor)
+
 
 class TestSubjects(DatabaseEntity):
     """Class for database operations on test subjects
@@ -641,6 +1232,7 @@ class TestSubjects(DatabaseEntity):
                 DELETE FROM completion WHERE subject_id=?''', subjectid)
         self.cursor.execute('''
                 DELETE FROM subject WHERE subject_id=?''', subjectid)
+        self.clear_candidates()
         self.connection.commit()
 
     def __enable(self, subject, bitness, priority):
@@ -800,9 +1392,13 @@ class Vendors(DatabaseEntity):
             self.cursor.execute('''
                     DELETE FROM subject_schedule
                     WHERE image_id IN (%s)''' % wildcards, imagelist)
+            self.cursor.execute('''
+                    DELETE FROM test_requirement
+                    WHERE image_id IN (%s)''' % wildcards, imagelist)
             self.cursor.execute('''
                     DELETE FROM image WHERE vendor_id=?''', vendorid)
         self.cursor.execute('DELETE FROM vendor WHERE vendor_id=?', vendorid)
+        self.clear_candidates()
         self.connection.commit()
 
     def list(self, args):
@@ -933,5 +1529,323 @@ class Completions(DatabaseEntity):
         return fetchassoc(self.cursor)
 
 
+class Overheads(DatabaseEntity):
+    """Class for database operations on the measured parameters of the
+    overhead model of the hypervisors
+    """
+
+    def __get_class(self, hostclass):
+        """@return: Host class as stored, '' for all hosts
+        """
+        if hostclass == 'all':
+            return ''
+        return checks.chk_hostclass(hostclass)
+
+    def add(self, args):
+        """Set a measured parameter of the overhead model
+
+        Arguments:
+            hypervisor -- Hypervisor type
+            hostclass  -- Name of the host class, or 'all'
+            name       -- Name of the parameter as in config.overheads
+            value      -- Measured value
+        """
+        checks.chk_arg_count(args, 4)
+        hypervisor, hostclass, name, value = args
+        hypervisor = checks.chk_hypervisor(hypervisor)
+        hostclass = self.__get_class(hostclass)
+        name, value = checks.chk_overhead(name, value)
+        self.cursor.execute('''
+                INSERT OR REPLACE INTO overhead
+                (hypervisor, host_class, name, value) VALUES (?,?,?,?)''',
+                (hypervisor, hostclass, name, value))
+        self.connection.commit()
+
+    def delete(self, args):
+        """Remove a measured parameter of the overhead model, so that the
+        configured value applies again
+
+        Arguments:
+            hypervisor -- Hypervisor type
+            hostclass  -- Name of the host class, or 'all'
+            name       -- Name of the parameter as in config.overheads
+        """
+        checks.chk_arg_count(args, 3)
+        hypervisor, hostclass, name = args
+        hypervisor = checks.chk_hypervisor(hypervisor)
+        hostclass = self.__get_class(hostclass)
+        self.cursor.execute('''
+                DELETE FROM overhead
+                WHERE hypervisor=? AND host_class=? AND name=?''',
+                (hypervisor, hostclass, name))
+        if self.cursor.rowcount == 0:
+            raise ValueError('No such overhead parameter.')
+        self.connection.commit()
+
+    def get_model(self, hypervisor, hostclass):
+        """Get the overhead model for the hosts of a class
+
+        Arguments:
+            hypervisor -- Hypervisor type, or None if unknown
+            hostclass  -- Name of the host class, or None
+        Returns:
+            A dictionary of all parameters of the overhead model, from
+            config.overheads overridden by the measured values for the
+            hypervisor, and for the hypervisor and the host class
+        """
+        model = dict(overheads['default'])
+        if hypervisor == None:
+            return model
+        model.update(overheads.get(hypervisor, {}))
+        for entry in ('', hostclass):
+            if entry == None:
+                continue
+            self.cursor.execute('''
+                    SELECT name, value FROM overhead
+                    WHERE hypervisor=? AND host_class=?''',
+                    (hypervisor, entry))
+            model.update(dict(self.cursor.fetchall()))
+        return model
+
+    def list(self, args):
+        """Return a list of all measured overhead parameters.
+
+        Returns:
+            A tuple of dictionaries containing pairs of column name and value
+        """
+        checks.chk_arg_count(args, 0)
+        self.cursor.execute('''
+                SELECT hypervisor,
+                       CASE WHEN host_class='' THEN 'all'
+                            ELSE host_class END AS host_class,
+                       name AS key, value
+                FROM overhead ORDER BY hypervisor, host_class, name''')
+        return fetchassoc(self.cursor)
+
+
+class Schedules(DatabaseEntity):
+    """Class for database operations on the schedules of hosts and test
+    subjects
+    """
+
+    def list(self, args):
+        """Return a list of all starving schedule entries.
+
+        Entries are starving if they were passed over by at least
+        config.starvationage test runs, or if no enabled host has enough
+        memory and cores for their minimum requirements. In host mode,
+        only the host of the entry counts. Entries of disabled hosts and
+        test subjects, and entries excluded by the bitness of their host or
+        test subject are not listed.
+
+        Returns:
+            A tuple of dictionaries containing pairs of column name and value
+        """
+        checks.chk_arg_count(args, 0)
+        fits = '''
+                host.is_enabled=1
+                AND host.is_64bit>=image.is_64bit
+                AND host_memory>=COALESCE(test_requirement.min_memory,
+                                          test.min_memory, 0)
+                AND (image.is_smp=0 OR host_cores>=COALESCE(
+                        test_requirement.min_cores, test.min_cores, 1))'''
+        query = '''
+                SELECT * FROM (
+                SELECT host_name AS schedule_name, test_name, image_name,
+                    age, %s AS is_satisfiable
+                FROM host_schedule
+                LEFT JOIN host ON host.host_id=host_schedule.host_id
+                LEFT JOIN image ON image.image_id=host_schedule.image_id
+                LEFT JOIN test ON test.test_id=host_schedule.test_id
+                LEFT JOIN test_requirement ON
+                    test_requirement.test_id=host_schedule.test_id AND
+                    test_requirement.image_id=host_schedule.image_id
+                WHERE image.is_enabled=1 AND host.is_enabled=1
+                AND host.is_64bit>=image.is_64bit
+                UNION ALL
+                SELECT subject_name || ' (' || CASE subject.is_64bit
+                        WHEN 1 THEN '64' ELSE '32' END || ' bit)',
+                    test_name, image_name, age,
+                    EXISTS (SELECT * FROM host WHERE %s) AS is_satisfiable
+                FROM subject_schedule
+                LEFT JOIN subject ON
+                    subject.subject_id=subject_schedule.subject_id
+                LEFT JOIN image ON image.image_id=subject_schedule.image_id
+                LEFT JOIN test ON test.test_id=subject_schedule.test_id
+                LEFT JOIN test_requirement ON
+                    test_requirement.test_id=subject_schedule.test_id AND
+                    test_requirement.image_id=subject_schedule.image_id
+                WHERE image.is_enabled=1 AND subject.is_enabled=1
+                AND subject.is_64bit>=image.is_64bit)
+                WHERE age>=? OR is_satisfiable=0
+                ORDER BY is_satisfiable, age DESC, schedule_name, test_name,
+                    image_name'''
+        self.cursor.execute(query % (fits, fits), (starvationage, ))
+        return fetchassoc(self.cursor)
+
+
+class Builds(DatabaseEntity):
+    """Class for database operations on the test runs of the builds of
+    test subjects
+    """
+
+    def list(self, args):
+        """Return a list of all builds of the test subjects with the number
+        of test runs and guests, the time of the first test run, and the
+        schedule entries covered by the test runs.
+
+        Returns:
+            A tuple of dictionaries containing pairs of column name and value
+        """
+        checks.chk_arg_count(args, 0)
+        self.cursor.execute('''
+                SELECT subject_name, subject.is_64bit,
+                    COALESCE(build, 'none') AS build,
+                    COUNT(DISTINCT subject_run.run_id) AS runs,
+                    COUNT(subject_run_test.run_id) AS guests,
+                    DATETIME(MIN(started), 'unixepoch', 'localtime')
+                        AS first_run,
+                    COUNT(DISTINCT subject_run_test.test_id || '/' ||
+                                   subject_run_test.image_id) || ' of ' || (
+                        SELECT COUNT(*) FROM subject_schedule
+                        LEFT JOIN image ON
+                            image.image_id=subject_schedule.image_id
+                        WHERE subject_schedule.subject_id=subject.subject_id
+                        AND image.is_enabled=1
+                        AND subject.is_64bit>=image.is_64bit) AS coverage
+                FROM subject_run
+                LEFT JOIN subject ON subject.subject_id=subject_run.subject_id
+                LEFT JOIN subject_run_test ON
+                    subject_run_test.run_id=subject_run.run_id
+                GROUP BY subject_run.subject_id, build
+                ORDER BY subject_name, subject.is_64bit, MIN(started)''')
+        return fetchassoc(self.cursor)
+
+    def runs(self, args):
+        """Return a list of all guests of the test runs using a build of a
+        test subject, to look up their results.
+
+        Arguments:
+            subject -- Name of the test subject
+            bitness -- Bitness of the test subject
+            build   -- File name of the build, or none for test runs
+                       without recorded build
+        Returns:
+            A tuple of dictionaries containing pairs of column name and value
+        """
+        checks.chk_arg_count(args, 3)
+        subject, bitness, build = args
+        subject = checks.chk_subject(subject)
+        bitness = checks.chk_bitness(bitness)
+        self.cursor.execute('''
+                SELECT subject_id FROM subject
+                WHERE subject_name=? AND is_64bit=?''', (subject, bitness))
+        subjectid = self.cursor.fetchone()
+        if subjectid == None:
+            raise ValueError('No such test subject.')
+        self.cursor.execute('''
+                SELECT subject_run.run_id AS run_id, host_name,
+                    DATETIME(started, 'unixepoch', 'localtime') AS first_run,
+                    test_name, image_name
+                FROM subject_run
+                LEFT JOIN host ON host.host_id=subject_run.host_id
+                LEFT JOIN subject_run_test ON
+                    subject_run_test.run_id=subject_run.run_id
+                LEFT JOIN test ON test.test_id=subject_run_test.test_id
+                LEFT JOIN image ON image.image_id=subject_run_test.image_id
+                WHERE subject_id=? AND COALESCE(build, 'none')=?
+                ORDER BY started, subject_run.run_id, test_name,
+                    image_name''', subjectid + (build, ))
+        return fetchassoc(self.cursor)
+
+
+class Checkpoints(DatabaseEntity):
+    """Class for database operations on preparation checkpoints
+
+    Steps are recorded by several preparation threads of a host, so the
+    connection may be used from any thread and is guarded by a lock.
+    """
+
+    def __init__(self):
+        init_database()
+        self.connection = sqlite3.connect(dbpath, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.lock = threading.Lock()
+
+    def save(self, hostname, overlay, tests):
+        """Start a new checkpoint for a host, replacing an older one
+
+        Arguments:
+            hostname -- Name of the host system
+            overlay  -- Whether guests start from overlays (0|1)
+            tests    -- Serialized tests of the testrun
+        """
+        self.lock.acquire()
+        try:
+            self.cursor.execute('''
+                    INSERT OR REPLACE INTO checkpoint
+                    (host_id, is_overlay, tests, steps)
+                    SELECT host_id, ?, ?, '' FROM host WHERE host_name=?''',
+                    (overlay, tests, hostname))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    def load(self, hostname):
+        """Get the checkpoint of a host
+
+        Arguments:
+            hostname -- Name of the host system
+        Returns:
+            A dictionary with the items 'overlay', 'tests' and 'steps'
+            (a list of step names), or None if there is no checkpoint
+        """
+        self.lock.acquire()
+        try:
+            self.cursor.execute('''
+                    SELECT is_overlay, tests, steps FROM checkpoint
+                    LEFT JOIN host ON host.host_id=checkpoint.host_id
+                    WHERE host_name=?''', (hostname, ))
+            row = self.cursor.fetchone()
+        finally:
+            self.lock.release()
+        if row == None:
+            return None
+        return {'overlay': row[0], 'tests': row[1],
+                'steps': [str(step) for step in row[2].split('\n') if step]}
+
+    def add_step(self, hostname, step):
+        """Record a completed step of the preparation of a host
+        """
+        self.lock.acquire()
+        try:
+            self.cursor.execute('''
+                    UPDATE checkpoint SET steps=steps || ?
+                    WHERE host_id=(SELECT host_id FROM host
+                                   WHERE host_name=?)''',
+                    ('%s\n' % (step, ), hostname))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+    def delete(self, args):
+        """Remove the checkpoint of a host
+
+        Arguments:
+            hostname -- Name of the host system
+        """
+        checks.chk_arg_count(args, 1)
+        hostname, = args
+        self.lock.acquire()
+        try:
+            self.cursor.execute('''
+                    DELETE FROM checkpoint
+                    WHERE host_id=(SELECT host_id FROM host
+                                   WHERE host_name=?)''', (hostname, ))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+
+
 if __name__ == "__main__":
     pass
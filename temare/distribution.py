@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 expandtab smarttab
+"""Module to distribute staged base images between hosts prepared at the
+same time
+"""
+import threading
+from config import fanout
+
+
+class DistributionPlan:
+    """Plan for distributing staged base images between hosts
+
+    The plan is made from the images every host needs, before any host
+    starts staging. One host per image (the seed) is chosen to copy it
+    from the image server, spreading the seeds evenly. All other hosts
+    copy the image from a host that already staged it, each of which
+    serves a limited number of hosts at the same time. This way, the load
+    on the image server grows with the number of distinct images instead
+    of the number of hosts.
+
+    Hosts stage the images they are seed for first, so seeds never wait
+    for other hosts. If the seed of an image failed or did not start
+    staging yet while nobody has the image, the next host asking for it
+    takes over. Hosts only wait for seeds which are busy staging, so the
+    hosts need not all be prepared at the same time.
+
+    Images are identified by arbitrary keys, hosts by their names.
+
+    Arguments:
+        needs   -- Dictionary of host names and lists of keys of the images
+                   the hosts need
+        uploads -- Number of hosts a single host serves at the same time
+                   (optional, defaults to config.fanout)
+    """
+
+    def __init__(self, needs, uploads=None):
+        if uploads == None:
+            uploads = fanout
+        self.condition = threading.Condition()
+        self.limit = uploads
+        self.needs = dict([(host, list(keys))
+                           for host, keys in needs.iteritems()])
+        self.seeds = {}
+        self.holders = {}
+        self.uploads = dict([(host, 0) for host in needs.keys()])
+        self.started = []
+        self.failed = []
+        self.copies = {'central': 0, 'peer': 0}
+        self.__make_plan()
+
+    def __make_plan(self):
+        """Choose a seed for every image, preferring the hosts with the
+        least number of seeds so far
+        """
+        wanted = {}
+        for host, keys in self.needs.iteritems():
+            for key in keys:
+                wanted.setdefault(key, []).append(host)
+        seedcount = dict([(host, 0) for host in self.needs.keys()])
+        keys = wanted.keys()
+        keys.sort(key=lambda key: (-len(wanted[key]), key))
+        for key in keys:
+            hosts = sorted(wanted[key], key=lambda host: (seedcount[host], host))
+            self.seeds[key] = hosts[0]
+            seedcount[hosts[0]] += 1
+
+    def start(self, host, keys, staged=()):
+        """Mark a host as staging its images
+
+        Arguments:
+            host   -- Name of the host
+            keys   -- List of keys of the images the host is going to stage
+            staged -- List of keys of the images the host staged before
+        Returns:
+            The list of keys in the order the host should stage them
+        """
+        self.condition.acquire()
+        try:
+            self.uploads.setdefault(host, 0)
+            if host not in self.started:
+                self.started.append(host)
+            for key in staged:
+                holders = self.holders.setdefault(key, [])
+                if host not in holders:
+                    holders.append(host)
+            self.condition.notifyAll()
+            keys = list(keys)
+            keys.sort(key=lambda key: int(self.seeds.get(key) != host))
+            return keys
+        finally:
+            self.condition.release()
+
+    def acquire(self, host, key):
+        """Find the source to copy an image from
+
+        Prefers a host that already staged the image and has a free upload
+        slot. Otherwise waits for one, unless the host is the seed of the
+        image or has to take over from it.
+
+        Arguments:
+            host -- Name of the host needing the image
+            key  -- Key of the image
+        Returns:
+            The name of the host to copy the image from, or None if the
+            image has to be copied from the image server
+        """
+        self.condition.acquire()
+        try:
+            while True:
+                holders = [peer for peer in self.holders.get(key, [])
+                           if peer not in self.failed and peer != host]
+                available = [peer for peer in holders
+                             if self.uploads[peer] < self.limit]
+                if len(available) != 0:
+                    available.sort(key=lambda peer: self.uploads[peer])
+                    self.uploads[available[0]] += 1
+                    return available[0]
+                seed = self.seeds.get(key)
+                if seed in (None, host):
+                    return None
+                if len(holders) == 0 and (seed in self.failed or
+                                          seed not in self.started):
+                    self.seeds[key] = host
+                    return None
+                self.condition.wait()
+        finally:
+            self.condition.release()
+
+    def release(self, host, key, source, success):
+        """Mark a copy of an image as finished
+
+        Arguments:
+            host    -- Name of the host that received the image
+            key     -- Key of the image
+            source  -- Name of the host the image was copied from,
+                       or None for the image server
+            success -- Whether the host staged the image successfully
+        """
+        self.condition.acquire()
+        try:
+            if source != None:
+                self.uploads[source] -= 1
+            if success:
+                self.holders.setdefault(key, []).append(host)
+                if source == None:
+                    self.copies['central'] += 1
+                else:
+                    self.copies['peer'] += 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def fail(self, host):
+        """Exclude a failed host from the distribution
+
+        The host is neither used as a source nor waited for any longer.
+        """
+        self.condition.acquire()
+        try:
+            if host not in self.failed:
+                self.failed.append(host)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get_summary(self):
+        """@return: A list of lines describing the image distribution
+        """
+        return ['Image distribution: %d copies from the image server, '
+                '%d copies between hosts' %
+                (self.copies['central'], self.copies['peer'])]
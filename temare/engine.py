@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 expandtab smarttab
+"""Module to run the preparation of many hosts at the same time
+"""
+import os
+import sys
+import select
+import threading
+import time
+import dbops
+import distribution
+import executor
+import report
+import transfer
+from config import preplimits, hypervisorscript, hypervisorttl, \
+                   preptimeouts, prepestimates, hostbreaker, healthscript, \
+                   guestboot
+
+# Stages of a preparation running no commands on the host, None for
+# failures before the preparation of the host started
+localstages = [None, 'Generating tests']
+
+
+def read_output(process, timeout):
+    """Read the output of a process until it exits
+
+    The output is read as soon as it arrives, so that the pipe never fills
+    up. The process is killed if it does not exit within the timeout.
+
+    Arguments:
+        process -- A Popen object with the output going to stdout
+        timeout -- Number of seconds to wait for the process
+    Returns:
+        A tuple of the exit code (None if the process was killed) and the
+        output of the process
+    """
+    deadline = time.time() + timeout
+    chunks = []
+    while True:
+        remaining = max(0, deadline - time.time())
+        if select.select([process.stdout], [], [], remaining)[0]:
+            data = os.read(process.stdout.fileno(), 65536)
+            if data == '':
+                break
+            chunks.append(data)
+        elif time.time() >= deadline:
+            break
+    while process.poll() == None and time.time() < deadline:
+        time.sleep(0.05)
+    if process.poll() == None:
+        process.kill()
+        process.wait()
+        return None, ''.join(chunks)
+    return process.returncode, ''.join(chunks)
+
+
+def get_timeout_message(output, timeout):
+    """@return: The reason of a command failing after the timeout, starting
+                with the output the command printed so far
+    """
+    message = 'Timed out after %d seconds' % (timeout, )
+    if output.strip() == '':
+        return message
+    return '%s\n%s' % (output.rstrip('\n'), message)
+
+
+def run_probes(hosts, command, timeout, limit=None, remote=None):
+    """Run a command on many hosts at the same time
+
+    Arguments:
+        hosts   -- A list of host names
+        command -- Command to run on every host
+        timeout -- Number of seconds to wait for the command
+        limit   -- Number of hosts probed at the same time
+                   (optional, defaults to the commands limit of
+                   config.preplimits)
+        remote  -- Executor to run the command with
+                   (optional, defaults to an executor.SshExecutor)
+    Returns:
+        A dictionary of host names and tuples of the exit code (None if
+        the command timed out) and the output of the command
+    """
+    if limit == None:
+        limit = preplimits['commands']
+    if remote == None:
+        remote = executor.SshExecutor()
+    results = {}
+    for index in range(0, len(hosts), limit):
+        processes = []
+        deadline = time.time() + timeout
+        for host in hosts[index:index + limit]:
+            processes.append((host, remote.spawn(host, command, timeout)))
+        for host, process in processes:
+            results[host] = read_output(process,
+                    max(0, deadline - time.time()))
+    return results
+
+
+def detect_hypervisors(hosts, ttl=None, limit=None, remote=None):
+    """Determine the hypervisor running on every host
+
+    Hypervisor types cached in the database are reused as long as they
+    are younger than ttl seconds. All other hosts are probed through the
+    executor at the same time, at most limit hosts at once, and the
+    detected types are cached.
+
+    Arguments:
+        hosts  -- A list of host names
+        ttl    -- Maximum age of cached types in seconds
+                  (optional, defaults to config.hypervisorttl)
+        limit  -- Number of hosts probed at the same time
+                  (optional, defaults to the commands limit of
+                  config.preplimits)
+        remote -- Executor to probe the hosts with
+                  (optional, defaults to an executor.SshExecutor)
+    Returns:
+        A dictionary of host names and their hypervisor types ('xen' or
+        'kvm'), or None if the type could not be determined
+    """
+    if ttl == None:
+        ttl = hypervisorttl
+    hostops = dbops.Hosts()
+    now = int(time.time())
+    cached = hostops.get_types(hosts)
+    types = {}
+    probe = []
+    for host in hosts:
+        hosttype, checked = cached.get(host, (None, 0))
+        if hosttype != None and now - checked < ttl:
+            types[host] = hosttype
+        else:
+            probe.append(host)
+    results = run_probes(probe, hypervisorscript, preptimeouts['check'],
+            limit, remote)
+    for host in probe:
+        retval, output = results[host]
+        output = output.strip().split('\n')[-1]
+        types[host] = None
+        if retval == 0 and output in ('xen', 'kvm'):
+            types[host] = output
+            hostops.set_type(host, output, now)
+    return types
+
+
+def check_health(hosts, limit=None, remote=None):
+    """Find the hosts to skip because their circuit breaker is open
+
+    Hosts whose cooldown expired get a cheap health probe. The breaker of
+    a host passing the probe is closed, the breaker of a host failing it
+    is opened again.
+
+    Arguments:
+        hosts  -- A list of host names
+        limit  -- Number of hosts probed at the same time
+                  (optional, defaults to the commands limit of
+                  config.preplimits)
+        remote -- Executor to probe the hosts with
+                  (optional, defaults to an executor.SshExecutor)
+    Returns:
+        A dictionary of the names of the hosts to skip and the reason
+    """
+    hostops = dbops.Hosts()
+    health = hostops.get_health(hosts)
+    skipped = {}
+    probe = []
+    for host in hosts:
+        if not health.has_key(host) or health[host]['state'] == 'closed':
+            continue
+        if health[host]['state'] == 'half-open':
+            probe.append(host)
+            continue
+        skipped[host] = ('Skipped after %d failed preparations in a row '
+                'until %s. Last error:\n%s' % (health[host]['failures'],
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                time.localtime(health[host]['cooldown'])),
+                health[host]['error']))
+    results = run_probes(probe, healthscript, hostbreaker['probe'], limit,
+            remote)
+    for host in probe:
+        retval, output = results[host]
+        if retval == 0:
+            hostops.reset_failures(host)
+            continue
+        if retval == None:
+            output = get_timeout_message(output, hostbreaker['probe'])
+        skipped[host] = 'Health probe failed:\n%s' % (output.strip(), )
+        hostops.add_failure(host, skipped[host])
+    return skipped
+
+
+def record_health(results):
+    """Update the circuit breakers of prepared hosts
+
+    Only failures of the hosts themselves count, that is failures in a
+    stage running commands on the host. Failures before any remote work,
+    such as generating the tests or not finding the hypervisor, and
+    cancelled commands leave the breaker of a host as it is.
+
+    Arguments:
+        results -- A dictionary of host names and result dictionaries as
+                   collected by the preparation engine
+    """
+    hostops = dbops.Hosts()
+    for host, result in results.iteritems():
+        if result['status'] == 'done':
+            hostops.reset_failures(host)
+        elif result.get('stage') not in localstages and \
+                not result['reason'].startswith('Cancelled'):
+            hostops.add_failure(host, result['reason'])
+
+
+def get_makespan(durations, count):
+    """Determine the time needed to run jobs on a number of workers,
+    which take the jobs in the given order as soon as they are idle
+
+    Arguments:
+        durations -- A list of the durations of the jobs
+        count     -- Number of workers
+    Returns:
+        The time the last job finishes
+    """
+    workers = [0.0] * max(1, min(count, len(durations)))
+    for duration in durations:
+        index = workers.index(min(workers))
+        workers[index] += duration
+    return max(workers)
+
+
+class TaskPool:
+    """Pool of threads running tasks of a single host at the same time
+
+    Every task is a list of steps run one after another. A step is a tuple
+    of a stage name, a function and a tuple of arguments for the function.
+    After a step failed, the remaining steps of its task are skipped and
+    no further tasks are started.
+
+    Arguments:
+        count  -- Number of tasks run at the same time
+        cancel -- Function called after the first failed step, to cancel
+                  the steps still running (optional)
+        enter  -- Function called with the stage name before every step,
+                  in the thread running the step (optional)
+    """
+
+    def __init__(self, count, cancel=None, enter=None):
+        self.count = count
+        self.cancel = cancel
+        self.enter = enter
+        self.lock = threading.Lock()
+        self.pending = []
+        self.threads = []
+        self.failure = None
+        self.failed = None
+
+    def add(self, steps):
+        """Add a task consisting of a list of steps
+        """
+        self.pending.append(steps)
+
+    def __work(self):
+        """Run tasks until no task is left or a step failed
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if len(self.pending) == 0 or self.failure != None:
+                    return
+                steps = self.pending.pop(0)
+            finally:
+                self.lock.release()
+            for stage, function, args in steps:
+                try:
+                    if self.enter != None:
+                        self.enter(stage)
+                    function(*args)
+                except Exception, err:
+                    self.lock.acquire()
+                    try:
+                        first = self.failure == None
+                        if first:
+                            self.failure = (stage, err)
+                            self.failed = time.time()
+                    finally:
+                        self.lock.release()
+                    if first and self.cancel != None:
+                        self.cancel()
+                    break
+
+    def start(self):
+        """Start running the tasks
+        """
+        for index in range(min(self.count, len(self.pending))):
+            thread = threading.Thread(target=self.__work)
+            self.threads.append(thread)
+            thread.start()
+
+    def join(self):
+        """Wait until all tasks are finished
+
+        Returns:
+            A tuple of the stage name and the exception of the first failed
+            step, or None if all steps succeeded. The time of the failure
+            is kept in the failed attribute.
+        """
+        for thread in self.threads:
+            thread.join()
+        return self.failure
+
+
+class PreparationEngine:
+    """Engine preparing hosts on a bounded pool of worker threads
+
+    The tests of all hosts are generated first, one host after another,
+    so that the images needed by every host are known before any remote
+    work starts. Afterwards a limited number of workers takes the hosts
+    with the longest estimated preparation first and runs their
+    preparation, so that no long preparation starts at the end of the run.
+    The estimates are based on the stage durations of the last successful
+    preparation of every host, the number of guests and the recorded image
+    sizes, which are updated after the run. Remote commands are limited
+    for all hosts together and for every single host.
+
+    Output of all preparations is serialized through the engine, and the
+    outcome of every host is collected as a result dictionary with the
+    keys host, status ('done' or 'failed'), stage, reason, guests,
+    duration and estimate. The timing of all commands, stages and hosts
+    is recorded in a preparation report.
+
+    Arguments:
+        limits     -- Dictionary with the keys hosts, commands and
+                      hostcommands (optional, defaults to config.preplimits)
+        fanout     -- Distribute staged base images between the hosts
+        prepreport -- Preparation report to record the timing in
+                      (optional, defaults to a report without file)
+        remote     -- Executor running the commands on the hosts
+                      (optional, defaults to an executor.SshExecutor)
+        history    -- Base the estimates on the stage durations and image
+                      sizes in the database and update them (optional,
+                      otherwise only config.prepestimates is used)
+        boot       -- Dictionary with the keys parallel, delay, timeout and
+                      interval for starting the guests of a host
+                      (optional, defaults to config.guestboot)
+    """
+
+    def __init__(self, limits=None, fanout=False, prepreport=None,
+                 remote=None, history=True, boot=None):
+        if limits == None:
+            limits = preplimits
+        self.limits = dict(preplimits)
+        self.limits.update(limits)
+        if boot == None:
+            boot = guestboot
+        self.boot = dict(guestboot)
+        self.boot.update(boot)
+        self.fanout = fanout
+        self.history = history
+        self.lock = threading.Lock()
+        self.commands = threading.Semaphore(self.limits['commands'])
+        self.hostcommands = {}
+        self.preparations = []
+        self.pending = []
+        self.results = {}
+        self.transfers = transfer.TransferScheduler()
+        self.distribution = None
+        self.estimates = {}
+        self.makespan = None
+        if prepreport == None:
+            prepreport = report.PreparationReport()
+        self.report = prepreport
+        if remote == None:
+            remote = executor.SshExecutor()
+        self.executor = remote
+
+    def add(self, preparation):
+        """Add the preparation of a host
+        """
+        self.preparations.append(preparation)
+
+    def write(self, text, stream=None):
+        """Write text to stdout or the given stream without interleaving
+        it with the output of other hosts
+        """
+        if stream == None:
+            stream = sys.stdout
+        self.lock.acquire()
+        try:
+            stream.write(text)
+            stream.flush()
+        finally:
+            self.lock.release()
+
+    def acquire_command(self, host):
+        """Wait until a remote command may run on a host
+        """
+        self.lock.acquire()
+        try:
+            if not self.hostcommands.has_key(host):
+                self.hostcommands[host] = threading.Semaphore(
+                        self.limits['hostcommands'])
+            semaphore = self.hostcommands[host]
+        finally:
+            self.lock.release()
+        semaphore.acquire()
+        self.commands.acquire()
+
+    def release_command(self, host):
+        """Mark a remote command on a host as finished
+        """
+        self.commands.release()
+        self.hostcommands[host].release()
+
+    def report_success(self, host, guests, started=None):
+        """Record and print the successful preparation of a host
+
+        Arguments:
+            host    -- Name of the host
+            guests  -- Number of guests started
+            started -- Start time of the preparation (optional)
+        """
+        duration = 0
+        if started != None:
+            duration = time.time() - started
+        self.lock.acquire()
+        try:
+            self.results[host] = {'host': host, 'status': 'done',
+                    'stage': None, 'reason': None, 'guests': guests,
+                    'duration': duration,
+                    'estimate': self.estimates.get(host)}
+        finally:
+            self.lock.release()
+        self.report.add_host(host, 'done', started, duration, guests)
+        self.write('%s done. Number of guests started: %d\n' %
+                (host, guests))
+
+    def report_failure(self, host, stage, reason, started=None):
+        """Record and print the failed preparation of a host
+
+        Arguments:
+            host    -- Name of the host
+            stage   -- Failing stage, or None if no stage was reached
+            reason  -- Description of the failure
+            started -- Start time of the preparation (optional)
+        """
+        duration = 0
+        if started != None:
+            duration = time.time() - started
+        self.lock.acquire()
+        try:
+            self.results[host] = {'host': host, 'status': 'failed',
+                    'stage': stage, 'reason': reason, 'guests': 0,
+                    'duration': duration,
+                    'estimate': self.estimates.get(host)}
+        finally:
+            self.lock.release()
+        self.report.add_host(host, 'failed', started, duration, 0)
+        if self.distribution != None:
+            self.distribution.fail(host)
+        if stage == None:
+            self.write('Preparation of host %s failed\n'
+                    'Reason:\n%s\n' % (host, reason), sys.stderr)
+        else:
+            self.write('Preparation of host %s failed\n'
+                    'Failing stage: %s\n'
+                    'Reason:\n%s\n' % (host, stage, reason), sys.stderr)
+
+    def estimate(self, preparation, sizes, history):
+        """Estimate the duration of the preparation of a host
+
+        Stages without image copies take as long as in the last successful
+        preparation, scaled by the number of guests. Image copies take
+        the time needed at the bandwidth the host reached before.
+        config.prepestimates is used for hosts without recorded stages,
+        and for images of unknown size.
+
+        Arguments:
+            preparation -- A preparation with generated tests
+            sizes       -- A dictionary of image filenames and their sizes
+            history     -- A list of tuples of the stage name, duration,
+                           bytes copied and number of guests of the last
+                           successful preparation of the host
+        Returns:
+            The estimated duration in seconds
+        """
+        guests = len(preparation.testrun.tests)
+        size = prepestimates['imagesize'] * 1048576
+        copied = sum([sizes.get(image, size)
+                      for image in preparation.get_transfers()])
+        bandwidth = prepestimates['bandwidth'] * 1048576.0
+        fixed = prepestimates['host'] + guests * prepestimates['guest']
+        if len(history) != 0:
+            fixed = 0.0
+            transferred = 0
+            transfertime = 0.0
+            for stage, duration, size, before in history:
+                if size > 0:
+                    transferred += size
+                    transfertime += duration
+                else:
+                    fixed += duration * guests / max(1, before)
+            if transferred > 0 and transfertime > 0:
+                bandwidth = transferred / transfertime
+        return fixed + copied / bandwidth
+
+    def __order(self):
+        """Sort the pending hosts by their estimated preparation time,
+        longest first, and estimate the makespan of the run
+        """
+        history = {}
+        sizes = {}
+        if self.history:
+            hosts = [preparation.host
+                     for preparation, started in self.pending]
+            history = dbops.Hosts().get_history(hosts)
+            images = []
+            for preparation, started in self.pending:
+                images.extend(preparation.get_transfers())
+            sizes = dbops.Images().get_sizes(sorted(set(images)))
+        for preparation, started in self.pending:
+            self.estimates[preparation.host] = self.estimate(preparation,
+                    sizes, history.get(preparation.host, []))
+        self.pending.sort(key=lambda entry: -self.estimates[entry[0].host])
+        self.makespan = {'estimated': get_makespan(
+                [self.estimates[preparation.host]
+                 for preparation, started in self.pending],
+                self.limits['hosts']), 'actual': None}
+
+    def __record(self):
+        """Record the stage durations of all hosts prepared successfully
+        from the start, and the sizes of all images, for later estimates
+        """
+        hostops = dbops.Hosts()
+        sizes = {}
+        for preparation in self.preparations:
+            sizes.update(preparation.sizes)
+            result = self.results.get(preparation.host)
+            if (result != None and result['status'] == 'done' and
+                    not preparation.resume):
+                hostops.set_history(preparation.host, result['guests'],
+                        self.report.get_stages(preparation.host))
+        dbops.Images().set_sizes(sizes)
+
+    def __prepare(self, preparation, started):
+        """Run the preparation of a single host and record its result
+        """
+        guests = len(preparation.testrun.tests)
+        try:
+            preparation.run()
+        except Exception, err:
+            self.report_failure(preparation.host, preparation.stage,
+                    str(err), started)
+            return
+        self.report_success(preparation.host, guests, started)
+
+    def __work(self):
+        """Prepare hosts until no host is left
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if len(self.pending) == 0:
+                    return
+                preparation, started = self.pending.pop(0)
+            finally:
+                self.lock.release()
+            self.__prepare(preparation, started)
+
+    def run(self):
+        """Generate the tests of all hosts and prepare the hosts
+
+        Returns:
+            A dictionary of host names and their result dictionaries
+        """
+        for preparation in self.preparations:
+            started = time.time()
+            try:
+                preparation.generate()
+            except Exception, err:
+                self.report_failure(preparation.host, preparation.stage,
+                        str(err), started)
+                continue
+            self.pending.append((preparation, started))
+        if self.fanout:
+            needs = {}
+            for preparation, started in self.pending:
+                if preparation.overlay:
+                    needs[preparation.host] = preparation.get_images()
+            self.distribution = distribution.DistributionPlan(needs)
+        self.__order()
+        started = time.time()
+        workers = []
+        for index in range(min(self.limits['hosts'], len(self.pending))):
+            workers.append(threading.Thread(target=self.__work))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.makespan['actual'] = time.time() - started
+        self.report.close()
+        if self.history:
+            self.__record()
+        return self.results
+
+    def get_failed(self):
+        """@return: A sorted list of the names of all failed hosts
+        """
+        return sorted([host for host, result in self.results.iteritems()
+                       if result['status'] == 'failed'])
+
+    def get_summary(self):
+        """@return: A list of lines describing the makespan, the image
+                    transfers, the image distribution, and the slowest
+                    hosts and stages
+        """
+        summary = []
+        if self.makespan != None and len(self.estimates) != 0:
+            summary.append('Makespan: %.1f s, estimated %.1f s' %
+                    (self.makespan['actual'], self.makespan['estimated']))
+        summary += self.transfers.get_summary()
+        if self.distribution != None:
+            summary += self.distribution.get_summary()
+        summary += self.report.get_summary()
+        return summary
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 expandtab smarttab
+"""Module for executing preparation commands on real or simulated hosts
+"""
+import os
+import re
+import pipes
+import random
+import shutil
+import tempfile
+import threading
+from subprocess import Popen, PIPE, STDOUT
+from config import hypervisorscript, overlaydir, virtdirman, sshtimeout, \
+                   remotetimeout
+
+
+class SshExecutor:
+    """Executor running commands on hosts through ssh
+    """
+
+    def spawn(self, host, command, timeout=None):
+        """Start a command on a host
+
+        Arguments:
+            host    -- Name of the host
+            command -- Command to execute
+            timeout -- Number of seconds after which the host kills the
+                       command (optional)
+        Returns:
+            A Popen object with the output of the command on its stdout
+        """
+        if timeout != None:
+            command = remotetimeout % (int(timeout) + 1, pipes.quote(command))
+        return Popen(['/usr/bin/ssh', '-o PasswordAuthentication=no',
+                '-o ConnectTimeout=%d' % (sshtimeout, ), 'root@%s' % (host, ),
+                command], stderr=STDOUT, stdout=PIPE)
+
+
+class SimulatedExecutor:
+    """Executor simulating a fleet of hosts on the local machine
+
+    Every simulated host is a directory below a temporary directory,
+    holding the base images staged on the host. Commands are recognized by
+    their kind and run as local processes which sleep for the simulated
+    duration, print the simulated output and exit with the simulated exit
+    code, so that timeouts and cancellation work as for real hosts.
+
+    Arguments:
+        latency    -- Seconds every command takes
+        bandwidth  -- Bandwidth of a single image copy in MB/s
+        failrate   -- Probability of a command to fail (0.0 to 1.0)
+        imagesize  -- Size of every image in MB
+        hypervisor -- Hypervisor running on the simulated hosts
+    """
+
+    def __init__(self, latency=0.05, bandwidth=100, failrate=0.0,
+                 imagesize=100, hypervisor='kvm'):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failrate = failrate
+        self.imagesize = imagesize
+        self.hypervisor = hypervisor
+        self.root = tempfile.mkdtemp(prefix='temare-')
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def get_directory(self, host):
+        """@return: The directory of a simulated host, holding its staged
+                    base images in config.overlaydir
+        """
+        directory = os.path.join(self.root, host)
+        self.lock.acquire()
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(os.path.join(directory, overlaydir))
+        finally:
+            self.lock.release()
+        return directory
+
+    def simulate(self, host, command):
+        """Determine duration, output and exit code of a command
+
+        Returns:
+            A tuple of the duration in seconds, the output and the exit code
+        """
+        directory = self.get_directory(host)
+        basedir = os.path.join(directory, overlaydir)
+        copytime = float(self.imagesize) / self.bandwidth
+        duration = self.latency
+        output = ''
+        self.lock.acquire()
+        try:
+            failed = self.random.random() < self.failrate
+        finally:
+            self.lock.release()
+        if failed:
+            return duration, 'Simulated failure of: %s\n' % (
+                    command.split('\n')[0], ), 1
+        if command == hypervisorscript:
+            output = '%s\n' % (self.hypervisor, )
+        elif command.startswith('if [ -d /mnt/official_testing ]'):
+            images = re.search('stat -L -c %s:%Y ([^;]*);', command).group(1)
+            output = 'nfs\n' + '%d:0\n' % (self.imagesize * 1048576, ) * \
+                     len(images.split())
+        elif command.startswith('/bin/mkdir -p %s/%s && cd ' %
+                (virtdirman, overlaydir)):
+            for name in sorted(os.listdir(basedir)):
+                stampfile = os.path.join(basedir, '%s.stamp' % (name, ))
+                if os.path.isfile(stampfile):
+                    output += '%s %s\n' % (name, open(stampfile).read())
+        elif '/bin/cp /mnt/official_testing/' in command or \
+                command.startswith('/usr/bin/scp'):
+            duration += copytime
+        elif 'qemu-img convert' in command:
+            duration += copytime / 2
+        elif command.endswith('echo ready; true'):
+            output = 'ready\n'
+        match = re.match('mv -f %s/%s/(\S+)\{\.tmp,\} && echo (\S+) ' %
+                (virtdirman, overlaydir), command)
+        if match != None:
+            open(os.path.join(basedir, match.group(1)), 'w').close()
+            stampfile = open(os.path.join(basedir,
+                    '%s.stamp' % (match.group(1), )), 'w')
+            stampfile.write(match.group(2))
+            stampfile.close()
+        return duration, output, 0
+
+    def spawn(self, host, command, timeout=None):
+        """Start the simulation of a command on a host
+
+        Arguments:
+            host    -- Name of the simulated host
+            command -- Command to simulate
+            timeout -- Number of seconds the command may take (unused, the
+                       local process is killed after the timeout)
+        Returns:
+            A Popen object with the simulated output on its stdout
+        """
+        duration, output, retval = self.simulate(host, command)
+        script = 'sleep %.3f; printf "%%s" "$0"; exit %d' % (duration, retval)
+        return Popen(['/bin/sh', '-c', script, output], stderr=STDOUT,
+                stdout=PIPE)
+
+    def cleanup(self):
+        """Remove the directories of all simulated hosts
+        """
+        shutil.rmtree(self.root, True)
+
+
+class SimulatedTestRun:
+    """Test run for a simulated host, providing the same test items as
+    generator.TestRunGenerator without using the database
+
+    Arguments:
+        guests -- Number of guests
+        images -- Number of distinct guest images used by all hosts
+    """
+
+    def __init__(self, guests, images=4):
+        self.resources = {'physical': 1024 * guests, 'overcommit': 1.0}
+        self.tests = []
+        for count in range(guests):
+            self.tests.append({
+                    'id': count + 1, 'runid': count + 1, 'vnc': count,
+                    'macaddr': '00:16:3e:00:00:%02x' % (count + 1, ),
+                    'image': 'simulated%d.img' % (count % images, ),
+                    'format': 'qcow2', 'test': 'simulated',
+                    'testcommand': '/bin/true', 'runtime': 60,
+                    'timeout': 120, 'bitness': 1, 'bigmem': 0, 'smp': 1,
+                    'cores': 1, 'memory': 512, 'shadowmem': 5, 'hap': 1,
+                    'ostype': 'simulated', 'virtio': 1, 'vhost': 1,
+                    'cache': 'none', 'aio': 'native', 'node': None,
+                    'cpus': None, 'hugepages': 0, 'balloon': 0,
+                    'datadir': virtdirman})
+
+    def do_finalize(self):
+        """Mark all tests used in the testrun as done (nothing to do)
+        """
+        self.tests = []
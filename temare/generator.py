@@ -2,11 +2,23 @@
 # vim: tabstop=4 shiftwidth=4 expandtab smarttab
 """Module to generate guest configurations for a test run
 """
+try:
+    import yaml
+except ImportError:
+    raise ValueError(
+            'You need to have PyYAML installed on your system.\n'
+            'Package names are python-yaml on Debian/Ubuntu/SuSE '
+            'and PyYAML on Fedora.')
+import re
 import sqlite3
 import checks
 import random
+import time
 from socket import gethostbyname
-from config import dbpath, virtdirman, virtdirauto, minmem
+from dbops import init_database, Overheads
+from config import dbpath, virtdirman, virtdirauto, pagesharing, \
+                   starvationage, steerstarving, vendorpolicy, \
+                   smokeruntime, smokeperostype, newbuildpolicy
 
 
 class TestRunGenerator():
@@ -20,6 +32,8 @@ class TestRunGenerator():
         subject  -- Specific test subject to be chosen (optional)
         bitness  -- Bitness of the specific test subject
                     (only required if test subject is specified)
+        tests    -- Tests generated earlier to be used instead of
+                    generating new ones (optional)
 
     Provided information:
         TestRunGenerator.host
@@ -27,6 +41,17 @@ class TestRunGenerator():
         'id'            -- Database ID of the host           (integer)
         'name'          -- Hostname                          (string)
         'ip'            -- IP address of the host            (string)
+        'hypervisor'    -- Cached hypervisor type, or None   (xen|kvm)
+        'class'         -- Host class, or None               (string)
+        'shape'         -- Memory, cores, and bitness        (tuple)
+
+        TestRunGenerator.overhead
+                Overhead model of the hypervisor and the host class as
+                described for config.overheads
+
+        TestRunGenerator.build
+                File name of the build of the test subject used by the
+                test run, or None if unknown, see set_build()
 
         TestRunGenerator.subject
                 Dictionary with the following items:
@@ -56,22 +81,55 @@ class TestRunGenerator():
         'shadowmem'     -- Shadow memory                     (integer)
         'hap'           -- Nested paging enabled             (0|1)
         'ostype'        -- Type of the guest OS              (string)
+        'virtio'        -- Guest has virtio drivers          (0|1)
+        'vhost'         -- Guest may use vhost-net           (0|1)
+        'cache'         -- Disk cache mode, or None          (string)
+        'aio'           -- Disk AIO mode, or None            (string)
+        'hugepages'     -- Memory backed by hugepages        (0|1)
+        'minmemory'     -- Minimum memory of the test        (integer)
+        'prefmemory'    -- Preferred memory of the test,     (integer)
+                           or None if it has no preference
+        'mincores'      -- Minimum VCPUs of the test         (integer)
+        'prefcores'     -- Preferred VCPUs of the test,      (integer)
+                           or None if it has no preference
+        'age'           -- Test runs passing over the test   (integer)
+        'balloon'       -- Memory balloon enabled            (0|1)
+        'node'          -- NUMA node the guest is bound to,  (integer)
+                           or None if it is not bound
+        'cpus'          -- Host CPUs of the node, e.g. 4-7,  (string)
+                           or None if it is not bound
 
     Methods:
+        TestRunGenerator.set_build()
+                Record the build of the test subject and start a fresh
+                cycle for a new build
+        TestRunGenerator.gen_tests()
+                Generate the tests, if tests were given to start with
         TestRunGenerator.do_finalize()
                 Mark all tests used in the testrun as done
     """
 
-    def __init__(self, hostname, auto=False, subject=False, bitness=False):
-        self.host = {'id': None, 'name': None, 'ip': None}
+    def __init__(self, hostname, auto=False, subject=False, bitness=False,
+                 tests=None):
+        self.host = {'id': None, 'name': None, 'ip': None,
+                     'hypervisor': None, 'class': None, 'shape': None}
         self.subject = {
                 'id': None, 'name': None, 'bitness': None, 'completion': {}}
         for key in checks.grubvalues.keys():
             self.subject['completion'][key] = ''
         self.resources = {
-                'memory': 0, 'cores': 0, 'bitness': 0, 'lastvendor': 0}
+                'memory': 0, 'cores': 0, 'bitness': 0, 'lastvendor': 0,
+                'hugepages': 0, 'physical': 0, 'overcommit': 1.0,
+                'commit': 0, 'nodes': 1, 'nodecpus': None}
+        self.overhead = {}
+        self.build = None
+        self.nodes = []
+        self.shared = []
         self.tests = []
-        self.connection = sqlite3.connect(dbpath)
+        # Tests are generated and finalized in different threads of the
+        # preparation engine, but never at the same time
+        init_database()
+        self.connection = sqlite3.connect(dbpath, check_same_thread=False)
         self.cursor = self.connection.cursor()
         self.get_host_info(hostname)
         if auto == False:
@@ -79,12 +137,18 @@ class TestRunGenerator():
         else:
             self.schedule = 'subject'
             self.get_subject_info(subject, bitness)
-        self.gen_tests()
+        self.set_resources()
+        if tests != None:
+            self.tests = tests
+        else:
+            self.gen_tests()
 
     def get_host_info(self, hostname):
-        """Fetch values for the host ID, available memory and cores,
+        """Fetch values for the host ID, memory and cores,
         the bitness of the virt system installed on the host,
-        the vendor ID of the last guest running on the host
+        the vendor ID of the last guest running on the host,
+        and its NUMA nodes, hugepage pool, overcommit ratio, cached
+        hypervisor type, and host class
 
         Arguments:
             hostname -- Name of the host system
@@ -92,7 +156,9 @@ class TestRunGenerator():
         hostname = checks.chk_hostname(hostname)
         self.cursor.execute('''
                 SELECT host_id, host_memory, host_cores, last_vendor_id,
-                       last_subject_id, is_64bit, is_enabled
+                       last_subject_id, is_64bit, is_enabled, host_nodes,
+                       host_hugepages, host_overcommit, host_type,
+                       host_class, host_nodecpus
                 FROM host WHERE host_name=?''', (hostname, ))
         result = self.cursor.fetchone()
         if result == None:
@@ -101,15 +167,77 @@ class TestRunGenerator():
         self.host['ip'] = gethostbyname(hostname)
         self.host['id'], self.resources['memory'], self.resources['cores'], \
                 self.resources['lastvendor'], self.resources['lastsubject'], \
-                self.resources['bitness'], state = result
-        if int(self.resources["memory"] * 0.1) > minmem:
-            self.resources['memory'] -= int(self.resources["memory"] * 0.1)
-        else:
-            self.resources['memory'] -= minmem
-        self.resources['cores'] += 1
+                self.resources['bitness'], state, self.resources['nodes'], \
+                self.resources['hugepages'], self.resources['overcommit'], \
+                self.host['hypervisor'], self.host['class'], \
+                self.resources['nodecpus'] = result
+        self.resources['physical'] = self.resources['memory']
+        self.host['shape'] = (self.resources['memory'],
+                self.resources['cores'], self.resources['bitness'])
         if state != 1:
             raise ValueError('The chosen host is currently disabled.')
 
+    def get_hypervisor(self):
+        """@return: The hypervisor of the test subject in subject mode,
+                    otherwise the cached hypervisor type of the host,
+                    None if unknown
+        """
+        if self.schedule == 'host':
+            return self.host['hypervisor']
+        for hypervisor in ('kvm', 'xen'):
+            if re.search(hypervisor, self.subject['name']):
+                return hypervisor
+        return None
+
+    def set_resources(self):
+        """Determine the memory and VCPUs available for guests with the
+        overhead model of the hypervisor and the host class, and split
+        them between the NUMA nodes of the host. The hugepage pool of the
+        host is taken from the available memory. With memory overcommit,
+        the memory committed to guests may exceed the available memory by
+        the overcommit ratio of the host. Xen has no page sharing and its
+        guests get no memory balloon, so the overcommit ratio of Xen hosts
+        is ignored.
+        """
+        hypervisor = self.get_hypervisor()
+        self.overhead = Overheads().get_model(hypervisor, self.host['class'])
+        if hypervisor == 'xen':
+            self.resources['overcommit'] = 1.0
+        memory = self.resources['memory']
+        self.resources['memory'] -= max(int(memory * self.overhead['share']),
+                                        int(self.overhead['reserve']))
+        cores = self.resources['cores']
+        self.resources['cores'] = max(1, int(cores * self.overhead['vcpus']))
+        nodes = self.resources['nodes']
+        cpulists = None
+        if self.resources['nodecpus'] != None:
+            cpulists = self.resources['nodecpus'].split('/')
+        if nodes > 1:
+            first = 0
+            for node in range(nodes):
+                if cpulists != None:
+                    cpus = cpulists[node]
+                    nodecores = checks.chk_cpulist(cpus)
+                else:
+                    nodecores = cores / nodes
+                    if node < cores % nodes:
+                        nodecores += 1
+                    cpus = '%d-%d' % (first, first + nodecores - 1)
+                    first += nodecores
+                if nodecores == 0:
+                    # More nodes stored than the host has cores
+                    continue
+                vcpus = max(1, int(nodecores * self.overhead['vcpus']))
+                self.nodes.append({'id': node, 'cores': vcpus,
+                        'memory': self.resources['memory'] / nodes,
+                        'cpus': cpus})
+        hugepages = min(self.resources['hugepages'],
+                        max(self.resources['memory'], 0))
+        self.resources['hugepages'] = hugepages
+        self.resources['memory'] -= hugepages
+        self.resources['commit'] = int(
+                self.resources['memory'] * self.resources['overcommit'])
+
     def get_subject_info(self, subject, bitness):
         """Find the next test subject to run on a host and fetch values for
         its ID, bitness and state, and the vendor ID of the last guest
@@ -164,17 +292,29 @@ class TestRunGenerator():
         for key, value in result:
             self.subject['completion'][key] = value
 
-    def get_vendor(self):
+    def get_vendor(self, skip=()):
         """Find the next vendor with possible guest images from the schedule
 
         Check for the bitness and exclude images already scheduled for the
-        current test run. Check if there are still tests to be done for
+        current test run. Only vendors with tests whose minimum memory and
+        VCPUs are left are considered, see get_fit(), and vendors in skip
+        are passed over. Check if there are still tests to be done for
         the vendor. If there are still tests to be done but only for
-        images wich are already scheduled for the current test run, unlock
-        a single random test from the already done ones. If all tests are
-        done reset the is_done flags of all tests.
+        images wich are already scheduled for the current test run or
+        for tests not fitting the resources left, unlock a single random
+        fitting test from the already done ones. If all tests are done
+        reset the is_done flags of all tests.
         Update last_vendor_id with the determined vendor.
 
+        With config.vendorpolicy 'runtime', the vendor with the most
+        runtime of fitting tests left is chosen instead of the next one,
+        as long as any vendor has such tests left for images not used in
+        the current test run. With config.steerstarving, the vendor of the
+        oldest fitting starving test is chosen ahead of both policies.
+
+        Arguments:
+            skip -- IDs of vendors to pass over (optional)
+
         @return: vendor ID or 0 on failure
         """
         # Gather all bits to construct different database queries
@@ -187,54 +327,117 @@ class TestRunGenerator():
             imagevalue = tuple([test['image'] for test in self.tests])
             wildcards = ','.join(['?'] * len(imagevalue))
             imagecond = 'AND image_name NOT IN (%s)' % (wildcards, )
+        if self.get_free_memory() < 1024:
+            # Only the hugepage pool is left
+            imagecond += ' AND is_hugepages=1'
+        fitcond, fitvalue = self.get_fit()
+        skipcond = ''
+        if len(skip) != 0:
+            wildcards = ','.join(['?'] * len(skip))
+            skipcond = 'AND vendor_id NOT IN (%s)' % (wildcards, )
+        selectcond = ' '.join((imagecond, fitcond, skipcond))
+        selectvalue = imagevalue + fitvalue + tuple(skip)
         query = '''
                 SELECT vendor_id FROM %s_schedule
                 LEFT JOIN image ON %s_schedule.image_id=image.image_id
+                LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                LEFT JOIN test_requirement ON
+                    test_requirement.test_id=%s_schedule.test_id AND
+                    test_requirement.image_id=%s_schedule.image_id
                 LEFT JOIN %s ON %s_schedule.%s_id=%s.%s_id
                 WHERE %s.is_64bit>=image.is_64bit
                 AND image.is_enabled=1
                 AND %s_schedule.%s_id=? %s %s
                 ORDER BY vendor_id LIMIT 1'''
-        # Try to find a vendor
-        config = ((self.schedule, ) * 10) + (imagecond, 'AND vendor_id>?')
-        values = idvalue + imagevalue + (self.resources['lastvendor'], )
-        self.cursor.execute(query % config, values)
-        result = self.cursor.fetchone()
+        result = None
+        if steerstarving:
+            # The vendor of the oldest starving test fitting the host
+            starvingquery = '''
+                    SELECT vendor_id FROM %s_schedule
+                    LEFT JOIN image ON %s_schedule.image_id=image.image_id
+                    LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                    LEFT JOIN test_requirement ON
+                        test_requirement.test_id=%s_schedule.test_id AND
+                        test_requirement.image_id=%s_schedule.image_id
+                    LEFT JOIN %s ON %s_schedule.%s_id=%s.%s_id
+                    WHERE %s.is_64bit>=image.is_64bit
+                    AND image.is_enabled=1
+                    AND %s_schedule.is_done=0
+                    AND %s_schedule.age>=?
+                    AND %s_schedule.%s_id=? %s
+                    ORDER BY %s_schedule.age DESC, vendor_id LIMIT 1'''
+            config = ((self.schedule, ) * 15) + (selectcond, self.schedule)
+            values = (starvationage, ) + idvalue + selectvalue
+            self.cursor.execute(starvingquery % config, values)
+            result = self.cursor.fetchone()
+        if result == None and vendorpolicy == 'runtime':
+            runtimequery = '''
+                    SELECT vendor_id FROM %s_schedule
+                    LEFT JOIN image ON %s_schedule.image_id=image.image_id
+                    LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                    LEFT JOIN test_requirement ON
+                        test_requirement.test_id=%s_schedule.test_id AND
+                        test_requirement.image_id=%s_schedule.image_id
+                    LEFT JOIN %s ON %s_schedule.%s_id=%s.%s_id
+                    WHERE %s.is_64bit>=image.is_64bit
+                    AND image.is_enabled=1
+                    AND %s_schedule.is_done=0
+                    AND %s_schedule.%s_id=? %s
+                    GROUP BY vendor_id
+                    ORDER BY SUM(runtime) DESC, vendor_id<=?, vendor_id
+                    LIMIT 1'''
+            config = ((self.schedule, ) * 14) + (selectcond, )
+            values = idvalue + selectvalue + (self.resources['lastvendor'], )
+            self.cursor.execute(runtimequery % config, values)
+            result = self.cursor.fetchone()
+        if result == None:
+            # Try to find the next vendor
+            config = ((self.schedule, ) * 13) + (selectcond, 'AND vendor_id>?')
+            values = idvalue + selectvalue + (self.resources['lastvendor'], )
+            self.cursor.execute(query % config, values)
+            result = self.cursor.fetchone()
         if result == None:
-            config = ((self.schedule, ) * 10) + (imagecond, '')
-            self.cursor.execute(query % config, (idvalue + imagevalue))
+            config = ((self.schedule, ) * 13) + (selectcond, '')
+            self.cursor.execute(query % config, (idvalue + selectvalue))
             result = self.cursor.fetchone()
             if result == None:
                 return 0
         vendor = result[0]
-        # Check is_done flags
+        # Check is_done flags of the tests fitting the resources left
+        opencond = ' '.join((imagecond, fitcond))
+        openvalue = imagevalue + fitvalue
         query = '''
                 SELECT schedule_id FROM %s_schedule
                 LEFT JOIN image ON %s_schedule.image_id=image.image_id
+                LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                LEFT JOIN test_requirement ON
+                    test_requirement.test_id=%s_schedule.test_id AND
+                    test_requirement.image_id=%s_schedule.image_id
                 LEFT JOIN %s ON %s_schedule.%s_id=%s.%s_id
                 WHERE %s.is_64bit>=image.is_64bit
                 AND image.is_enabled=1
                 AND %s_schedule.%s_id=?
                 AND %s_schedule.is_done=?
                 AND vendor_id=? %s'''
-        config = ((self.schedule, ) * 11) + (imagecond, )
-        values = idvalue + (0, vendor) + imagevalue
+        config = ((self.schedule, ) * 14) + (opencond, )
+        values = idvalue + (0, vendor) + openvalue
         self.cursor.execute(query % config, values)
         if self.cursor.fetchone() == None:
             # Nothing to be done. But probably still something to do
-            # for images already used in the current test run
-            config = ((self.schedule, ) * 11) + ('', )
+            # for images already used in the current test run or for
+            # tests not fitting the resources left
+            config = ((self.schedule, ) * 14) + ('', )
             self.cursor.execute(query % config, (idvalue + (0, vendor)))
             if self.cursor.fetchone() != None:
-                # There are still some tests to do, but the image
-                # is already used in this test run. Unlock a random
-                # test from the done ones.
-                config = ((self.schedule, ) * 11) + (imagecond, )
-                values = idvalue + (1, vendor) + imagevalue
+                # There are still some tests to do, but not fitting
+                # this test run. Unlock a random fitting test from the
+                # done ones.
+                config = ((self.schedule, ) * 14) + (opencond, )
+                values = idvalue + (1, vendor) + openvalue
                 self.cursor.execute(query % config, values)
                 result = random.choice(self.cursor.fetchall())
                 query = 'UPDATE %s_schedule SET is_done=0 WHERE schedule_id=?'
-                self.cursor.execute(query % (self.schedule, ), (result[0], ))
+                self.set_done(query % (self.schedule, ), (result[0], ))
                 self.connection.commit()
             else:
                 # All tests done. Reset all is_done flags.
@@ -245,7 +448,7 @@ class TestRunGenerator():
                 config = (self.schedule, wildcards)
                 query = '''UPDATE %s_schedule
                         SET is_done=0 WHERE schedule_id IN (%s)'''
-                self.cursor.execute(query % config, testval)
+                self.set_done(query % config, testval)
                 self.connection.commit()
         # Update last_vendor_id
         query = 'UPDATE %s SET last_vendor_id=? WHERE %s_id=?'
@@ -255,9 +458,58 @@ class TestRunGenerator():
         self.resources['lastvendor'] = vendor
         return vendor
 
+    def get_fit(self):
+        """Build the condition for schedule entries of tests whose minimum
+        memory and VCPUs are left for a guest, as get_test() checks them
+        for the candidates of a vendor
+
+        @return: tuple of the condition and its values
+        """
+        freecores, freememory = self.get_limits({'hugepages': 0})[2:]
+        hugememory = self.get_limits({'hugepages': 1})[3]
+        cond = '''
+                AND COALESCE(test_requirement.min_memory, test.min_memory,
+                             1024) <=
+                    CASE WHEN is_hugepages=1 THEN ? ELSE ? END
+                AND CASE WHEN is_smp=0 THEN 1
+                         ELSE COALESCE(test_requirement.min_cores,
+                                       test.min_cores, 1) END <= ?'''
+        return cond, (hugememory, freememory, freecores)
+
     def do_weighing(self, smallup, smallsmp, bigup, bigsmp):
         """Pick a test most suitable for the available resources
+
+        With config.steerstarving, the oldest test passed over by at least
+        config.starvationage test runs is picked ahead of all others.
+        Otherwise, only short tests are considered as long as there are
+        any, see config.smokeruntime, and of those only the ones of OS
+        types without short test in the current cycle if there are any and
+        config.smokeperostype is set. Tests preferring more memory or
+        VCPUs than the minimum guest are picked first, so that the
+        resources of the host go to the tests benefitting from them. The
+        chance of a test to be picked grows with the number of test runs
+        passing over it, and starving tests are never left out by the
+        preferences above.
         """
+        starving = [test for test in smallup + smallsmp + bigup + bigsmp
+                    if test['age'] >= starvationage]
+        if steerstarving and len(starving) != 0:
+            oldest = max([test['age'] for test in starving])
+            return random.choice([test for test in starving
+                                  if test['age'] == oldest])
+        smoke = [test for test in smallup + smallsmp + bigup + bigsmp
+                 if test['runtime'] <= smokeruntime]
+        if smokeperostype and len(smoke) != 0:
+            smoked = self.get_smoked_ostypes()
+            representatives = [test for test in smoke
+                               if test['ostype'] not in smoked]
+            if len(representatives) != 0:
+                smoke = representatives
+        if len(smoke) != 0:
+            smallup = [test for test in smallup if test in smoke]
+            smallsmp = [test for test in smallsmp if test in smoke]
+            bigup = [test for test in bigup if test in smoke]
+            bigsmp = [test for test in bigsmp if test in smoke]
         if self.resources['memory'] > 4096 and len(bigup + bigsmp) != 0:
             if self.resources['cores'] > 1 and len(bigsmp) != 0:
                 # select random test from bigsmp, do random cores/mem
@@ -289,86 +541,310 @@ class TestRunGenerator():
         else:
             # select random test, do random cores/mem
             testlist = smallup + smallsmp + bigup + bigsmp
-        return random.choice(testlist)
+        demanding = [test for test in testlist
+                     if (test['prefmemory'] or 0) > 1024 or
+                        (test['prefcores'] or 0) > 1]
+        if len(demanding) != 0:
+            testlist = demanding
+        testlist = testlist + [test for test in starving
+                               if test not in testlist]
+        pick = random.randrange(sum([1 + test['age'] for test in testlist]))
+        for test in testlist:
+            pick -= 1 + test['age']
+            if pick < 0:
+                return test
 
-    def get_test(self):
-        """Fetch all possible tests and return a test most suitable
-        for the available resources
+    def get_smoked_ostypes(self):
+        """@return: The OS types with a short test done in the current
+                    cycle or used in the current test run, see
+                    config.smokeruntime
+        """
+        idvalue = (self.subject['id'], )
+        if self.schedule == 'host':
+            idvalue = (self.host['id'], )
+        query = '''
+                SELECT DISTINCT os_type_name FROM %s_schedule
+                LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                LEFT JOIN os_type ON os_type.os_type_id=test.os_type_id
+                WHERE %s_schedule.%s_id=? AND is_done=1 AND runtime<=?'''
+        self.cursor.execute(query % ((self.schedule, ) * 4),
+                idvalue + (smokeruntime, ))
+        ostypes = [row[0] for row in self.cursor.fetchall()]
+        return ostypes + [test['ostype'] for test in self.tests
+                          if test['runtime'] <= smokeruntime]
+
+    def query_candidates(self, vendor):
+        """Fetch all tests of a vendor not done yet whose guest image fits
+        the bitness of the host or test subject, and whose minimum memory
+        and VCPUs do not exceed those of the host
+
+        @return: dict with the lists 'smallup', 'smallsmp', 'bigup', and
+                 'bigsmp' of tests, classified by the bigmem and SMP
+                 capability of their images
         """
-        # Gather all bits to construct different database queries
-        vendor = self.get_vendor()
-        if vendor == 0:
-            return None
         idvalue = (self.subject['id'], )
-        imagevalue = ()
-        imagecond = ''
         if self.schedule == 'host':
             idvalue = (self.host['id'], )
-        if len(self.tests) != 0:
-            imagevalue = tuple([test['image'] for test in self.tests])
-            wildcards = ','.join(['?'] * len(imagevalue))
-            imagecond = 'AND image_name NOT IN (%s)' % (wildcards, )
         query = '''
                 SELECT schedule_id, image_name, image_format,
                         test_name, test_command, runtime, timeout,
-                        is_bigmem, is_smp, image.is_64bit, os_type_name
+                        is_bigmem, is_smp, image.is_64bit, os_type_name,
+                        is_virtio, is_vhost, disk_cache, disk_aio,
+                        is_hugepages,
+                        COALESCE(test_requirement.min_memory,
+                                 test.min_memory),
+                        COALESCE(test_requirement.pref_memory,
+                                 test.pref_memory),
+                        COALESCE(test_requirement.min_cores, test.min_cores),
+                        COALESCE(test_requirement.pref_cores, test.pref_cores),
+                        %s_schedule.age
                 FROM %s_schedule
                 LEFT JOIN image ON %s_schedule.image_id=image.image_id
                 LEFT JOIN test ON %s_schedule.test_id=test.test_id
+                LEFT JOIN test_requirement ON
+                    test_requirement.test_id=%s_schedule.test_id AND
+                    test_requirement.image_id=%s_schedule.image_id
                 LEFT JOIN %s ON %s_schedule.%s_id=%s.%s_id
                 LEFT JOIN os_type ON os_type.os_type_id=image.os_type_id
                 WHERE %s.is_64bit>=image.is_64bit
                 AND image.is_enabled=1
                 AND is_done=0
                 AND %s_schedule.%s_id=?
-                AND vendor_id=?
-                %s'''
-        smallup = smallsmp = bigup = bigsmp = []
-        self.cursor.execute(
-                query % (((self.schedule, ) * 11) + (imagecond, )),
-                (idvalue + (vendor, ) + imagevalue))
-        row = self.cursor.fetchone()
-        while row != None:
-            if row[7] == 0 and row[8] == 0:
-                smallup.append(row)
-            elif row[7] == 0 and row[8] == 1:
-                smallsmp.append(row)
-            elif row[7] == 1 and row[8] == 0:
-                bigup.append(row)
-            elif row[7] == 1 and row[8] == 1:
-                bigsmp.append(row)
-            row = self.cursor.fetchone()
-        return dict(zip(
-                ('id', 'image', 'format', 'test',
-                 'testcommand', 'runtime','timeout',
-                 'bigmem', 'smp', 'bitness', 'ostype'),
-                self.do_weighing(smallup, smallsmp, bigup, bigsmp)))
+                AND vendor_id=?'''
+        candidates = {'smallup': [], 'smallsmp': [], 'bigup': [],
+                      'bigsmp': []}
+        memory, cores = self.host['shape'][:2]
+        self.cursor.execute(query % ((self.schedule, ) * 14),
+                idvalue + (vendor, ))
+        for row in self.cursor.fetchall():
+            test = dict(zip(
+                    ('id', 'image', 'format', 'test',
+                     'testcommand', 'runtime','timeout',
+                     'bigmem', 'smp', 'bitness', 'ostype',
+                     'virtio', 'vhost', 'cache', 'aio', 'hugepages',
+                     'minmemory', 'prefmemory', 'mincores', 'prefcores',
+                     'age'),
+                    row))
+            if test['minmemory'] == None:
+                test['minmemory'] = 1024
+            if test['mincores'] == None or test['smp'] == 0:
+                test['mincores'] = 1
+            if test['smp'] == 0:
+                test['prefcores'] = None
+            if test['minmemory'] > memory or test['mincores'] > cores:
+                continue
+            bucket = ('small', 'big')[test['bigmem']] + \
+                     ('up', 'smp')[test['smp']]
+            candidates[bucket].append(test)
+        return candidates
+
+    def get_candidates(self, vendor):
+        """Classify the candidate tests of a vendor as in query_candidates()
+
+        In subject mode, the candidates are cached for all hosts with the
+        same memory, cores, and bitness, until the done flags of the test
+        subject change. Changes to the schedule, the guest images, or the
+        tests clear the cache, see dbops.DatabaseEntity.clear_candidates().
+
+        @return: dict of candidate tests as for query_candidates()
+        """
+        if self.schedule == 'host':
+            return self.query_candidates(vendor)
+        shape = '%d/%d/%d' % self.host['shape']
+        values = (self.subject['id'], vendor, shape)
+        self.cursor.execute('''
+                SELECT candidates FROM candidate_cache
+                LEFT JOIN subject ON
+                    subject.subject_id=candidate_cache.subject_id
+                WHERE candidate_cache.subject_id=? AND vendor_id=?
+                AND host_shape=?
+                AND candidate_cache.done_epoch=subject.done_epoch''', values)
+        result = self.cursor.fetchone()
+        if result != None:
+            return yaml.safe_load(result[0])
+        # Read the epoch first, so that candidates queried while another
+        # test run changes the done flags are never taken as current
+        self.cursor.execute('''
+                SELECT done_epoch FROM subject WHERE subject_id=?''',
+                (self.subject['id'], ))
+        epoch = self.cursor.fetchone()[0]
+        candidates = self.query_candidates(vendor)
+        self.cursor.execute('''
+                INSERT OR REPLACE INTO candidate_cache
+                (subject_id, vendor_id, host_shape, done_epoch, candidates)
+                VALUES (?,?,?,?,?)''',
+                values + (epoch, yaml.safe_dump(candidates)))
+        self.connection.commit()
+        return candidates
+
+    def set_done(self, query, values):
+        """Change the done flags of schedule entries and, in subject mode,
+        start a new done epoch of the test subject
+
+        Arguments:
+            query  -- UPDATE statement for the schedule entries
+            values -- Values of the statement
+        """
+        self.cursor.execute(query, values)
+        if self.schedule == 'subject':
+            self.cursor.execute('''
+                    UPDATE subject SET done_epoch=done_epoch+1
+                    WHERE subject_id=?''', (self.subject['id'], ))
+
+    def get_test(self):
+        """Fetch all possible tests and return a test most suitable
+        for the available resources
+
+        Tests are only considered if their guest image is not used in the
+        test run yet, and if the minimum memory and VCPUs they require, or
+        require for the guest image, are left. Images without SMP
+        capability are always limited to a single VCPU. If no test of the
+        vendor picked by get_vendor() fits, the next vendor is tried.
+
+        @return: The test or None if no test of any vendor fits
+        """
+        images = [test['image'] for test in self.tests]
+        # Only the hugepage pool is left
+        hugepagesonly = self.get_free_memory() < 1024
+        skip = []
+        vendor = self.get_vendor(skip)
+        while vendor != 0:
+            candidates = self.get_candidates(vendor)
+            for bucket in candidates.keys():
+                tests = []
+                for test in candidates[bucket]:
+                    if test['image'] in images or \
+                       (hugepagesonly and test['hugepages'] != 1):
+                        continue
+                    freecores, freememory = self.get_limits(test)[2:]
+                    if test['minmemory'] <= freememory and \
+                       test['mincores'] <= freecores:
+                        tests.append(dict(test))
+                candidates[bucket] = tests
+            if len(sum(candidates.values(), [])) != 0:
+                return self.do_weighing(candidates['smallup'],
+                                        candidates['smallsmp'],
+                                        candidates['bigup'],
+                                        candidates['bigsmp'])
+            skip.append(vendor)
+            vendor = self.get_vendor(skip)
+        return None
+
+    def get_free_memory(self):
+        """@return: Memory left for guests not backed by hugepages, which
+                    is limited by the estimated use of the available memory
+                    and by the memory left to commit
+        """
+        return min(self.resources['memory'], self.resources['commit'])
+
+    def get_node(self):
+        """Pick the NUMA node for the next guest
+
+        @return: The node with the most free cores and at least one free
+                 core and 1 GB of free memory, or None if the host has a
+                 single node or no node is left with enough resources
+        """
+        nodes = [node for node in self.nodes
+                 if node['cores'] > 0 and node['memory'] >= 1024]
+        if len(nodes) == 0:
+            return None
+        return max(nodes, key=lambda node: (node['cores'], node['memory']))
+
+    def get_limits(self, test):
+        """Determine the resources left for the guest of a test
+
+        @return: A tuple of the NUMA node to bind the guest to or None,
+                 whether the guest gets its memory from the hugepage pool,
+                 and the number of VCPUs and the memory left for it
+        """
+        node = self.get_node()
+        hugepages = test['hugepages'] == 1 and \
+                    self.resources['hugepages'] >= 1024
+        freecores = self.resources['cores']
+        freememory = self.get_free_memory()
+        if hugepages:
+            freememory = self.resources['hugepages']
+        if node != None:
+            freecores = node['cores']
+            freememory = min(freememory, node['memory'])
+        return node, hugepages, freecores, freememory
 
     def get_test_config(self, test):
         """Figure out the configuration for a single test
 
-        @return: dict with items 'cores', 'memory', 'shadowmem', and 'hap'
+        On hosts with several NUMA nodes the guest is sized to fit into
+        the node with the most free cores and bound to it, so that guests
+        neither straddle nodes nor share cores. Guests of images using
+        hugepages get their memory from the hugepage pool of the host as
+        long as it has at least 1 GB left.
+
+        On hosts with memory overcommit, guests get a memory balloon, and
+        a guest of the same vendor and OS type as an earlier guest of the
+        test run is expected to share config.pagesharing of its memory
+        with it, which is not taken from the available memory.
+
+        Guests get the preferred memory and VCPUs of their test as far as
+        they are left, but never less than the minimum of the test. Tests
+        without preferences get a random share of the resources left.
+
+        @return: dict with items 'cores', 'memory', 'shadowmem', 'hap',
+                 'hugepages', 'balloon', 'node', and 'cpus'
         """
-        if self.resources['cores'] == 1 or test['smp'] == 0:
+        node, hugepages, freecores, freememory = self.get_limits(test)
+        if freecores == 1 or test['smp'] == 0:
             cores = 1
+        elif test['prefcores'] != None:
+            cores = max(test['mincores'], min(test['prefcores'], freecores))
         else:
-            cores = random.randint(2, self.resources['cores'])
+            cores = random.randint(max(2, test['mincores']), freecores)
         hap = 1
-        if self.resources['memory'] > 4096 and test['bigmem'] == 1:
-            memory = random.randrange(
-                    4096, self.resources['memory'] + 256, 256)
-        elif self.resources['memory'] > 4096:
-            memory = random.randrange(1024, 4096 + 256, 256)
+        minmemory = max(1024, test['minmemory'])
+        minmemory += -minmemory % 256
+        if test['prefmemory'] != None:
+            memory = min(test['prefmemory'], freememory)
+            if test['bigmem'] == 0:
+                memory = min(memory, 4096)
+            memory = max(minmemory, memory - memory % 256)
+        elif freememory > 4096 and test['bigmem'] == 1:
+            memory = random.randrange(max(4096, minmemory),
+                                      freememory + 256, 256)
+        elif freememory > 4096:
+            memory = random.randrange(minmemory, max(4096, minmemory) + 256,
+                                      256)
         else:
-            memory = random.randrange(
-                    1024, self.resources['memory'] + 256, 256)
+            memory = random.randrange(minmemory, freememory + 256, 256)
+        if hugepages:
+            # Hugepages cannot be overcommitted
+            memory = max(1024, min(memory, freememory - freememory % 256))
         if memory > 3840 and self.resources['bitness'] == 0:
             hap = 0
-        shadowmem = int(round(memory * 10 / 1024))
+        shadowmem = int(memory * self.overhead['shadow'] / 1024)
+        overcommit = self.resources['overcommit'] > 1
+        overhead = shadowmem + int(self.overhead['guest'])
+        charged = committed = memory + overhead
+        if hugepages:
+            # Hugepages are neither shared nor overcommitted
+            self.resources['hugepages'] -= memory
+            charged = committed = overhead
+        elif overcommit:
+            key = (self.resources['lastvendor'], test['ostype'])
+            if key in self.shared:
+                charged -= int(memory * pagesharing)
+            else:
+                self.shared.append(key)
         self.resources['cores'] -= cores
-        self.resources['memory'] -= (memory + shadowmem)
-        return {'cores': cores, 'memory': memory,
-                'shadowmem': shadowmem, 'hap': hap }
+        self.resources['memory'] -= charged
+        self.resources['commit'] -= committed
+        config = {'cores': cores, 'memory': memory,
+                  'shadowmem': shadowmem, 'hap': hap,
+                  'hugepages': int(hugepages), 'balloon': int(overcommit),
+                  'node': None, 'cpus': None}
+        if node != None:
+            node['cores'] -= cores
+            node['memory'] -= charged
+            config['node'] = node['id']
+            config['cpus'] = node['cpus']
+        return config
 
     def gen_macaddr(self, guestid):
         """Generate MAC address for guest NIC
@@ -388,7 +864,9 @@ class TestRunGenerator():
         """Generate a single test and its configuration
         """
         count = 0
-        while self.resources['memory'] >= 1024  and self.resources['cores'] > 0:
+        while (self.get_free_memory() >= 1024 or
+               self.resources['hugepages'] >= 1024) and \
+              self.resources['cores'] > 0:
             test = self.get_test()
             if test   == None and len(self.tests) == 0:
                 raise ValueError('Nothing to do.')
@@ -412,19 +890,71 @@ class TestRunGenerator():
             self.tests.append(test)
             count += 1
 
+    def set_build(self, build):
+        """Record the build of the test subject used by the test run
+
+        If the build differs from the last build of the test subject,
+        config.newbuildpolicy decides whether all its schedule entries,
+        only those of its short tests, or none are marked as not done.
+
+        Arguments:
+            build -- File name of the build
+        """
+        self.build = build
+        self.cursor.execute('''
+                SELECT last_build FROM subject WHERE subject_id=?''',
+                (self.subject['id'], ))
+        lastbuild = self.cursor.fetchone()[0]
+        if lastbuild == build:
+            return
+        query = 'UPDATE subject_schedule SET is_done=0 WHERE subject_id=?'
+        values = (self.subject['id'], )
+        if lastbuild != None and newbuildpolicy == 'restart':
+            self.set_done(query, values)
+        elif lastbuild != None and newbuildpolicy == 'fasttrack':
+            query += '''
+                    AND test_id IN (
+                        SELECT test_id FROM test WHERE runtime<=?)'''
+            self.set_done(query, values + (smokeruntime, ))
+        self.cursor.execute('''
+                UPDATE subject SET last_build=? WHERE subject_id=?''',
+                (build, self.subject['id']))
+        self.connection.commit()
+
     def do_finalize(self):
         """Set is_done flags for all tests used in the testrun
 
         This method must be called when all preparation steps succeeded.
-        It also resets the TestRunGenerator.tests attribute.
+        It also resets the TestRunGenerator.tests attribute. All other
+        tests not done yet age by one test run.
         """
         testids = tuple([test['id'] for test in self.tests])
         wildcards = ','.join(['?'] * len(testids))
-        query = 'UPDATE %s_schedule SET is_done=1 WHERE schedule_id IN (%s)'
+        idvalue = (self.subject['id'], )
+        if self.schedule == 'host':
+            idvalue = (self.host['id'], )
+        query = '''UPDATE %s_schedule SET age=age+1
+                WHERE %s_id=? AND is_done=0 AND schedule_id NOT IN (%s)'''
+        self.cursor.execute(query % (self.schedule, self.schedule, wildcards),
+                idvalue + testids)
+        query = 'UPDATE %s_schedule SET age=0 WHERE schedule_id IN (%s)'
         self.cursor.execute(query % (self.schedule, wildcards), testids)
+        query = 'UPDATE %s_schedule SET is_done=1 WHERE schedule_id IN (%s)'
+        self.set_done(query % (self.schedule, wildcards), testids)
         if self.schedule == 'subject':
             query = 'UPDATE host SET last_subject_id=? WHERE host_id=?'
             self.cursor.execute(query, (self.subject['id'], self.host['id']))
+            self.cursor.execute('''
+                    INSERT INTO subject_run
+                    (subject_id, host_id, build, started) VALUES (?,?,?,?)''',
+                    (self.subject['id'], self.host['id'], self.build,
+                     int(time.time())))
+            runid = self.cursor.lastrowid
+            self.cursor.executemany('''
+                    INSERT INTO subject_run_test (run_id, test_id, image_id)
+                    SELECT ?, test_id, image_id FROM subject_schedule
+                    WHERE schedule_id=?''',
+                    [(runid, testid) for testid in testids])
         self.connection.commit()
         self.tests = []
 
@@ -13,184 +13,840 @@ import os
 import sys
 import re
 import threading
+import copy
+import dbops
+import engine
 import generator
 import time
-from subprocess import Popen, PIPE, STDOUT
 from os.path import basename
 from checks import chk_hostname, chk_subject
 from config import kvm, svm, xlsh, formats, cfgscript, copyscript,  \
                    osimage, xencfgstore, nfshost, suiteimage,       \
                    builddir, buildarchs, buildpattern, imagepath,   \
-                   kvmcfgstore, grubtemplates, virtdirman
+                   kvmcfgstore, grubtemplates, virtdirman,          \
+                   overlaydir, overlayscript, reflinkscript,        \
+                   backingformats,                                  \
+                   overlaysh, overlaysvm, sizescript, peercopyscript, \
+                   preptimeouts, kvmreadyscript, xenreadyscript,   \
+                   kvmsetup, svmsetup, xlsetup, hostsetupfile,     \
+                   kvmdisk, kvmnic, numapin, kvmhugepages, hugepagescript, \
+                   kvmballoon, kvmksm, swapscript, stagedscript
 
 
-class BasePreparation(threading.Thread):
+def set_io_options(test):
+    """Add the KVM disk and network options of a guest to its test
+
+    Uses the fastest configuration the I/O capabilities of the guest image
+    allow: virtio for the system disk and the NIC, vhost-net for the tap
+    device, and the preferred disk cache and AIO modes. Guest images
+    without any of them keep the plain -hda/-hdb options. Tests of
+    checkpoints written before images had I/O capabilities are treated as
+    having none.
+    """
+    virtio = test.get('virtio', 0) == 1
+    cache = test.get('cache')
+    aio = test.get('aio')
+    if aio == 'native' and cache != 'none':
+        aio = None
+    options = ''
+    if cache != None:
+        options += ',cache=%s' % (cache, )
+    if aio != None:
+        options += ',aio=%s' % (aio, )
+    if virtio or options != '':
+        test['diskbus'] = virtio and 'virtio' or 'ide'
+        test['driveopts'] = options
+        test['kvmdisk'] = kvmdisk['drive'] % test
+    else:
+        test['kvmdisk'] = kvmdisk['legacy'] % test
+    test['nicopts'] = test['tapopts'] = ''
+    if virtio:
+        test['nicopts'] = ',model=virtio'
+        if test.get('vhost', 0) == 1:
+            test['tapopts'] = ',vhost=on'
+    test['kvmnic'] = kvmnic % test
+
+
+def get_xen_format(test):
+    """@return: Designation of the format of the guest image of a test as
+                used in SVM files
+
+    Raw images are accessed through blktap with native AIO, bypassing the
+    page cache of dom0, unless the image prefers cache mode writeback,
+    which the loopback file backend provides. The other cache and AIO
+    modes, virtio and vhost-net have no equivalent in SVM files and only
+    apply to KVM guests.
+    """
+    if test['format'] == 'raw' and test.get('cache') == 'writeback':
+        return formats['file']
+    return formats[test['format']]
+
+
+def set_numa_pinning(test):
+    """Add the binding of a guest to its NUMA node to its test
+
+    Guests without a node, including the tests of checkpoints written
+    before guests were bound to nodes, are not bound.
+    """
+    test['kvmpin'] = test['svmcpus'] = test['xlcpus'] = ''
+    if test.get('node') != None:
+        test['kvmpin'] = numapin['kvm'] % test
+        test['svmcpus'] = numapin['svm'] % test
+        test['xlcpus'] = numapin['xl'] % test
+
+
+def set_guest_options(test):
+    """Add the I/O, NUMA binding, hugepage, and memory overcommit options
+    of a guest to its test, as used by the guest configuration templates
+    and the host setup scripts
+    """
+    set_io_options(test)
+    set_numa_pinning(test)
+    test['kvmmem'] = test['kvmballoon'] = test['kvmksm'] = ''
+    if test.get('hugepages', 0) == 1:
+        test['kvmmem'] = kvmhugepages
+    if test.get('balloon', 0) == 1:
+        test['kvmballoon'] = kvmballoon
+        test['kvmksm'] = kvmksm
+
+
+class BasePreparation:
     """Base class to prepare a host for manual testing
+
+    Preparations are run by a preparation engine, which generates the
+    tests of all hosts first and then calls run() for every host.
+    A failure in the stage named by checkstage means the host does not
+    run the expected hypervisor.
+
+    The generated tests and every completed step of a guest are recorded
+    in a checkpoint. A resumed preparation reuses the tests of the
+    checkpoint and skips the steps completed before.
     """
 
-    def __init__(self, base, host):
-        threading.Thread.__init__(self)
+    cfgext = ''
+    cfgstage = ''
+    convert = False
+    checkstage = None
+    readyscript = None
+    setupscript = None
+
+    def __init__(self, base, host, overlay=False, resume=False,
+                 testrun=None):
         self.base = base
         self.host = host
-        self.testrun = None
+        self.overlay = overlay
+        self.resume = resume
+        self.checkpoints = None
+        self.done = []
+        self.testrun = testrun
         self.stage = ''
+        self.source = None
+        self.sizes = {}
+        self.stamps = {}
+        self.staging = {}
+        self.staged = []
+        self.processes = []
+        self.cancelled = False
+        self.booting = None
+        self.laststart = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
 
     def error_handler(self, reason):
-        """Print some details about a failing stage and exit thread
+        """Abort the preparation of the host in the current stage
+
+        The engine reports the failing stage and the reason.
+        """
+        raise RuntimeError(reason)
+
+    def generate(self):
+        """Generate the tests for the host and add the file names
+
+        If the preparation was given a test run, its tests are used as
+        they are and no checkpoint is recorded.
+        """
+        self.stage = 'Generating tests'
+        if self.testrun == None:
+            try:
+                self.host = chk_hostname(self.host)
+                self.checkpoints = dbops.Checkpoints()
+                if self.resume:
+                    checkpoint = self.checkpoints.load(self.host)
+                    if checkpoint == None:
+                        self.error_handler('No checkpoint to resume from.')
+                    self.overlay = bool(checkpoint['overlay'])
+                    self.done = checkpoint['steps']
+                    self.testrun = generator.TestRunGenerator(self.host,
+                            tests=yaml.safe_load(checkpoint['tests']))
+                else:
+                    self.testrun = generator.TestRunGenerator(self.host)
+                    tests = copy.deepcopy(self.testrun.tests)
+                    self.checkpoints.save(self.host, int(self.overlay),
+                            yaml.safe_dump(tests))
+            except ValueError, err:
+                self.error_handler(err[0])
+        for test in self.testrun.tests:
+            test['mntfile'] = '%(runid)03d-%(test)s.img' % test
+            test['imgbasename'] = basename(test['image'])
+            test['cfgext'] = self.cfgext
+            test['cfgfile'] = '%(datadir)s/%(runid)03d.%(cfgext)s' % test
+            test['hostsetup'] = '%s/%s' % (test['datadir'], hostsetupfile)
+            test['hostenv'] = '%(hostsetup)s.env' % test
+            test['basefmt'] = backingformats[test['format']]
+            if self.convert:
+                test['basefmt'] = 'raw'
+            set_guest_options(test)
+
+    def get_images(self):
+        """@return: A list of keys of the base images the host stages,
+                    consisting of the image filename and the conversion
+                    flag
+        """
+        images = [(suiteimage, False)]
+        for test in self.testrun.tests:
+            if (test['image'], self.convert) not in images:
+                images.append((test['image'], self.convert))
+        return images
+
+    def get_transfers(self):
+        """@return: A list of the filenames of the images to be copied
+                    onto the host, once for every copy
+        """
+        if self.overlay:
+            return [image for image, doconvert in self.get_images()]
+        images = []
+        for test in self.testrun.tests:
+            if 'suite %(runid)03d' % test not in self.done:
+                images.append(suiteimage)
+            if 'image %(runid)03d' % test not in self.done:
+                images.append(test['image'])
+        return images
+
+    def get_copy_timeout(self, image):
+        """@return: Timeout in seconds for copying or converting an image
+        """
+        megabytes = self.sizes.get(image, 0) / 1048576.0
+        return int(preptimeouts['copy'] +
+                   megabytes / preptimeouts['bandwidth'])
+
+    def cancel(self):
+        """Kill all commands running on the host and refuse new ones
+
+        Only the local processes of the executor are killed, the host kills
+        the commands at their timeout at the latest.
+        """
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            for process in self.processes:
+                if process.poll() == None:
+                    process.kill()
+        finally:
+            self.lock.release()
+        for event in self.staging.values():
+            event.set()
+
+    def enter_stage(self, stage):
+        """Set the stage of the steps run by the current thread
         """
-        sys.stderr.write(
-                'Preparation of host %s failed\n'
-                'Failing stage: %s\n'
-                'Reason:\n%s\n' % (self.host, self.stage, reason))
-        self.base.failed = 1
-        sys.exit(1)
+        self.local.stage = stage
 
-    def do_command(self, command):
-        """Execute commands through ssh on the host
+    def get_stage(self):
+        """@return: The stage of the current thread, or the stage of the
+                    host if the thread runs no steps
         """
-        process = Popen(['/usr/bin/ssh', '-o PasswordAuthentication=no',
-                'root@%s' % self.host, command], stderr=STDOUT, stdout=PIPE)
-        retval = process.wait()
+        return getattr(self.local, 'stage', self.stage)
+
+    def do_command(self, command, timeout=None, size=0, queued=0):
+        """Execute commands on the host through the executor of the engine
+        as soon as the engine permits it, and record them in the
+        preparation report
+
+        The command is killed if it does not finish within the timeout,
+        also on the host by the executor.
+        Arguments:
+            command -- Command to execute
+            timeout -- Timeout in seconds
+                       (optional, defaults to config.preptimeouts['default'])
+            size    -- Number of bytes the command moves (optional)
+            queued  -- Seconds waited before calling do_command (optional)
+        @return: Output of the command
+        """
+        if timeout == None:
+            timeout = preptimeouts['default']
+        waiting = time.time()
+        self.base.acquire_command(self.host)
+        started = time.time()
+        try:
+            self.lock.acquire()
+            try:
+                if self.cancelled:
+                    self.error_handler('Cancelled after another step failed')
+                process = self.base.executor.spawn(self.host, command,
+                        timeout)
+                self.processes.append(process)
+            finally:
+                self.lock.release()
+            try:
+                retval, output = engine.read_output(process, timeout)
+            finally:
+                self.lock.acquire()
+                self.processes.remove(process)
+                self.lock.release()
+        finally:
+            self.base.release_command(self.host)
+        status = retval
+        if self.cancelled:
+            status = 'cancelled'
+        elif retval == None:
+            status = 'timeout'
+        self.base.report.add_command(self.host, self.get_stage(), command,
+                started, time.time() - started, status, size,
+                queued + started - waiting)
+        if self.cancelled:
+            self.error_handler('Cancelled after another step failed')
+        if retval == None:
+            self.error_handler(engine.get_timeout_message(output, timeout))
         if retval != 0:
-            output = process.communicate()[0]
             if output in (None, ''):
                 output = 'Exited with error code %d' % (retval, )
             self.error_handler(output)
+        return output
+
+    def get_sizes(self, images):
+        """Determine the image source of the host and the sizes and stamps
+        of images on it
+
+        The stamp of an image consists of its size and its modification
+        time, and tells if a staged base image is still up to date.
+
+        Arguments:
+            images -- List of image filenames
+        """
+        self.stage = 'Determining image sizes'
+        unique = sorted(set(images))
+        output = self.do_command(sizescript % ((' '.join(unique), ) * 2))
+        output = output.split()
+        try:
+            self.source = output[0]
+            if len(output) < len(unique) + 1:
+                raise ValueError
+            for image, stamp in zip(unique, output[1:]):
+                self.sizes[image] = int(stamp.split(':')[0])
+                self.stamps[image] = stamp
+        except (IndexError, ValueError):
+            self.error_handler('Unexpected output:\n%s' % ('\n'.join(output)))
+
+    def plan_transfers(self, images):
+        """Determine the image source and the image sizes of the host
+        unless known already, and register the amount of bytes to copy with
+        the transfer scheduler
+
+        Arguments:
+            images -- List of image filenames to be copied onto the host
+        """
+        unknown = [image for image in images if not self.sizes.has_key(image)]
+        if len(unknown) != 0:
+            self.get_sizes(unknown)
+        total = sum([self.sizes[image] for image in images])
+        self.base.transfers.register(self.host, total)
+
+    def do_transfer(self, image, command):
+        """Execute a command copying an image onto the host as soon as
+        the transfer scheduler permits it
+
+        Arguments:
+            image   -- Filename of the image on the image source
+            command -- Command to copy the image
+        """
+        size = self.sizes[image]
+        waiting = time.time()
+        started = self.base.transfers.acquire(self.host, self.source, size)
+        try:
+            self.do_command(command, self.get_copy_timeout(image), size,
+                    started - waiting)
+        finally:
+            self.base.transfers.release(self.host, self.source, size)
+
+    def copy_suite_image(self, test):
+        """Copy the testsuite image of a guest
+        """
+        cpscript = copyscript % test
+        self.do_transfer(suiteimage,
+                cpscript % ((suiteimage, test['mntfile']) * 2))
+
+    def copy_guest_image(self, test):
+        """Copy the guest image of a guest
+
+        The guest image is converted to raw format after copying if the
+        hypervisor needs it.
+        """
+        cpscript = copyscript % test
+        self.do_transfer(test['image'],
+                cpscript % tuple([test['image']] * 4))
+        if self.convert:
+            self.do_command(
+                    'qemu-img convert -O raw %(datadir)s/%(image)s{,.tmp}'
+                    % test, self.get_copy_timeout(test['image']))
+            self.do_command('mv -f %(datadir)s/%(image)s{.tmp,}' % test)
+
+    def get_stamp(self, image, doconvert):
+        """@return: The stamp of a staged base image, consisting of the
+                    stamp of the image on the image source and the
+                    conversion flag
+        """
+        if doconvert:
+            return '%s:raw' % (self.stamps[image], )
+        return self.stamps[image]
+
+    def plan_staging(self, pool):
+        """Find the base images missing or outdated on the host and plan
+        their staging
+
+        The testsuite image and the guest images are staged into
+        config.overlaydir only if they are not staged there from an earlier
+        test run. A staged image whose stamp differs from the current size
+        and modification time of the image on the image source is staged
+        again. If images get distributed between hosts, missing images
+        are copied from other hosts that already staged them wherever the
+        distribution plan allows it.
+
+        Arguments:
+            pool -- Task pool of the host to add a task staging every
+                    missing image to
+        """
+        self.stage = 'Staging base images'
+        datadir = self.testrun.tests[0]['datadir']
+        basedir = '%s/%s' % (datadir, overlaydir)
+        output = self.do_command(stagedscript % (basedir, basedir))
+        staged = {}
+        for line in output.split('\n'):
+            if len(line.split()) == 2:
+                name, stamp = line.split()
+                staged[name] = stamp
+        images = [(suiteimage, suiteimage, False)]
+        for test in self.testrun.tests:
+            entry = (test['image'], test['imgbasename'], self.convert)
+            if entry not in images:
+                images.append(entry)
+        self.get_sizes([image for image, name, doconvert in images])
+        self.stage = 'Staging base images'
+        done = [(image, name, doconvert) for image, name, doconvert in images
+                if staged.get(name) == self.get_stamp(image, doconvert)]
+        images = [entry for entry in images if entry not in done]
+        self.staging = {}
+        self.staged = []
+        for image, name, doconvert in done:
+            self.staging[name] = threading.Event()
+            self.staging[name].set()
+            self.staged.append(name)
+        done = [(image, doconvert) for image, name, doconvert in done]
+        plan = self.base.distribution
+        if plan != None:
+            order = plan.start(self.host,
+                    [(image, doconvert) for image, name, doconvert in images],
+                    done)
+            images.sort(key=lambda entry: order.index((entry[0], entry[2])))
+        if len(images) != 0:
+            self.plan_transfers([entry[0] for entry in images])
+        for image, name, doconvert in images:
+            self.staging[name] = threading.Event()
+            pool.add([('Staging base images', self.stage_image,
+                       (basedir, image, name, doconvert))])
+
+    def stage_image(self, basedir, image, name, doconvert):
+        """Stage a base image from the image server or from another host
+
+        Arguments:
+            basedir   -- Directory holding the staged base images
+            image     -- Filename of the image on the image server
+            name      -- Filename of the staged image
+            doconvert -- Convert the staged image to raw format
+        """
+        cpscript = copyscript % {'datadir': self.testrun.tests[0]['datadir']}
+        basefile = '%s/%s' % (basedir, name)
+        tmpfile = '%s/%s.tmp' % (overlaydir, name)
+        plan = self.base.distribution
+        source = None
+        success = False
+        if plan != None:
+            source = plan.acquire(self.host, (image, doconvert))
+        try:
+            if source == None:
+                self.do_transfer(image, cpscript % ((image, tmpfile) * 2))
+                if doconvert:
+                    self.do_command(
+                            'qemu-img convert -O raw %s{.tmp,.raw} && '
+                            'mv -f %s{.raw,.tmp}' % (basefile, basefile),
+                            self.get_copy_timeout(image))
+            else:
+                self.do_command(peercopyscript %
+                        (source, basefile, '%s.tmp' % (basefile, )),
+                        self.get_copy_timeout(image), self.sizes.get(image, 0))
+            self.do_command('mv -f %s{.tmp,} && echo %s >%s.stamp' %
+                    (basefile, self.get_stamp(image, doconvert), basefile))
+            success = True
+            self.staged.append(name)
+        finally:
+            if plan != None:
+                plan.release(self.host, (image, doconvert), source, success)
+            self.staging[name].set()
+
+    def wait_for_images(self, test):
+        """Wait until the base images of a guest are staged
+        """
+        for name in (suiteimage, test['imgbasename']):
+            self.staging[name].wait()
+            if name not in self.staged:
+                self.error_handler('Base image %s was not staged' % (name, ))
+
+    def create_overlays(self, test):
+        """Create a reflinked copy of the staged testsuite image and a thin
+        qcow2 overlay on top of the staged guest image of a guest, using
+        the same filenames as fully copied images would have
+        """
+        basedir = '%s/%s' % (test['datadir'], overlaydir)
+        self.do_command(reflinkscript % (
+                '%s/%s' % (basedir, suiteimage),
+                '%(datadir)s/%(mntfile)s' % test))
+        self.do_command(overlayscript % (
+                '%s/%s' % (basedir, test['imgbasename']), test['basefmt'],
+                '%(datadir)s/%(imgbasename)s' % test))
+
+    def setup_host(self):
+        """Write and run the host setup script once for all guests
+        """
+        self.stage = 'Set up host'
+        if len(self.testrun.tests) == 0:
+            return
+        test = self.testrun.tests[0]
+        self.do_command((cfgscript % {'cfgfile': test['hostsetup']}) %
+                (self.setupscript % test, ))
+        self.do_command('/bin/bash %(hostsetup)s' % test,
+                preptimeouts['check'])
+
+    def get_swapped(self):
+        """@return: Number of pages swapped in and out on the host so far
+                    if its guests overcommit memory, otherwise None
+        """
+        if len([test for test in self.testrun.tests
+                if test.get('balloon', 0) == 1]) == 0:
+            return None
+        self.stage = 'Check swap activity'
+        output = self.do_command(swapscript, preptimeouts['check'])
+        try:
+            return int(output.split()[-1])
+        except (ValueError, IndexError):
+            return 0
+
+    def record_memory(self, swapped):
+        """Record the memory density of the host in the preparation report
+
+        Arguments:
+            swapped -- Result of get_swapped() before the guests were
+                       started
+        """
+        if swapped != None:
+            swapped = max(0, self.get_swapped() - swapped)
+        committed = sum([test['memory'] for test in self.testrun.tests])
+        self.base.report.add_memory(self.host, committed,
+                self.testrun.resources['physical'], swapped)
+
+    def configure_guest(self, test):
+        """Generate the configuration of a guest on the host
+        """
+        raise NotImplementedError
+
+    def start_guest(self, test):
+        """Start a guest on the host
+        """
+        raise NotImplementedError
+
+    def wait_until_ready(self, test):
+        """Wait until a started guest is ready, or until the boot timeout
+        of the engine expired
+
+        Returns:
+            True if the guest became ready
+        """
+        boot = self.base.boot
+        deadline = time.time() + boot['timeout']
+        while True:
+            output = self.do_command(self.readyscript % test,
+                    preptimeouts['check'])
+            if output.strip() == 'ready':
+                return True
+            if time.time() + boot['interval'] > deadline:
+                return False
+            time.sleep(boot['interval'])
+
+    def boot_guest(self, test):
+        """Start a guest as soon as fewer guests than permitted by the
+        engine are booting and the delay since the last start passed, and
+        wait until the guest is ready before starting the next one
+        """
+        self.booting.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                started = max(time.time(),
+                              self.laststart + self.base.boot['delay'])
+                self.laststart = started
+            finally:
+                self.lock.release()
+            time.sleep(max(0, started - time.time()))
+            self.start_guest(test)
+            ready = self.wait_until_ready(test)
+            self.base.report.add_guest(self.host, test['runid'], started,
+                    time.time() - started, ready)
+        finally:
+            self.booting.release()
+
+    def do_step(self, step, function, test):
+        """Run a step of a guest unless it was completed before, and record
+        it in the checkpoint
+
+        Arguments:
+            step     -- Name of the step
+            function -- Function taking the test of the guest
+            test     -- Test of the guest
+        """
+        name = '%s %03d' % (step, test['runid'])
+        if name in self.done:
+            return
+        function(test)
+        if self.checkpoints != None:
+            self.checkpoints.add_step(self.host, name)
+        self.done.append(name)
+
+    def get_started(self):
+        """@return: Number of guests started before the preparation was
+                    resumed
+        """
+        return len([step for step in self.done if step.startswith('start ')])
+
+    def finalize(self):
+        """Mark the tests as done and drop the checkpoint
+        """
+        self.stage = 'Marking tests as done'
+        self.testrun.do_finalize()
+        if self.checkpoints != None:
+            self.checkpoints.delete([self.host])
+
+    def start_guests(self):
+        """Prepare and start all guests
+
+        Every guest runs through its own pipeline of configuration, image
+        copies or overlays, and start, so that guests start as soon as
+        their own images are ready. The pipelines of several guests run at
+        the same time, but guests boot in waves to keep them from slowing
+        each other down. Base images are staged by tasks of the same pool,
+        in the order given by the distribution plan. The staging tasks are
+        taken first, so that guests only ever wait for images being staged
+        by another thread of the pool.
+        """
+        self.booting = threading.Semaphore(self.base.boot['parallel'])
+        pool = engine.TaskPool(self.base.limits['hostcommands'], self.cancel,
+                self.enter_stage)
+        if self.overlay:
+            self.plan_staging(pool)
+        else:
+            images = self.get_transfers()
+            if len(images) != 0:
+                self.plan_transfers(images)
+        for test in self.testrun.tests:
+            steps = [(self.cfgstage, self.do_step,
+                      ('config', self.configure_guest, test))]
+            if self.overlay:
+                steps.append(
+                        ('Staging base images', self.wait_for_images, (test, )))
+                steps.append(('Creating guest overlays', self.do_step,
+                              ('overlay', self.create_overlays, test)))
+            else:
+                steps.append(('Copying testsuite image files', self.do_step,
+                              ('suite', self.copy_suite_image, test)))
+                steps.append(('Copying guest image files', self.do_step,
+                              ('image', self.copy_guest_image, test)))
+            steps.append(('Starting guests', self.do_step,
+                          ('start', self.boot_guest, test)))
+            pool.add(steps)
+        pool.start()
+        if pool.join() != None:
+            self.stage, err = pool.failure
+            raise err
 
 
 class XenHostPreparation(BasePreparation):
     """Class to prepare a Xen host for manual testing
 
-    This class has to be run as a thread to allow the loading of
-    different hosts at the same time. As soon as the thread is
-    started it performs following actions:
+    This class has to be run by a preparation engine to allow the loading
+    of different hosts at the same time. After generating the tests it
+    performs following actions:
      * Checks the status of xend on the specified host
      * Checks for other guests that might still be running
-     * Wipes out old guest configuration files and images from the host
-     * Generates new guest configuration files on the host
-     * Copies guest images either through NFS or scp onto the host
-     * Starts all guests
+     * Wipes out old guest configuration files and images from the host,
+       unless a failed preparation is resumed
+     * Finds the Xen device model once for all guests
+     * For several guests at the same time, generates the guest
+       configuration file, copies the guest images either through NFS or
+       scp onto the host, or stages them once and creates copy-on-write
+       overlays, as permitted by the transfer scheduler shared by all
+       hosts, and starts the guest as soon as its images are ready
+     * Starts guests in waves, releasing the next guest once the domain
+       of a guest runs and it shows activity on its serial console or on
+       the network
      * Marks tests as done in the database
 
     Arguments:
-        base -- Reference to the calling class (used for error reporting)
-        host -- Name of the host to start the test run on
+        base    -- Reference to the preparation engine
+        host    -- Name of the host to start the test run on
+        overlay -- Start guests from overlays of staged base images
+        resume  -- Resume the preparation from the checkpoint of the host
+        testrun -- Test run to use instead of generating the tests
+                   (optional)
     """
 
-    def __init__(self, base, host):
-        BasePreparation.__init__(self, base, host)
+    cfgext = 'svm'
+    cfgstage = 'Generate guest configuration files'
+    checkstage = 'Check xend status'
+    readyscript = xenreadyscript
+    setupscript = svmsetup
+
+    def __init__(self, base, host, overlay=False, resume=False,
+                 testrun=None):
+        BasePreparation.__init__(self, base, host, overlay, resume, testrun)
+
+    def generate(self):
+        """Generate the tests for the host and set the image formats
+        """
+        BasePreparation.generate(self)
+        for test in self.testrun.tests:
+            test['format'] = get_xen_format(test)
+            if self.overlay:
+                test['format'] = formats['qcow2']
+
+    def configure_guest(self, test):
+        """Generate the configuration file of a guest
+        """
+        self.do_command((cfgscript % test) % ((svm % test), ))
+
+    def start_guest(self, test):
+        """Start a guest
+        """
+        self.do_command('/usr/sbin/xm create %(cfgfile)s' % test)
 
     def run(self):
         """Take all steps required to start all guests on the host
         """
-        self.stage = 'Generating tests'
-        try:
-            self.host = chk_hostname(self.host)
-            self.testrun = generator.TestRunGenerator(self.host)
-        except ValueError, err:
-            self.error_handler(err[0])
-        for test in self.testrun.tests:
-            test['mntfile'] = '%(runid)03d-%(test)s.img' % test
-            test['format'] = formats[test['format']]
-            test['imgbasename'] = basename(test['image'])
-            test['cfgext'] = 'svm'
-            test['cfgfile'] = '%(datadir)s/%(runid)03d.%(cfgext)s' % test
         self.stage = 'Check xend status'
-        self.do_command('/usr/sbin/xend status')
+        self.do_command('/usr/sbin/xend status', preptimeouts['check'])
         self.stage = 'Check for running guests'
-        self.do_command('test `/usr/sbin/xm list |wc -l` -eq 2')
-        self.stage = 'Cleanup old guest configs, images, and logs'
-        self.do_command(
-                '/bin/rm -f %s/*.{svm,img} /tmp/*.fifo' % (virtdirman, ))
-        self.stage = 'Generate guest configuration files'
-        for test in self.testrun.tests:
-            self.do_command((cfgscript % test) % ((svm % test), ))
-        self.stage = 'Copying testsuite image files'
-        for test in self.testrun.tests:
-            cpscript = copyscript % test
-            self.do_command(cpscript % ((suiteimage, test['mntfile']) * 2))
-        self.stage = 'Copying guest image files'
-        for test in self.testrun.tests:
-            cpscript = copyscript % test
-            self.do_command(cpscript % tuple([test['image']] * 4))
-        self.stage = 'Starting guests'
-        for test in self.testrun.tests:
-            self.do_command('/usr/sbin/xm create %(cfgfile)s' % test)
-        numguests = len(self.testrun.tests)
-        self.testrun.do_finalize()
-        sys.stdout.write(
-                '%s done. Number of guests started: %d\n' %
-                (self.host, numguests, ))
+        self.do_command('test `/usr/sbin/xm list |wc -l` -eq %d' %
+                (2 + self.get_started(), ), preptimeouts['check'])
+        if not self.resume:
+            self.stage = 'Cleanup old guest configs, images, and logs'
+            self.do_command(
+                    '/bin/rm -f %s/*.{svm,img} /tmp/*.fifo' % (virtdirman, ))
+        self.setup_host()
+        swapped = self.get_swapped()
+        self.start_guests()
+        self.record_memory(swapped)
+        self.finalize()
 
 
 class KvmHostPreparation(BasePreparation):
     """Class to prepare a KVM host for manual testing
 
-    This class has to be run as a thread to allow the loading of
-    different hosts at the same time. As soon as the thread is
-    started it performs following actions:
+    This class has to be run by a preparation engine to allow the loading
+    of different hosts at the same time. After generating the tests it
+    performs following actions:
      * Checks if kernel modules are loaded
      * Checks for other guests that might still be running
-     * Wipes out old guest images from the host
-     * Copies guest images either through NFS or scp onto the host
-     * Starts all guests
+     * Wipes out old guest images from the host, unless a failed
+       preparation is resumed
+     * Finds the KVM executable and loads the KVM modules once for all
+       guests
+     * Checks that enough hugepages are free for the guests backed by
+       hugepages
+     * For several guests at the same time, generates the guest start
+       script, copies the guest images either through NFS or scp onto the
+       host, or stages them once and creates copy-on-write overlays, as
+       permitted by the transfer scheduler shared by all hosts, and starts
+       the guest as soon as its images are ready
+     * Starts guests in waves, releasing the next guest once a guest
+       shows activity on its serial console or on the network
      * Marks tests as done in the database
 
     Arguments:
-        base -- Reference to the calling class (used for error reporting)
-        host -- Name of the host to start the test run on
+        base    -- Reference to the preparation engine
+        host    -- Name of the host to start the test run on
+        overlay -- Start guests from overlays of staged base images
+        resume  -- Resume the preparation from the checkpoint of the host
+        testrun -- Test run to use instead of generating the tests
+                   (optional)
     """
 
-    def __init__(self, base, host):
-        BasePreparation.__init__(self, base, host)
+    cfgext = 'sh'
+    cfgstage = 'Generate guest start scripts'
+    convert = True
+    checkstage = 'Check for kernel modules'
+    readyscript = kvmreadyscript
+    setupscript = kvmsetup
+
+    def __init__(self, base, host, overlay=False, resume=False,
+                 testrun=None):
+        BasePreparation.__init__(self, base, host, overlay, resume, testrun)
+
+    def check_hugepages(self):
+        """Make sure the host has enough free hugepages for the guests
+        backed by hugepages which are not started yet
+        """
+        self.stage = 'Check for free hugepages'
+        needed = sum([test['memory'] for test in self.testrun.tests
+                      if test.get('hugepages', 0) == 1 and
+                      'start %03d' % (test['runid'], ) not in self.done])
+        if needed == 0:
+            return
+        output = self.do_command(hugepagescript, preptimeouts['check'])
+        try:
+            free = int(output.split()[-1])
+        except (ValueError, IndexError):
+            free = 0
+        if free < needed:
+            self.error_handler('Only %d MB of hugepages are free, but the '
+                    'guests need %d MB.' % (free, needed))
+
+    def configure_guest(self, test):
+        """Generate the start script of a guest
+        """
+        self.do_command((cfgscript % test) % ((kvm % test), ))
+        self.do_command('chmod 755 %s' % (test['cfgfile'], ))
+
+    def start_guest(self, test):
+        """Start a guest
+        """
+        self.do_command(test['cfgfile'])
 
     def run(self):
         """Take all steps required to start all guests on the host
         """
-        self.stage = 'Generating tests'
-        try:
-            self.host = chk_hostname(self.host)
-            self.testrun = generator.TestRunGenerator(self.host)
-        except ValueError, err:
-            self.error_handler(err[0])
-        for test in self.testrun.tests:
-            test['mntfile'] = '%(runid)03d-%(test)s.img' % test
-            test['imgbasename'] = basename(test['image'])
-            test['cfgext'] = 'sh'
-            test['cfgfile'] = '%(datadir)s/%(runid)03d.%(cfgext)s' % test
         self.stage = 'Check for kernel modules'
         self.do_command('/sbin/modprobe kvm kvm-amd kvm-intel && '
-                '/sbin/lsmod | /bin/grep -q "^kvm "')
+                '/sbin/lsmod | /bin/grep -q "^kvm "', preptimeouts['check'])
         self.stage = 'Check for running guests'
         self.do_command(
-                'test `ps -C qemu-kvm -C qemu-system-x86_64 | wc -l` -eq 1')
-        self.stage = 'Cleanup old guest configs, images, and logs'
-        self.do_command(
-                '/bin/rm -f %s/*.{sh,img} /tmp/*.fifo' % (virtdirman, ))
-        self.stage = 'Generate guest start scripts'
-        for test in self.testrun.tests:
-            self.do_command((cfgscript % test) % ((kvm % test), ))
-            self.do_command('chmod 755 %s' % (test['cfgfile'], ))
-        self.stage = 'Copying testsuite image files'
-        for test in self.testrun.tests:
-            cpscript = copyscript % test
-            self.do_command(cpscript % ((suiteimage, test['mntfile']) * 2))
-        self.stage = 'Copying guest image files'
-        for test in self.testrun.tests:
-            cpscript = copyscript % test
-            self.do_command(cpscript % tuple([test['image']] * 4))
+                'test `ps -C qemu-kvm -C qemu-system-x86_64 | wc -l` -eq %d'
+                % (1 + self.get_started(), ), preptimeouts['check'])
+        if not self.resume:
+            self.stage = 'Cleanup old guest configs, images, and logs'
             self.do_command(
-                    'qemu-img convert -O raw %(datadir)s/%(image)s{,.tmp}'
-                    % test)
-            self.do_command('mv -f %(datadir)s/%(image)s{.tmp,}' % test)
-        self.stage = 'Starting guests'
-        for test in self.testrun.tests:
-            self.do_command(test['cfgfile'])
-        numguests = len(self.testrun.tests)
-        self.testrun.do_finalize()
-        sys.stdout.write(
-                '%s done. Number of guests started: %d\n' %
-                (self.host, numguests, ))
+                    '/bin/rm -f %s/*.{sh,img} /tmp/*.fifo' % (virtdirman, ))
+        self.setup_host()
+        self.check_hugepages()
+        swapped = self.get_swapped()
+        self.start_guests()
+        self.record_memory(swapped)
+        self.finalize()
 
 
 class SubjectPreparation():
@@ -202,7 +858,7 @@ class SubjectPreparation():
     in YAML format to STDOUT.
     """
 
-    def __init__(self, host, subject=False, bitness=False):
+    def __init__(self, host, subject=False, bitness=False, overlay=False):
         """
         @param host   : Name of the test machine
         @type  host   : str
@@ -210,10 +866,25 @@ class SubjectPreparation():
         @type  subject: str
         @param bitness: Bitness of the test subject (optional)
         @type  bitness: int
+        @param overlay: Start guests from overlays of unpacked base images
+        @type  overlay: bool
         """
         self.host = chk_hostname(host)
+        health = dbops.Hosts().get_health([self.host]).get(self.host)
+        if health != None and health['state'] == 'open':
+            raise ValueError('Host %s failed %d times in a row and is '
+                    'skipped until %s.\nLast error:\n%s' % (self.host,
+                    health['failures'], time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.localtime(health['cooldown'])), health['error']))
         self.testrun = generator.TestRunGenerator(
-                self.host, True, subject, bitness)
+                self.host, True, subject, bitness, tests=[])
+        self.build = None
+        if self.testrun.subject['name'].startswith('xen'):
+            self.build = self.get_latest_build()
+            self.testrun.set_build(basename(self.build))
+        self.testrun.gen_tests()
+        self.overlay = overlay
+        self.hostsetup = None
         self.dry_mode = 0
 
     def get_latest_build(self):
@@ -261,10 +932,16 @@ class SubjectPreparation():
         if filename.endswith('.sh'):
             os.chmod(filename, 0755)
 
-    def __gen_precondition_guest(self, test):
+    def __gen_precondition_guest(self, test, unpack=True):
         """
         Generate the Tapper precondition for a single guest
 
+        @param test  : Test of the guest
+        @type  test  : dict
+        @param unpack: Unpack the guest image, otherwise it was unpacked
+                       into config.overlaydir for another guest already
+                       and the root precondition does nothing
+        @type  unpack: bool
         @return: Guest precondition
         @rtype : dict
         """
@@ -287,6 +964,13 @@ class SubjectPreparation():
             'mounttype':         'raw',
             'target_directory':  test['datadir'],
         }
+        if self.overlay:
+            root['target_directory'] = '%s/%s' % (test['datadir'], overlaydir)
+        if not unpack:
+            root['precondition_type'] = 'exec'
+            root['filename'] = '/bin/true'
+            del root['url']
+            del root['target_directory']
         parselogs = {
             'execname':            '/opt/tapper/bin/py_parselog',
             'timeout_testprogram': 200,
@@ -339,40 +1023,87 @@ class SubjectPreparation():
             cfgtype     -- Type of the guest config file      (exec|svm)
             cfgfilesrc  -- Location of the guest config file  (string)
                            on the Tapper server
+            basefile    -- Unpacked base image of the guest   (string)
+                           (only when starting from overlays)
+            basefmt     -- Format of the unpacked base image  (string)
+            hostsetup   -- Host setup script on the host      (string)
+            hostenv     -- Environment file written by the    (string)
+                           host setup script
+
+        With overlays enabled, every guest image gets unpacked into
+        config.overlaydir once, by the first guest using it, and the guest
+        configuration creates a thin qcow2 overlay on top of it before the
+        guest is started.
 
+        The host setup script is written once for all guests into the same
+        directory, and its precondition is kept in self.hostsetup. Tapper
+        copies it onto the host before the host boots, and the first guest
+        starting runs it before any guest starts (see config.setupstep).
         Finally, the precondition for each guest is generated.
 
         @return: Guest preconditions
         @rtype : list
         """
         guests = []
+        unpacked = []
+        if len(self.testrun.tests) == 0:
+            return guests
         timestamp = time.mktime(time.gmtime())
         subject = self.testrun.subject['name']
+        xl = re.search("^xen-unstable|xen-4.2", subject) != None
+        if xl:
+            cfgext, cfgtype, cfgstore = 'sh', 'exec', xencfgstore
+            template, setupscript = xlsh, xlsetup
+        elif re.search('^xen|autoinstall-xen', subject):
+            cfgext, cfgtype, cfgstore = 'svm', 'svm', xencfgstore
+            template, setupscript = svm, svmsetup
+        elif re.search('^autoinstall-kvm', subject):
+            cfgext, cfgtype, cfgstore = 'sh', 'exec', kvmcfgstore
+            template, setupscript = kvm, kvmsetup
+        else:
+            raise ValueError('Invalid test subject "%s".' % (subject, ))
+        setupfile = '%s-%ld-setup.sh' % (self.host, timestamp)
         for test in self.testrun.tests:
             prefix = '%03d-%s-%ld' % (test['runid'], self.host, timestamp)
             test['mntfile'] = '%s.img' % (prefix, )
-            test['format'] = formats[test['format']]
+            test['basefmt'] = backingformats[test['format']]
+            test['format'] = get_xen_format(test)
             test['imgbasename'] = basename(test['image'])
-            if re.search("^xen-unstable|xen-4.2", subject):
+            test['hostsetup'] = '%s/%s' % (test['datadir'], setupfile)
+            test['hostenv'] = '%(hostsetup)s.env' % test
+            if self.overlay:
+                test['format'] = formats['qcow2']
+                test['basefile'] = '%s/%s/%s' % (
+                        test['datadir'], overlaydir, test['imgbasename'])
+            if xl:
                 test['format'] = "raw"
-                test['cfgfile'] = '%s.sh' % (prefix, )
-                test['cfgfilesrc'] = '%s/%s' % (xencfgstore, test['cfgfile'])
-                test['cfgtype'] = 'exec'
-                configfile = xlsh % test
-            elif re.search('^xen|autoinstall-xen', subject):
-                test['cfgfile'] = '%s.svm' % (prefix, )
-                test['cfgfilesrc'] = '%s/%s' % (xencfgstore, test['cfgfile'])
-                test['cfgtype'] = 'svm'
-                configfile = svm % test
-            elif re.search('^autoinstall-kvm', subject):
-                test['cfgfile'] = '%s.sh' % (prefix, )
-                test['cfgfilesrc'] = '%s/%s' % (kvmcfgstore, test['cfgfile'])
-                test['cfgtype'] = 'exec'
-                configfile = kvm % test
-            else:
-                raise ValueError('Invalid test subject "%s".' % (subject, ))
+                if self.overlay:
+                    test['format'] = "qcow2"
+            test['cfgfile'] = '%s.%s' % (prefix, cfgext)
+            test['cfgfilesrc'] = '%s/%s' % (cfgstore, test['cfgfile'])
+            test['cfgtype'] = cfgtype
+            set_guest_options(test)
+            configfile = template % test
+            if self.hostsetup == None:
+                setupsrc = '%s/%s' % (cfgstore, setupfile)
+                self.__write_guest_configfile(setupsrc, setupscript % test)
+                self.hostsetup = {
+                    'precondition_type': 'copyfile',
+                    'protocol':          'nfs',
+                    'name':              '%s:%s' % (nfshost, setupsrc),
+                    'dest':              test['datadir'],
+                }
+            if self.overlay and test['cfgtype'] == 'exec':
+                shebang, path, script = configfile.split('\n', 2)
+                configfile = '%s\n%s\n%s%s' % (
+                        shebang, path, overlaysh % test, script)
+            elif self.overlay:
+                configfile = (overlaysvm % test) + configfile
             self.__write_guest_configfile(test['cfgfilesrc'], configfile)
-            guests.append(self.__gen_precondition_guest(test))
+            guests.append(self.__gen_precondition_guest(test,
+                    test['image'] not in unpacked))
+            if self.overlay:
+                unpacked.append(test['image'])
         return guests
 
     def gen_precondition_autoinstall(self):
@@ -429,6 +1160,8 @@ class SubjectPreparation():
             'root':             root,
             'testprogram_list': testprogramlist,
         }
+        if self.hostsetup != None:
+            host['preconditions'] = [self.hostsetup, ]
         precondition = {
             'precondition_type': 'virt',
             'name':              name,
@@ -444,7 +1177,7 @@ class SubjectPreparation():
         @return: Tapper autoinstall precondition
         @rtype : dict
         """
-        xenbuild = self.get_latest_build()
+        xenbuild = self.build
         guests = self.gen_guest_configs()
         xenpkg = {
             'precondition_type': 'package',
@@ -486,6 +1219,8 @@ class SubjectPreparation():
             'runtime':             50,
         }
         preconditions = [xenpkg, instpkg, inst, firmware, ]
+        if self.hostsetup != None:
+            preconditions.append(self.hostsetup)
         testprogramlist = [metainfo, xen_core_pair,]
         root = {
             'precondition_type': 'image',
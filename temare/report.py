@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 expandtab smarttab
+"""Module to record the timing of hosts prepared at the same time
+"""
+import os
+import json
+import threading
+
+
+class PreparationReport:
+    """Report of the timing of all stages and commands of a preparation run
+
+    Every remote command is recorded with its host, stage, start time,
+    duration, the number of bytes it moved, the time it waited for the
+    transfer scheduler and the engine, and its exit status ('timeout' or
+    'cancelled' for killed commands). As soon as a host is finished, one
+    record per stage of the host follows, spanning from the start of its
+    first to the end of its last command, and one record for the host.
+    The boot of every guest is recorded with the time it took the guest to
+    become ready. Once all guests of a host are started, the memory
+    committed to them is recorded with the physical memory of the host
+    and, on hosts overcommitting memory, the pages swapped meanwhile.
+
+    Records are dictionaries with a type of 'command', 'stage', 'host',
+    'guest' or 'memory' and are written as JSON lines if a filename is
+    given.
+
+    Arguments:
+        filename -- Name of the file to write the records to (optional)
+    """
+
+    def __init__(self, filename=None):
+        self.lock = threading.Lock()
+        self.output = None
+        self.commands = {}
+        self.stages = []
+        self.hosts = []
+        self.guests = []
+        self.memory = []
+        if filename != None:
+            try:
+                directory = os.path.dirname(filename)
+                if directory != '' and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.output = open(filename, 'w')
+            except (IOError, OSError), err:
+                raise ValueError('Cannot write report file %s:\n%s' %
+                        (filename, err.strerror))
+
+    def __write(self, record):
+        """Write a record to the report file, if there is one
+        """
+        if self.output != None:
+            self.output.write('%s\n' % (json.dumps(record, sort_keys=True), ))
+            self.output.flush()
+
+    def add_command(self, host, stage, command, started, duration, status,
+                    size=0, queued=0):
+        """Record a finished remote command
+
+        Arguments:
+            host     -- Name of the host
+            stage    -- Stage the command belongs to
+            command  -- Command line (only the first line is recorded)
+            started  -- Start time of the command
+            duration -- Duration of the command in seconds
+            status   -- Exit code, 'timeout', or 'cancelled'
+            size     -- Number of bytes moved by the command
+            queued   -- Seconds waited before the command could start
+        """
+        record = {'type': 'command', 'host': host, 'stage': stage,
+                  'command': command.split('\n')[0][:200],
+                  'start': started, 'duration': duration, 'bytes': size,
+                  'queued': queued, 'status': status}
+        self.lock.acquire()
+        try:
+            self.commands.setdefault(host, []).append(record)
+            self.__write(record)
+        finally:
+            self.lock.release()
+
+    def add_guest(self, host, runid, started, duration, ready):
+        """Record the boot of a guest
+
+        Arguments:
+            host     -- Name of the host
+            runid    -- Run ID of the guest
+            started  -- Time the guest was started
+            duration -- Seconds until the guest was ready, or until the
+                        readiness checks gave up
+            ready    -- Whether the guest became ready
+        """
+        record = {'type': 'guest', 'host': host, 'runid': runid,
+                  'start': started, 'duration': duration, 'ready': ready}
+        self.lock.acquire()
+        try:
+            self.guests.append(record)
+            self.__write(record)
+        finally:
+            self.lock.release()
+
+    def add_memory(self, host, committed, physical, swapped=None):
+        """Record the memory density of a host
+
+        Arguments:
+            host      -- Name of the host
+            committed -- MB of memory committed to the guests
+            physical  -- MB of physical memory of the host
+            swapped   -- Pages swapped in and out while the guests were
+                         started, None if the host does not overcommit
+        """
+        record = {'type': 'memory', 'host': host, 'committed': committed,
+                  'physical': physical,
+                  'density': float(committed) / max(physical, 1),
+                  'swapped': swapped}
+        self.lock.acquire()
+        try:
+            self.memory.append(record)
+            self.__write(record)
+        finally:
+            self.lock.release()
+
+    def add_host(self, host, status, started, duration, guests):
+        """Record a finished host and the stages it went through
+
+        Arguments:
+            host     -- Name of the host
+            status   -- 'done' or 'failed'
+            started  -- Start time of the preparation, or None
+            duration -- Duration of the preparation in seconds
+            guests   -- Number of guests started
+        """
+        self.lock.acquire()
+        try:
+            stages = {}
+            order = []
+            for command in self.commands.get(host, []):
+                end = command['start'] + command['duration']
+                if not stages.has_key(command['stage']):
+                    order.append(command['stage'])
+                    stages[command['stage']] = {
+                            'type': 'stage', 'host': host,
+                            'stage': command['stage'],
+                            'start': command['start'], 'end': end,
+                            'commands': 0, 'bytes': 0}
+                stage = stages[command['stage']]
+                stage['start'] = min(stage['start'], command['start'])
+                stage['end'] = max(stage['end'], end)
+                stage['commands'] += 1
+                stage['bytes'] += command['bytes']
+            for name in order:
+                stage = stages[name]
+                stage['duration'] = stage['end'] - stage['start']
+                del stage['end']
+                self.stages.append(stage)
+                self.__write(stage)
+            record = {'type': 'host', 'host': host, 'status': status,
+                      'start': started, 'duration': duration,
+                      'guests': guests}
+            self.hosts.append(record)
+            self.__write(record)
+        finally:
+            self.lock.release()
+
+    def get_stages(self, host):
+        """@return: A list of tuples of the name, duration and bytes moved
+                    of every stage of a finished host
+        """
+        return [(record['stage'], record['duration'], record['bytes'])
+                for record in self.stages if record['host'] == host]
+
+    def get_bytes(self):
+        """@return: Number of bytes moved by the commands of all finished
+                    hosts
+        """
+        return sum([record['bytes'] for record in self.stages])
+
+    def get_summary(self, count=5):
+        """@return: A list of lines with the boot times of the guests, the
+                    memory density of the hosts, and tables of the slowest
+                    hosts and the stages taking the most time over all
+                    hosts
+        """
+        if len(self.hosts) == 0:
+            return []
+        lines = []
+        if len(self.guests) != 0:
+            durations = [record['duration'] for record in self.guests]
+            lines.append('Guest boots: %d guests, %.1f s on average, '
+                    '%.1f s at most, %d not ready' % (len(durations),
+                    sum(durations) / len(durations), max(durations),
+                    len([record for record in self.guests
+                         if not record['ready']])))
+        if len(self.memory) != 0:
+            densities = [record['density'] for record in self.memory]
+            swapping = [record for record in self.memory
+                        if record['swapped'] != None]
+            lines.append('Memory density: %.2f on average, %.2f at most, '
+                    '%d of %d overcommitted hosts swapped' % (
+                    sum(densities) / len(densities), max(densities),
+                    len([record for record in swapping
+                         if record['swapped'] > 0]), len(swapping)))
+        lines += ['Slowest hosts:',
+                 '    %-32s %10s %8s %7s' %
+                 ('Host', 'Duration', 'Status', 'Guests')]
+        hosts = sorted(self.hosts, key=lambda record: -record['duration'])
+        for record in hosts[:count]:
+            lines.append('    %-32s %9.1fs %8s %7d' % (record['host'],
+                    record['duration'], record['status'], record['guests']))
+        totals = {}
+        for record in self.stages:
+            total = totals.setdefault(record['stage'],
+                    {'hosts': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0})
+            total['hosts'] += 1
+            total['total'] += record['duration']
+            total['max'] = max(total['max'], record['duration'])
+            total['bytes'] += record['bytes']
+        if len(totals) != 0:
+            lines.append('Slowest stages:')
+            lines.append('    %-44s %5s %10s %10s %10s' %
+                    ('Stage', 'Hosts', 'Total', 'Max', 'MB'))
+            stages = sorted(totals.keys(), key=lambda name:
+                    -totals[name]['total'])
+            for name in stages[:count]:
+                total = totals[name]
+                lines.append('    %-44s %5d %9.1fs %9.1fs %10.1f' % (name,
+                        total['hosts'], total['total'], total['max'],
+                        total['bytes'] / 1048576.0))
+        return lines
+
+    def close(self):
+        """Close the report file
+        """
+        if self.output != None:
+            self.output.close()
+            self.output = None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 expandtab smarttab
+"""Module to schedule image transfers of hosts prepared at the same time
+"""
+import heapq
+import threading
+import time
+from config import transferlimits
+
+
+class TokenBucket:
+    """Token bucket limiting the amount of bytes started per second
+
+    Transfers larger than the bucket capacity only need a full bucket to
+    start and leave a debt behind, which delays the following transfers
+    until it is paid off. The long term rate stays within the limit.
+
+    Arguments:
+        rate  -- Number of bytes added to the bucket per second
+        burst -- Capacity of the bucket in bytes
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def refill(self):
+        """Add the tokens accumulated since the last refill
+        """
+        now = time.time()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def get_delay(self, amount):
+        """@return: Seconds to wait until a transfer of the given size
+                    may start
+        """
+        self.refill()
+        needed = min(float(amount), self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, amount):
+        """Take the tokens for a transfer of the given size
+        """
+        self.refill()
+        self.tokens -= amount
+
+
+class TransferScheduler:
+    """Scheduler for image transfers shared by all preparation threads
+
+    Every image source gets a limit of concurrent transfers and a
+    bandwidth budget, as defined in config.transferlimits. Sources without
+    an entry of their own get the limits of the 'default' entry. Waiting
+    transfers of hosts with the least remaining bytes to copy are started
+    first, so that hosts finish their preparation as early as possible.
+
+    Arguments:
+        limits -- Dictionary of image sources and tuples of the number of
+                  concurrent transfers and the bandwidth in MB/s
+                  (optional, defaults to config.transferlimits)
+    """
+
+    def __init__(self, limits=None):
+        if limits == None:
+            limits = transferlimits
+        self.condition = threading.Condition()
+        self.sources = {}
+        self.remaining = {}
+        self.sequence = 0
+        self.default = limits.get('default', transferlimits['default'])
+        for source, (concurrency, bandwidth) in limits.iteritems():
+            if source != 'default':
+                self.add_source(source, concurrency, bandwidth)
+
+    def add_source(self, source, concurrency, bandwidth):
+        """Add an image source and its limits
+
+        Arguments:
+            source      -- Name of the image source
+            concurrency -- Number of concurrent transfers
+            bandwidth   -- Bandwidth budget in MB/s
+        """
+        rate = bandwidth * 1024 * 1024
+        self.sources[source] = {
+                'limit':   concurrency,
+                'active':  0,
+                'waiting': [],
+                'bucket':  TokenBucket(rate, rate),
+                'count':   0,
+                'bytes':   0,
+                'first':   None,
+                'last':    None}
+
+    def register(self, host, size):
+        """Register the amount of bytes a host is going to transfer
+        """
+        self.condition.acquire()
+        try:
+            self.remaining[host] = self.remaining.get(host, 0) + size
+        finally:
+            self.condition.release()
+
+    def acquire(self, host, source, size):
+        """Wait until a transfer of a host may start
+
+        Arguments:
+            host   -- Name of the host the transfer is going to
+            source -- Name of the image source
+            size   -- Size of the image in bytes
+        Returns:
+            The start time of the transfer
+        """
+        self.condition.acquire()
+        try:
+            if not self.sources.has_key(source):
+                self.add_source(source, *self.default)
+            state = self.sources[source]
+            self.sequence += 1
+            ticket = (self.remaining.get(host, 0), self.sequence, host)
+            heapq.heappush(state['waiting'], ticket)
+            while True:
+                if (state['waiting'][0] == ticket and
+                        state['active'] < state['limit']):
+                    delay = state['bucket'].get_delay(size)
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            heapq.heappop(state['waiting'])
+            state['active'] += 1
+            state['bucket'].consume(size)
+            started = time.time()
+            if state['first'] == None:
+                state['first'] = started
+            self.condition.notifyAll()
+            return started
+        finally:
+            self.condition.release()
+
+    def release(self, host, source, size):
+        """Mark a transfer of a host as finished
+
+        Arguments:
+            host   -- Name of the host the transfer went to
+            source -- Name of the image source
+            size   -- Size of the image in bytes
+        """
+        self.condition.acquire()
+        try:
+            state = self.sources[source]
+            state['active'] -= 1
+            state['count'] += 1
+            state['bytes'] += size
+            state['last'] = time.time()
+            self.remaining[host] = max(0, self.remaining.get(host, 0) - size)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get_summary(self):
+        """@return: A list of lines describing the aggregate throughput
+                    of every image source used
+        """
+        lines = []
+        for source in sorted(self.sources.keys()):
+            state = self.sources[source]
+            if state['count'] == 0:
+                continue
+            duration = max(state['last'] - state['first'], 0.001)
+            megabytes = state['bytes'] / 1048576.0
+            lines.append(
+                    'Transfers from %s: %d images, %.1f MB in %.0f s '
+                    '(%.1f MB/s)' % (source, state['count'], megabytes,
+                    duration, megabytes / duration))
+        return lines
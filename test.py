@@ -3,6 +3,19 @@ import os
 os.environ['HARNESS_ACTIVE'] = '1'
 os.system('cp t/orig-db t/test-schedule.db')
 from temare import preparation
+from temare import dbops
+from temare import transfer
+from temare import distribution
+from temare import engine
+from temare import report
+from temare import executor
+from temare import generator
+import threading
+import time
+import subprocess
+import json
+import shutil
+import tempfile
 import pprint
 import random
 import re
@@ -59,6 +72,941 @@ class TestPreparation(unittest.TestCase):
 
 
 
+class TestGuestPreparation(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        dbops.Hosts().memory(['bullock', '8192'])
+        dbops.Hosts().cores(['bullock', '4'])
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_overlaypreparation(self):
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1, True)
+        precondition = prep.gen_precondition_xen()
+        test = prep.testrun.tests[0]
+        self.assertTrue(precondition['guests'][0]['root']['target_directory'] == '/virt/base')
+        self.assertTrue(test['format'] == 'qcow2')
+        configfile = open(test['cfgfilesrc']).read()
+        self.assertTrue('backing_file=/virt/base/%s' % test['imgbasename'] in configfile)
+        self.assertTrue('backing_fmt=%s' % test['basefmt'] in configfile)
+
+    def test_overlay_unpack_once(self):
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1, True)
+        tests = prep.testrun.tests
+        tests.append(dict(tests[0]))
+        tests[-1]['runid'] = len(tests)
+        precondition = prep.gen_precondition_xen()
+        roots = [guest['root'] for guest in precondition['guests']]
+        self.assertTrue(roots[0]['precondition_type'] == 'package')
+        self.assertTrue(roots[-1]['precondition_type'] == 'exec')
+        self.assertTrue(roots[-1]['mountfile'] ==
+                '%(datadir)s/%(mntfile)s' % tests[-1])
+
+    def test_host_setup(self):
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1)
+        precondition = prep.gen_precondition_xen()
+        setups = [entry for entry in precondition['host']['preconditions']
+                  if entry['precondition_type'] == 'copyfile']
+        self.assertTrue(len(setups) == 1)
+        setupfile = setups[0]['name'].split(':', 1)[1]
+        self.assertTrue('sleep 4' in open(setupfile).read())
+        for test in prep.testrun.tests:
+            configfile = open(test['cfgfilesrc']).read()
+            self.assertTrue('sleep 4' not in configfile)
+            self.assertTrue('. %(hostenv)s\n' % test in configfile)
+            self.assertTrue('flock %(hostsetup)s.lock' % test in configfile)
+            self.assertTrue(test['hostsetup'].endswith(
+                    os.path.basename(setupfile)))
+
+    def test_numa_pinning(self):
+        dbops.Hosts().nodes(['bullock', '2'])
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1)
+        prep.gen_precondition_xen()
+        self.assertTrue(len(prep.testrun.tests) != 0)
+        used = {0: 0, 1: 0}
+        for test in prep.testrun.tests:
+            configfile = open(test['cfgfilesrc']).read()
+            if test['node'] == None:
+                # Guests not fitting into a node any more stay unbound
+                self.assertTrue('cpus=' not in configfile)
+                continue
+            self.assertTrue(test['cpus'] == ('0-1', '2-3')[test['node']])
+            used[test['node']] += test['cores']
+            self.assertTrue('cpus="%(cpus)s"\n' % test in configfile)
+        self.assertTrue(prep.testrun.tests[0]['node'] != None)
+        self.assertTrue(max(used.values()) <= 2)
+
+    def test_numa_cpulists(self):
+        self.assertRaises(ValueError, dbops.Hosts().nodes,
+                ['bullock', '0-1,x/2'])
+        self.assertRaises(ValueError, dbops.Hosts().nodes,
+                ['bullock', '3-1/4'])
+        self.assertRaises(ValueError, dbops.Hosts().nodes,
+                ['bullock', '0-1/2-5'])
+        dbops.Hosts().nodes(['bullock', '0,2/1,3'])
+        testrun = generator.TestRunGenerator('bullock')
+        self.assertTrue([node['cpus'] for node in testrun.nodes] ==
+                        ['0,2', '1,3'])
+        for test in testrun.tests:
+            if test['node'] != None:
+                self.assertTrue(test['cpus'] == ('0,2', '1,3')[test['node']])
+
+    def test_numa_nodes_above_cores(self):
+        hostops = dbops.Hosts()
+        self.assertRaises(ValueError, hostops.nodes, ['bullock', '5'])
+        hostops.nodes(['bullock', '4'])
+        hostops.cores(['bullock', '2'])
+        testrun = generator.TestRunGenerator('bullock')
+        self.assertTrue([node['cpus'] for node in testrun.nodes] ==
+                        ['0-0', '1-1'])
+        for test in testrun.tests:
+            self.assertTrue(test['node'] in (None, 0, 1))
+
+    def test_io_options(self):
+        test = {'datadir': '/virt', 'imgbasename': 'guest.img',
+                'mntfile': '001-test.img', 'macaddr': '52:54:00:00:00:01',
+                'vnc': 0}
+        preparation.set_io_options(test)
+        self.assertTrue(test['kvmdisk'].startswith('-hda /virt/guest.img '))
+        self.assertTrue(test['kvmnic'] ==
+                '-net nic,macaddr=52:54:00:00:00:01 -net tap,ifname=tap0')
+        test.update({'virtio': 1, 'vhost': 1, 'cache': 'writeback',
+                     'aio': 'native'})
+        preparation.set_io_options(test)
+        self.assertTrue('file=/virt/guest.img,if=virtio,index=0,media=disk,'
+                'cache=writeback -drive' in test['kvmdisk'])
+        self.assertTrue(',if=ide,index=1,' in test['kvmdisk'])
+        self.assertTrue('model=virtio' in test['kvmnic'])
+        self.assertTrue(test['kvmnic'].endswith(',vhost=on'))
+        test['cache'] = 'none'
+        preparation.set_io_options(test)
+        self.assertTrue(test['kvmdisk'].endswith(',cache=none,aio=native'))
+        self.assertRaises(ValueError, dbops.Images().cache,
+                ['nosuchimage.img', 'unsafe'])
+        test['format'] = 'raw'
+        self.assertTrue(preparation.get_xen_format(test) == 'tap:aio')
+        test['cache'] = 'writeback'
+        self.assertTrue(preparation.get_xen_format(test) == 'file')
+        test['format'] = 'qcow2'
+        self.assertTrue(preparation.get_xen_format(test) == 'tap:qcow2')
+
+
+class RecordingPreparation(preparation.KvmHostPreparation):
+
+    failon = None
+
+    def do_command(self, command, timeout=None, size=0, queued=0):
+        self.commands.append(command)
+        if self.failon != None and command == self.failon:
+            self.error_handler('Guest did not start')
+        if command.startswith('if [ -d /mnt/official_testing ]'):
+            return 'nfs' + ' 1048576' * 20
+        if command.endswith('echo ready; true'):
+            return 'ready'
+        return ''
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        dbops.Hosts().memory(['bullock', '16384'])
+        dbops.Hosts().cores(['bullock', '8'])
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_resume(self):
+        prepengine = engine.PreparationEngine(boot={'delay': 0})
+        prep = RecordingPreparation(prepengine, 'bullock')
+        prep.commands = []
+        prep.generate()
+        tests = [test['id'] for test in prep.testrun.tests]
+        prep.failon = prep.testrun.tests[-1]['cfgfile']
+        self.assertRaises(RuntimeError, prep.run)
+        self.assertTrue(prep.stage == 'Starting guests')
+
+        prep = RecordingPreparation(prepengine, 'bullock', resume=True)
+        prep.commands = []
+        prep.generate()
+        self.assertTrue([test['id'] for test in prep.testrun.tests] == tests)
+        prep.run()
+        started = [command for command in prep.commands
+                   if command.startswith('/xen/images/')]
+        self.assertTrue(started == ['/xen/images/%03d.sh' % len(tests)])
+        self.assertTrue(len([command for command in prep.commands
+                             if 'rm -f' in command or 'qemu-img' in command])
+                        == 0)
+        self.assertTrue(dbops.Checkpoints().load('bullock') == None)
+
+
+class TestHugepages(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '8'])
+        hostops.hugepages(['bullock', '8192'])
+        imageops = dbops.Images()
+        for image in imageops.list([]):
+            imageops.hugepages([image['image_name'], 'yes'])
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_hugepage_pool(self):
+        prepengine = engine.PreparationEngine(boot={'delay': 0})
+        prep = RecordingPreparation(prepengine, 'bullock')
+        prep.commands = []
+        prep.generate()
+        backed = [test for test in prep.testrun.tests
+                  if test['hugepages'] == 1]
+        self.assertTrue(len(backed) != 0)
+        self.assertTrue(sum([test['memory'] for test in backed]) <= 8192)
+        self.assertTrue('-mem-path /dev/hugepages' in
+                        preparation.kvm % backed[0])
+        self.assertRaises(RuntimeError, prep.run)
+        self.assertTrue(prep.stage == 'Check for free hugepages')
+
+
+class TestOvercommit(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '32'])
+        hostops.overcommit(['bullock', '1.5'])
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_overcommit(self):
+        prepengine = engine.PreparationEngine(boot={'delay': 0})
+        prep = RecordingPreparation(prepengine, 'bullock')
+        prep.commands = []
+        prep.generate()
+        tests = prep.testrun.tests
+        self.assertTrue(len([test for test in tests
+                             if test['balloon'] == 0]) == 0)
+        committed = sum([test['memory'] + test['shadowmem']
+                         for test in tests])
+        self.assertTrue(committed <= 16384 * 0.9 * 1.5)
+        self.assertTrue('-balloon virtio' in preparation.kvm % tests[0])
+        self.assertTrue('ksm/run' in preparation.kvmsetup % tests[0])
+        prep.run()
+        record = prepengine.report.memory[0]
+        self.assertTrue(record['physical'] == 16384)
+        self.assertTrue(record['swapped'] == 0)
+        self.assertTrue(record['committed'] ==
+                        sum([test['memory'] for test in tests]))
+
+    def test_no_overcommit_on_xen(self):
+        dbops.Hosts().set_type('bullock', 'xen', int(time.time()))
+        testrun = generator.TestRunGenerator('bullock')
+        self.assertTrue(testrun.resources['overcommit'] == 1.0)
+        self.assertTrue(len([test for test in testrun.tests
+                             if test['balloon'] == 1]) == 0)
+
+
+class TestRequirements(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '8'])
+        testops = dbops.Tests()
+        for test in ('ctcs', 'lmbench', 'ltp', 'foo'):
+            testops.requirement([test, 'Linux', 'prefmem', '1024'])
+            testops.requirement([test, 'Linux', 'prefcores', '1'])
+        testops.requirement(['kernbench', 'Linux', 'minmem', '2G'])
+        testops.requirement(['kernbench', 'Linux', 'mincores', '2'])
+        testops.requirement(['uname', 'Linux', 'minmem', '32G'])
+        testops.image_requirement(['uname', 'suse_sles11_64b_qcow.img',
+                                   'minmem', '1024'])
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_requirements(self):
+        testops = dbops.Tests()
+        self.assertRaises(ValueError, testops.requirement,
+                ['kernbench', 'Linux', 'prefmem', '1024'])
+        self.assertRaises(ValueError, testops.requirement,
+                ['kernbench', 'Linux', 'maxmem', '1024'])
+        testrun = generator.TestRunGenerator('bullock')
+        for test in testrun.tests:
+            self.assertTrue(test['memory'] >= test['minmemory'])
+            self.assertTrue(test['cores'] >= test['mincores'])
+            if test['test'] == 'kernbench' and test['smp'] == 1:
+                self.assertTrue(test['cores'] >= 2)
+            elif test['test'] == 'uname':
+                self.assertTrue(test['image'] == 'suse_sles11_64b_qcow.img')
+            elif test['test'] != 'kernbench':
+                self.assertTrue(test['memory'] == 1024)
+                self.assertTrue(test['cores'] == 1)
+
+
+class TestCandidateCache(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_shared_candidates(self):
+        generator.TestRunGenerator('bullock', True, 'xen-unstable', 1)
+        testrun = generator.TestRunGenerator('bullock', True, 'xen-unstable',
+                                             1, tests=[])
+        candidates = testrun.get_candidates(3)
+        testrun.query_candidates = None
+        self.assertTrue(testrun.get_candidates(3) == candidates)
+        testrun.set_done('UPDATE subject_schedule SET is_done=0 '
+                         'WHERE schedule_id=?', (0, ))
+        testrun.connection.commit()
+        testrun.query_candidates = lambda vendor: {'smallup': []}
+        self.assertTrue(testrun.get_candidates(3) == {'smallup': []})
+        dbops.Images().state(['suse_sles11_64b_qcow.img', 'disable'])
+        testrun.cursor.execute('SELECT * FROM candidate_cache')
+        self.assertTrue(testrun.cursor.fetchall() == [])
+
+
+class TestStarvation(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '8'])
+        testops = dbops.Tests()
+        for test in ('ctcs', 'lmbench', 'ltp', 'kernbench', 'foo', 'uname'):
+            testops.requirement([test, 'Linux', 'prefcores', '1'])
+        hostops.cursor.execute('''
+                UPDATE host_schedule SET age=150 WHERE schedule_id=(
+                    SELECT MAX(schedule_id) FROM host_schedule
+                    WHERE host_id=1)''')
+        hostops.connection.commit()
+
+    def tearDown(self):
+        generator.steerstarving = True
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_aging(self):
+        starving = [entry for entry in dbops.Schedules().list([])
+                    if entry['schedule_name'] == 'bullock']
+        self.assertTrue(len(starving) == 1)
+        self.assertTrue(starving[0]['age'] == 150)
+        self.assertTrue(starving[0]['is_satisfiable'] == 1)
+        testrun = generator.TestRunGenerator('bullock')
+        testids = [test['id'] for test in testrun.tests]
+        testrun.cursor.execute('''
+                SELECT MAX(schedule_id) FROM host_schedule
+                WHERE host_id=1''')
+        self.assertTrue(testrun.cursor.fetchone()[0] in testids)
+        testrun.do_finalize()
+        testrun.cursor.execute('''
+                SELECT MAX(age), MIN(age) FROM host_schedule
+                WHERE host_id=1 AND is_done=0''')
+        self.assertTrue(testrun.cursor.fetchone() == (1, 1))
+
+    def test_starving_vendor(self):
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        for vendor in (2, 3, 4):
+            testrun.cursor.execute('''
+                    UPDATE host_schedule SET age=0, is_done=0''')
+            testrun.cursor.execute('''
+                    UPDATE host_schedule SET age=150 WHERE schedule_id=(
+                        SELECT MIN(schedule_id) FROM host_schedule
+                        LEFT JOIN image ON
+                            host_schedule.image_id=image.image_id
+                        WHERE host_id=1 AND vendor_id=? AND is_64bit=0)''',
+                    (vendor, ))
+            testrun.connection.commit()
+            self.assertTrue(testrun.get_vendor() == vendor)
+
+    def test_starving_unfiltered(self):
+        generator.steerstarving = False
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        short = {'runtime': 60, 'ostype': 'Linux', 'age': 0,
+                 'prefmemory': 2048, 'prefcores': 2}
+        starving = {'runtime': 86400, 'ostype': 'Linux', 'age': 10 ** 9,
+                    'prefmemory': None, 'prefcores': None}
+        self.assertTrue(testrun.do_weighing([], [], [short], [starving]) ==
+                        starving)
+
+
+class TestVendorPolicy(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cursor.execute('''
+                UPDATE host_schedule SET is_done=1 WHERE host_id=1
+                AND image_id IN (SELECT image_id FROM image
+                                 WHERE vendor_id=3)''')
+        hostops.cursor.execute('''
+                UPDATE host_schedule SET is_done=0 WHERE host_id=1
+                AND image_id=5''')
+        hostops.cursor.execute('''
+                UPDATE host_schedule SET is_done=1 WHERE host_id=1
+                AND image_id=38''')
+        hostops.cursor.execute('UPDATE host SET last_vendor_id=2')
+        hostops.connection.commit()
+
+    def tearDown(self):
+        generator.vendorpolicy = 'runtime'
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_runtime(self):
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        self.assertTrue(testrun.get_vendor() == 2)
+        self.assertTrue(testrun.get_vendor() == 2)
+        testrun.cursor.execute('''
+                INSERT INTO test_requirement (test_id, image_id, min_cores)
+                SELECT test_id, image_id, 64 FROM host_schedule
+                WHERE host_id=1 AND image_id IN (SELECT image_id FROM image
+                                                 WHERE vendor_id=2)''')
+        testrun.connection.commit()
+        self.assertTrue(testrun.get_vendor() == 4)
+
+    def test_roundrobin(self):
+        generator.vendorpolicy = 'roundrobin'
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        self.assertTrue(testrun.get_vendor() == 3)
+        self.assertTrue(testrun.get_vendor() == 4)
+
+    def test_unfit_vendor(self):
+        generator.vendorpolicy = 'roundrobin'
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        testrun.cursor.execute('''
+                INSERT INTO test_requirement (test_id, image_id, min_memory)
+                SELECT test_id, image_id, 65536 FROM host_schedule
+                WHERE host_id=1 AND image_id IN (SELECT image_id FROM image
+                                                 WHERE vendor_id=3)''')
+        testrun.connection.commit()
+        test = testrun.get_test()
+        self.assertTrue(not test['image'].startswith('suse_'))
+        self.assertTrue(testrun.resources['lastvendor'] == 4)
+
+    def test_unlock_fitting(self):
+        generator.vendorpolicy = 'roundrobin'
+        testrun = generator.TestRunGenerator('bullock', tests=[])
+        testrun.cursor.execute('''
+                INSERT INTO test_requirement (test_id, image_id, min_memory)
+                SELECT test_id, image_id, 65536 FROM host_schedule
+                WHERE host_id=1 AND image_id=5''')
+        testrun.connection.commit()
+        test = testrun.get_test()
+        self.assertTrue(testrun.resources['lastvendor'] == 3)
+        self.assertTrue(test['image'].startswith('suse_'))
+        self.assertTrue(test['minmemory'] <= 16384)
+
+
+class TestSmokeFirst(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '8'])
+        dbops.Tests().requirement(['uname', 'Linux', 'prefcores', '1'])
+        self.smokeruntime = generator.smokeruntime
+        generator.smokeruntime = 60
+
+    def tearDown(self):
+        generator.smokeruntime = self.smokeruntime
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_short_tests_first(self):
+        testrun = generator.TestRunGenerator('bullock')
+        self.assertTrue(len(testrun.tests) > 1)
+        for test in testrun.tests:
+            self.assertTrue(test['test'] == 'uname')
+        self.assertTrue(testrun.get_smoked_ostypes()[0] == 'Linux')
+
+
+class TestBuilds(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '8'])
+        self.smokeruntime = generator.smokeruntime
+        generator.smokeruntime = 60
+
+    def tearDown(self):
+        generator.smokeruntime = self.smokeruntime
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_record_build(self):
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1)
+        build = os.path.basename(prep.build)
+        prep.testrun.do_finalize()
+        builds = dbops.Builds().list([])
+        self.assertTrue(len(builds) == 1)
+        self.assertTrue(builds[0]['build'] == build)
+        self.assertTrue(builds[0]['runs'] == 1)
+        self.assertTrue(builds[0]['guests'] > 0)
+        runs = dbops.Builds().runs(['xen-unstable', '64', build])
+        self.assertTrue(len(runs) == builds[0]['guests'])
+
+    def test_fasttrack(self):
+        cursor = dbops.Builds().cursor
+        cursor.execute('''
+                UPDATE subject SET last_build='older' WHERE subject_id=1''')
+        cursor.execute('''
+                UPDATE subject_schedule SET is_done=1 WHERE subject_id=1''')
+        cursor.connection.commit()
+        prep = preparation.SubjectPreparation('bullock', 'xen-unstable', 1)
+        cursor.execute('''
+                SELECT test_name, MIN(is_done) FROM subject_schedule
+                LEFT JOIN test ON test.test_id=subject_schedule.test_id
+                WHERE subject_id=1 GROUP BY test_name''')
+        for test, done in cursor.fetchall():
+            self.assertTrue(done == int(test != 'uname'))
+        self.assertTrue(len(prep.testrun.tests) > 0)
+        for test in prep.testrun.tests:
+            self.assertTrue(test['test'] == 'uname')
+
+
+class TestOverheadModel(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+        hostops = dbops.Hosts()
+        hostops.memory(['bullock', '16384'])
+        hostops.cores(['bullock', '4'])
+        hostops.hostclass(['bullock', 'big'])
+        hostops.set_type('bullock', 'kvm', int(time.time()))
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_measured_values(self):
+        overheadops = dbops.Overheads()
+        overheadops.add(['kvm', 'all', 'reserve', '4096'])
+        overheadops.add(['kvm', 'big', 'vcpus', '2'])
+        overheadops.add(['kvm', 'big', 'shadow', '0'])
+        overheadops.add(['xen', 'all', 'reserve', '8192'])
+        testrun = generator.TestRunGenerator('bullock')
+        self.assertTrue(testrun.overhead['reserve'] == 4096)
+        self.assertTrue(testrun.overhead['share'] == 0.1)
+        tests = testrun.tests
+        self.assertTrue(sum([test['cores'] for test in tests]) <= 8)
+        self.assertTrue(sum([test['memory'] for test in tests]) <=
+                        16384 - 4096)
+        self.assertTrue(max([test['shadowmem'] for test in tests]) == 0)
+        self.assertRaises(ValueError, overheadops.add,
+                ['kvm', 'all', 'bogus', '1'])
+        overheadops.delete(['kvm', 'all', 'reserve'])
+        self.assertTrue(overheadops.get_model('kvm', None) ==
+                        dbops.overheads['default'])
+
+
+class TestHypervisorDetection(unittest.TestCase):
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def test_cached_type(self):
+        hostops = dbops.Hosts()
+        hostops.set_type('bullock', 'kvm', int(time.time()))
+        self.assertTrue(engine.detect_hypervisors(['bullock']) ==
+                        {'bullock': 'kvm'})
+        self.assertTrue(hostops.get_types(['bullock', 'nohost']).keys() ==
+                        ['bullock'])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.hostops = dbops.Hosts()
+        self.hostops.reset_failures('bullock')
+
+    def tearDown(self):
+        self.hostops.reset_failures('bullock')
+
+    def expire_cooldown(self):
+        self.hostops.cursor.execute('''UPDATE host SET cooldown_until=0
+                WHERE host_name=?''', ('bullock', ))
+        self.hostops.connection.commit()
+
+    def test_open_after_failures(self):
+        for count in range(3):
+            self.assertTrue(engine.check_health(['bullock']) == {})
+            engine.record_health({'bullock': {'status': 'failed',
+                    'stage': 'Generating tests', 'reason': 'No tests'}})
+            engine.record_health({'bullock': {'status': 'failed',
+                    'stage': 'Check for kernel modules',
+                    'reason': 'Host is down'}})
+        health = self.hostops.get_health(['bullock'])['bullock']
+        self.assertTrue(health['state'] == 'open')
+        self.assertTrue(health['failures'] == 3)
+        skipped = engine.check_health(['bullock'])
+        self.assertTrue(skipped['bullock'].endswith('Host is down'))
+        listing = [row for row in self.hostops.list([])
+                   if row['host_name'] == 'bullock']
+        self.assertTrue(listing[0]['breaker'] == 'open')
+
+    def test_probe(self):
+        for count in range(3):
+            self.hostops.add_failure('bullock', 'Host is down')
+        self.expire_cooldown()
+        remote = executor.SimulatedExecutor(0.01, failrate=1.0)
+        skipped = engine.check_health(['bullock'], remote=remote)
+        self.assertTrue(skipped['bullock'].startswith('Health probe failed'))
+        remote.cleanup()
+        health = self.hostops.get_health(['bullock'])['bullock']
+        self.assertTrue(health['state'] == 'open')
+        self.expire_cooldown()
+        remote = executor.SimulatedExecutor(0.01)
+        self.assertTrue(engine.check_health(['bullock'], remote=remote) == {})
+        health = self.hostops.get_health(['bullock'])['bullock']
+        self.assertTrue(health['state'] == 'closed')
+        remote.cleanup()
+
+
+class TestTransferScheduler(unittest.TestCase):
+
+    def test_shortest_host_first(self):
+        scheduler = transfer.TransferScheduler({'nfs': (1, 1024)})
+        scheduler.register('long', 1000)
+        scheduler.register('short', 10)
+        order = []
+        def copy(host):
+            scheduler.acquire(host, 'nfs', 1)
+            order.append(host)
+            scheduler.release(host, 'nfs', 1)
+        scheduler.acquire('first', 'nfs', 1)
+        threads = [threading.Thread(target=copy, args=(host, ))
+                   for host in ('long', 'short')]
+        for thread in threads:
+            thread.start()
+        while len(scheduler.sources['nfs']['waiting']) != 2:
+            time.sleep(0.01)
+        scheduler.release('first', 'nfs', 1)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(order == ['short', 'long'])
+        self.assertTrue(scheduler.sources['nfs']['count'] == 3)
+
+
+class TestDistribution(unittest.TestCase):
+
+    def setUp(self):
+        self.server = tempfile.mkdtemp()
+        self.hosts = {}
+        for image in ('suite.img', 'guest1.img', 'guest2.img'):
+            open(os.path.join(self.server, image), 'w').write(image)
+        for host in ('host1', 'host2', 'host3', 'host4', 'host5'):
+            self.hosts[host] = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for directory in [self.server] + self.hosts.values():
+            shutil.rmtree(directory)
+
+    def stage(self, plan, host, images):
+        for image in plan.start(host, images):
+            source = plan.acquire(host, image)
+            sourcedir = self.server
+            if source != None:
+                sourcedir = self.hosts[source]
+            shutil.copy(os.path.join(sourcedir, image), self.hosts[host])
+            plan.release(host, image, source, True)
+
+    def get_needs(self):
+        needs = {'host5': ['suite.img', 'guest1.img']}
+        for host in ('host1', 'host2', 'host3', 'host4'):
+            needs[host] = ['suite.img', 'guest1.img']
+            if host in ('host1', 'host2'):
+                needs[host] = ['suite.img', 'guest2.img']
+        return needs
+
+    def test_fanout(self):
+        needs = self.get_needs()
+        plan = distribution.DistributionPlan(needs, 1)
+        plan.fail('host5')
+        threads = []
+        for host in ('host1', 'host2', 'host3', 'host4'):
+            threads.append(threading.Thread(target=self.stage,
+                                            args=(plan, host, needs[host])))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(plan.copies == {'central': 3, 'peer': 5})
+        for host in ('host3', 'host4'):
+            content = open(os.path.join(self.hosts[host], 'guest1.img')).read()
+            self.assertTrue(content == 'guest1.img')
+
+    def test_fanout_one_by_one(self):
+        needs = self.get_needs()
+        plan = distribution.DistributionPlan(needs, 1)
+        for host in ('host4', 'host3', 'host2', 'host1'):
+            self.stage(plan, host, needs[host])
+        self.assertTrue(plan.copies == {'central': 3, 'peer': 5})
+
+
+class TestReadOutput(unittest.TestCase):
+
+    def test_large_output(self):
+        process = subprocess.Popen(['/bin/sh', '-c', 'seq 200000'],
+                                   stdout=subprocess.PIPE)
+        retval, output = engine.read_output(process, 30)
+        self.assertTrue(retval == 0)
+        self.assertTrue(output.split()[-1] == '200000')
+
+    def test_timeout(self):
+        started = time.time()
+        process = subprocess.Popen(['/bin/sh', '-c', 'echo started; sleep 10'],
+                                   stdout=subprocess.PIPE)
+        retval, output = engine.read_output(process, 0.5)
+        self.assertTrue(retval == None)
+        self.assertTrue(output == 'started\n')
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(engine.get_timeout_message(output, 1) ==
+                        'started\nTimed out after 1 seconds')
+
+    def test_remote_timeout(self):
+        calls = []
+        popen = executor.Popen
+        executor.Popen = lambda args, **kwargs: calls.append(args)
+        try:
+            executor.SshExecutor().spawn('bullock', "echo 'a b'", 60)
+        finally:
+            executor.Popen = popen
+        command = calls[0][-1]
+        self.assertTrue(command.startswith('/usr/bin/timeout -k 10 61 '))
+        process = subprocess.Popen(['/bin/sh', '-c',
+                command.replace('/usr/bin/timeout', 'timeout')],
+                stdout=subprocess.PIPE)
+        self.assertTrue(process.communicate()[0] == 'a b\n')
+
+
+class TestPreparationReport(unittest.TestCase):
+
+    def test_stages(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'logs', 'report.jsonl')
+        prepreport = report.PreparationReport(filename)
+        prepreport.add_command('host1', 'Check', 'xend status', 100.0, 1.0, 0)
+        prepreport.add_command('host1', 'Copy', 'cp a\nb', 101.0, 5.0, 0, 2048)
+        prepreport.add_command('host1', 'Copy', 'cp c', 102.0, 6.0, 0, 1024, 3)
+        prepreport.add_host('host1', 'done', 99.0, 10.0, 2)
+        prepreport.add_host('host2', 'failed', None, 0, 0)
+        prepreport.close()
+        records = [json.loads(line) for line in open(filename)]
+        shutil.rmtree(directory)
+        self.assertTrue([record['type'] for record in records] ==
+                        ['command'] * 3 + ['stage'] * 2 + ['host'] * 2)
+        self.assertTrue(records[1]['command'] == 'cp a')
+        self.assertTrue(records[4]['stage'] == 'Copy')
+        self.assertTrue(records[4]['duration'] == 7.0)
+        self.assertTrue(records[4]['bytes'] == 3072)
+        summary = prepreport.get_summary()
+        self.assertTrue(summary[2].split()[0] == 'host1')
+        self.assertTrue(summary[6].split()[0] == 'Copy')
+
+
+class TestTaskPool(unittest.TestCase):
+
+    def test_failure_stops_pool(self):
+        done = []
+        def step(name):
+            if name == 'b2':
+                raise RuntimeError('broken')
+            done.append(name)
+        pool = engine.TaskPool(1)
+        for task in ('a', 'b', 'c'):
+            pool.add([('First', step, (task + '1', )),
+                      ('Second', step, (task + '2', ))])
+        pool.start()
+        stage, err = pool.join()
+        self.assertTrue(stage == 'Second')
+        self.assertTrue(str(err) == 'broken')
+        self.assertTrue(done == ['a1', 'a2', 'b1'])
+
+
+class TestPreparationEngine(unittest.TestCase):
+
+    def setUp(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    def tearDown(self):
+        os.system('cp t/orig-db t/test-schedule.db')
+
+    class FakePreparation:
+
+        def __init__(self, base, host, fail, guests=2):
+            self.base = base
+            self.host = host
+            self.fail = fail
+            self.guests = guests
+            self.overlay = False
+            self.resume = False
+            self.stage = ''
+            self.testrun = None
+            self.sizes = {}
+
+        def generate(self):
+            self.stage = 'Generating tests'
+            self.tests = [{}] * self.guests
+            self.testrun = self
+
+        def get_transfers(self):
+            return ['image%d.img' % (index, ) for index in range(self.guests)]
+
+        def run(self):
+            self.stage = 'Starting guests'
+            self.base.order.append(self.host)
+            self.base.acquire_command(self.host)
+            try:
+                self.base.active += 1
+                self.base.maximum = max(self.base.maximum, self.base.active)
+                time.sleep(0.05)
+                self.base.active -= 1
+            finally:
+                self.base.release_command(self.host)
+            if self.fail:
+                raise RuntimeError('Guest did not start')
+
+    def test_limits_and_results(self):
+        output = tempfile.TemporaryFile()
+        prepengine = engine.PreparationEngine({'hosts': 4, 'commands': 2})
+        prepengine.active = 0
+        prepengine.maximum = 0
+        prepengine.order = []
+        prepengine.write = lambda text, stream=None: output.write(text)
+        for index in range(6):
+            prepengine.add(self.FakePreparation(prepengine, 'host%d' % index,
+                                                index == 3))
+        results = prepengine.run()
+        self.assertTrue(prepengine.maximum == 2)
+        self.assertTrue(prepengine.get_failed() == ['host3'])
+        self.assertTrue(results['host3']['stage'] == 'Starting guests')
+        self.assertTrue(results['host3']['reason'] == 'Guest did not start')
+        self.assertTrue(results['host0']['guests'] == 2)
+
+    def test_longest_first(self):
+        output = tempfile.TemporaryFile()
+        prepengine = engine.PreparationEngine({'hosts': 2})
+        prepengine.active = 0
+        prepengine.maximum = 0
+        prepengine.order = []
+        prepengine.write = lambda text, stream=None: output.write(text)
+        for index, guests in enumerate([1, 4, 2, 3]):
+            prepengine.add(self.FakePreparation(prepengine, 'host%d' % index,
+                                                False, guests))
+        prepengine.run()
+        self.assertTrue(prepengine.order[:2] in (['host1', 'host3'],
+                                                 ['host3', 'host1']))
+        self.assertTrue(prepengine.order[2:] == ['host2', 'host0'])
+        estimates = prepengine.estimates
+        self.assertTrue(prepengine.makespan['estimated'] ==
+                max(estimates['host1'] + estimates['host0'],
+                    estimates['host3'] + estimates['host2']))
+
+    def test_estimate_from_history(self):
+        prepengine = engine.PreparationEngine()
+        dbops.Hosts().set_history('bullock', 2,
+                [('Copying guest image files', 10.0, 100 * 1048576),
+                 ('Starting guests', 4.0, 0)])
+        history = dbops.Hosts().get_history(['bullock', 'nosuchhost'])
+        self.assertTrue(history.keys() == ['bullock'])
+        prep = self.FakePreparation(prepengine, 'bullock', False, 4)
+        prep.generate()
+        sizes = dict([('image%d.img' % (index, ), 50 * 1048576)
+                      for index in range(4)])
+        self.assertTrue(abs(prepengine.estimate(prep, sizes,
+                history['bullock']) - 28.0) < 0.001)
+
+
+class TestSimulatedFleet(unittest.TestCase):
+
+    def prepare(self, failrate, overlay, hosts=6, guests=3, boot=None):
+        output = tempfile.TemporaryFile()
+        remote = executor.SimulatedExecutor(0.01, 1000, failrate, 1)
+        if boot == None:
+            boot = {'delay': 0}
+        prepengine = engine.PreparationEngine({'hosts': 4}, overlay,
+                                              remote=remote, boot=boot)
+        prepengine.write = lambda text, stream=None: output.write(text)
+        for index in range(hosts):
+            prepengine.add(preparation.KvmHostPreparation(prepengine,
+                    'sim%d' % index, overlay,
+                    testrun=executor.SimulatedTestRun(guests)))
+        try:
+            return prepengine, prepengine.run()
+        finally:
+            remote.cleanup()
+
+    def test_fanout(self):
+        threads = []
+        start = threading.Thread.start
+        def count(thread):
+            threads.append(thread)
+            start(thread)
+        threading.Thread.start = count
+        try:
+            prepengine, results = self.prepare(0.0, True)
+        finally:
+            threading.Thread.start = start
+        # Engine workers plus one pool of hostcommands threads per host
+        self.assertTrue(len(threads) <= 4 + 6 * 4)
+        self.assertTrue(prepengine.get_failed() == [])
+        self.assertTrue(sum([result['guests']
+                             for result in results.values()]) == 18)
+        self.assertTrue(prepengine.distribution.copies['peer'] > 0)
+        self.assertTrue(prepengine.report.get_bytes() > 0)
+
+    def test_outdated_base_images(self):
+        remote = executor.SimulatedExecutor(0.01, 1000, 0.0, 1)
+        copied = []
+        try:
+            for imagesize in (1, 1, 2):
+                remote.imagesize = imagesize
+                prepengine = engine.PreparationEngine({'hosts': 1},
+                        remote=remote, history=False, boot={'delay': 0})
+                prepengine.write = lambda text, stream=None: None
+                prepengine.add(preparation.KvmHostPreparation(prepengine,
+                        'sim0', True, testrun=executor.SimulatedTestRun(2)))
+                prepengine.run()
+                self.assertTrue(prepengine.get_failed() == [])
+                copied.append(prepengine.report.get_bytes())
+        finally:
+            remote.cleanup()
+        self.assertTrue(copied[0] == 3 * 1048576)
+        self.assertTrue(copied[1] == 0)
+        self.assertTrue(copied[2] == 3 * 2 * 1048576)
+
+    def test_failures(self):
+        prepengine, results = self.prepare(1.0, False)
+        self.assertTrue(len(prepengine.get_failed()) == 6)
+        self.assertTrue(results['sim0']['stage'] == 'Check for kernel modules')
+        self.assertTrue(results['sim0']['reason'].startswith(
+                'Simulated failure of: /sbin/modprobe'))
+
+    def test_staggered_boot(self):
+        prepengine, results = self.prepare(0.0, False, 1, 4,
+                                           {'parallel': 1, 'delay': 0.2})
+        guests = sorted(prepengine.report.guests,
+                        key=lambda record: record['start'])
+        self.assertTrue(len(guests) == 4)
+        self.assertTrue(len([record for record in guests
+                             if record['ready']]) == 4)
+        for before, after in zip(guests, guests[1:]):
+            self.assertTrue(after['start'] - before['start'] >= 0.2)
+            self.assertTrue(after['start'] >=
+                            before['start'] + before['duration'])
+
+
 if __name__ == '__main__':
     unittest.main()
 